@@ -4,76 +4,976 @@
 	Passing instructions in this way is efficient, and also allows for multiple keys to be changed with a single bitmask.
 	These are distinguished from other messages by also being prefixed with a specific control character.
 
+	Every command can also be sent as a binary frame (see wire_protocol.lua), whose opcode is the byte
+	value of the command's control character. Each command registers how to parse its text and binary
+	forms, and replies in the same form it was received in.
+
+	Every accepted socket gets its own session, holding its parsing state, its role and the replies
+	still waiting to be sent. One session at a time can be the control client; any number of others
+	can attach as read-only telemetry clients (monitors, metrics scrapers, debuggers).
+
+	Each session is greeted with the instance's identity (instance ID, PID, ROM and the port actually
+	bound), since the server moves to the next port if its assigned one is taken.
+
 	Basic host/client communication (see functions ST_*) is based loosely on mGBA test script(s) from official repo.
 ]]
 
 local state_manager = require("state_manager")
--- state_manager.initialize_state()
+local wire_protocol = require("wire_protocol")
+local json = require("json_utils")
 local instance = state_manager.create_instance()
-console:log("Created instance with port " .. instance.port .. " and timestamp " .. instance.timestamp)
+console:log("Created instance " .. instance.instance_id .. " at " .. instance.started)
 
---[[ begin section Bitmask Utilities ]]
-local PK_KEY_STATE_CTRL_CHAR = "\x01"
+--[[ begin section Command Registry ]]
+-- Commands are looked up by control character. parse_text receives the rest of the text line
+-- and parse_binary the frame payload; both return the arguments passed to handle after req.
+-- Commands marked read_only only observe the emulator, so telemetry sessions may send them.
+PK_commands = {}
 
-function PK_is_valid_key_state_bitmask_str(ks_str)
-	-- Check if string starts with key state control character, which is used to
-	-- distinguish key state messages from other messages.
-	if string.sub(ks_str, 1, 1) == PK_KEY_STATE_CTRL_CHAR then
-		return true
+function PK_register_command(ctrl_char, command)
+	PK_commands[ctrl_char] = command
+end
+
+-- Helpers for the binary forms of commands with repeated fixed-size records
+function PK_unpack_records(payload, format)
+	local records = {}
+	local size = string.packsize(format)
+	for pos = 1, #payload - size + 1, size do
+		table.insert(records, { string.unpack(format, payload, pos) })
+	end
+	return records
+end
+--[[ end section Command Registry ]]
+
+--[[ begin section Reply Utilities ]]
+-- Replies are sent back to the client as lines prefixed with the control character of the
+-- request they answer, so the client can tell them apart from other messages.
+-- A request line may itself be prefixed with a request ID, e.g. "\x1042\x011" sets the keys
+-- as request 42. Its reply then carries the same prefix, and commands that otherwise have
+-- nothing to say reply "ok" once they have been applied, so the client knows they have run.
+-- Requests received as binary frames are answered with binary frames carrying the same ID.
+local PK_REQUEST_ID_CTRL_CHAR = "\x10"
+
+function PK_parse_request(sock_id, line)
+	local req_id, rest = string.match(line, "^" .. PK_REQUEST_ID_CTRL_CHAR .. "(%d+)(.*)$")
+	if req_id then
+		return { sock_id = sock_id, req_id = req_id }, rest
+	end
+	return { sock_id = sock_id }, line
+end
+
+function PK_reply_prefix(req, ctrl_char)
+	if req.req_id then
+		return PK_REQUEST_ID_CTRL_CHAR .. req.req_id .. ctrl_char
+	end
+	return ctrl_char
+end
+
+function PK_send(sock_id, data)
+	local session = ST_sessions[sock_id]
+	if not session then return end
+	ST_queue(session, data)
+end
+
+function PK_reply(req, ctrl_char, msg)
+	if req.binary then
+		PK_send(req.sock_id, wire_protocol.encode_frame(string.byte(ctrl_char), req.req_id, msg))
+	else
+		PK_send(req.sock_id, PK_reply_prefix(req, ctrl_char) .. msg .. "\n")
+	end
+end
+
+-- Raw data: a binary frame, or a text header line with the byte count followed by the bytes
+function PK_reply_bulk(req, ctrl_char, data)
+	if req.binary then
+		PK_reply(req, ctrl_char, data)
 	else
-		return false
+		PK_send(req.sock_id, PK_reply_prefix(req, ctrl_char) .. #data .. "\n" .. data)
 	end
 end
 
-function PK_handle_key_state_bitmask(ks_bitmask)
-	-- Remove control character and convert to number
-    local bitmask = tonumber(string.sub(ks_bitmask, 2))
+function PK_ack(req, ctrl_char)
+	if req.req_id then
+		PK_reply(req, ctrl_char, "ok")
+	end
+end
+--[[ end section Reply Utilities ]]
+
+--[[ begin section Bitmask Utilities ]]
+local PK_KEY_STATE_CTRL_CHAR = "\x01"
+
+function PK_handle_key_state_bitmask(req, bitmask)
     -- console:log("Received bitmask: " .. bitmask)
     emu:setKeys(bitmask)
+    PK_ack(req, PK_KEY_STATE_CTRL_CHAR)
 end
+
+PK_register_command(PK_KEY_STATE_CTRL_CHAR, {
+	-- Convert the decimal bitmask to a number
+	parse_text = function(body) return tonumber(body) end,
+	parse_binary = function(payload) return string.unpack("<I2", payload) end,
+	handle = PK_handle_key_state_bitmask,
+})
 --[[ end section Bitmask Utilities ]]
 
 --[[ begin section Reset Utilities ]]
 -- Reset is a special case because it is not a key state, but rather a control character.
 -- It is used to reset the game to the initial state.
 local PK_RESET_CTRL_CHAR = "\x02"
-function PK_is_reset_cmd(str)
-	if string.sub(str, 1, 1) == PK_RESET_CTRL_CHAR then
-		return true
-	end
-end
 
-function PK_handle_reset()
+function PK_handle_reset(req)
 	console:log("Resetting game")
+	if PK_program then
+		PK_finish_program("cancelled")
+	end
 	emu:setKeys(0)
 	emu:reset()
+	PK_ack(req, PK_RESET_CTRL_CHAR)
 end
+
+PK_register_command(PK_RESET_CTRL_CHAR, {
+	parse_text = function() end,
+	parse_binary = function() end,
+	handle = PK_handle_reset,
+})
 --[[ end section Reset Utilities ]]
 
 --[[ begin section Screenshot Utilities ]]
 local PK_SCREENSHOT_CTRL_CHAR = "\x03"
-function PK_is_screenshot_cmd(str)
-	if string.sub(str, 1, 1) == PK_SCREENSHOT_CTRL_CHAR then
-		return true
-	end
-end
 
-function PK_handle_screenshot(str)
-	local filename = string.sub(str, 2)
+function PK_handle_screenshot(req, filename)
 	console:log("Taking screenshot to " .. filename)
+	-- The file has been fully written once this returns
 	emu:screenshot("temp/" .. filename)
+	PK_ack(req, PK_SCREENSHOT_CTRL_CHAR)
 end
+
+PK_register_command(PK_SCREENSHOT_CTRL_CHAR, {
+	parse_text = function(body) return body end,
+	parse_binary = function(payload) return payload end,
+	handle = PK_handle_screenshot,
+	read_only = true,
+})
 --[[ end section Screenshot Utilities ]]
 
+--[[ begin section Input Program Utilities ]]
+-- An input program is a list of "bitmask:frames" steps, e.g. "\x041:3,0:40,128:3".
+-- The whole program is uploaded in one message and played back on the frame callback,
+-- so its timing is measured in emulated frames rather than in wall-clock time.
+-- Binary form: one little-endian (u16 bitmask, u32 frames) record per step.
+local PK_PROGRAM_CTRL_CHAR = "\x04"
+PK_program = nil
+
+function PK_finish_program(status)
+	local program = PK_program
+	PK_program = nil
+	emu:setKeys(0)
+	PK_reply(program.req, program.ctrl_char, status)
+end
+
+function PK_advance_program()
+	-- Move on to the next step, skipping any that have no frames left
+	while PK_program.remaining <= 0 do
+		PK_program.index = PK_program.index + 1
+		local step = PK_program.steps[PK_program.index]
+		if not step then
+			PK_finish_program(PK_program.ended)
+			return
+		end
+		emu:setKeys(step.bitmask)
+		PK_program.remaining = step.frames
+	end
+end
+
+-- stop, if given, returns the reply once the program should stop early, and nothing until then.
+-- ended is the reply if it plays to the end.
+function PK_start_program(req, ctrl_char, steps, stop, ended)
+	-- Only one program runs at a time, a new one replaces whatever is playing
+	if PK_program then
+		PK_finish_program("cancelled")
+	end
+
+	PK_program = { steps = steps, index = 0, remaining = 0, req = req, ctrl_char = ctrl_char, stop = stop, ended = ended }
+	if PK_check_program_stop() then return end
+	PK_advance_program()
+end
+
+function PK_check_program_stop()
+	local result = PK_program.stop and PK_program.stop()
+	if result then
+		PK_finish_program(result)
+		return true
+	end
+	return false
+end
+
+function PK_handle_program(req, steps)
+	PK_start_program(req, PK_PROGRAM_CTRL_CHAR, steps, nil, "done")
+end
+
+function PK_step_program()
+	if not PK_program then return end
+	if PK_check_program_stop() then return end
+	PK_program.remaining = PK_program.remaining - 1
+	PK_advance_program()
+end
+
+PK_register_command(PK_PROGRAM_CTRL_CHAR, {
+	parse_text = function(body)
+		local steps = {}
+		for bitmask, frames in string.gmatch(body, "(%d+):(%d+)") do
+			table.insert(steps, { bitmask = tonumber(bitmask), frames = tonumber(frames) })
+		end
+		return steps
+	end,
+	parse_binary = function(payload)
+		local steps = {}
+		for _, record in ipairs(PK_unpack_records(payload, "<I2I4")) do
+			table.insert(steps, { bitmask = record[1], frames = record[2] })
+		end
+		return steps
+	end,
+	handle = PK_handle_program,
+})
+--[[ end section Input Program Utilities ]]
+
+--[[ begin section Savestate Utilities ]]
+-- Savestates are captured into named slots held in memory by this script, e.g. "\x05encounter".
+-- Restoring one replaces soft-resetting and navigating the title screen on every cycle.
+-- Only tagged requests are acknowledged, so an untagged one can lead a batch without a reply.
+local PK_SAVE_STATE_CTRL_CHAR = "\x05"
+local PK_LOAD_STATE_CTRL_CHAR = "\x06"
+local PK_state_slots = {}
+
+function PK_handle_save_state(req, slot)
+	local buffer = emu:saveStateBuffer()
+	if not buffer then
+		PK_reply(req, PK_SAVE_STATE_CTRL_CHAR, "error could not save state")
+		return
+	end
+	PK_state_slots[slot] = buffer
+	console:log("Saved state to slot " .. slot)
+	PK_ack(req, PK_SAVE_STATE_CTRL_CHAR)
+end
+
+function PK_handle_load_state(req, slot)
+	local buffer = PK_state_slots[slot]
+	if not buffer then
+		PK_reply(req, PK_LOAD_STATE_CTRL_CHAR, "error no state in slot " .. slot)
+		return
+	end
+	if PK_program then
+		PK_finish_program("cancelled")
+	end
+	emu:setKeys(0)
+	if not emu:loadStateBuffer(buffer) then
+		PK_reply(req, PK_LOAD_STATE_CTRL_CHAR, "error could not load state")
+		return
+	end
+	PK_ack(req, PK_LOAD_STATE_CTRL_CHAR)
+end
+
+PK_register_command(PK_SAVE_STATE_CTRL_CHAR, {
+	parse_text = function(body) return body end,
+	parse_binary = function(payload) return payload end,
+	handle = PK_handle_save_state,
+})
+
+PK_register_command(PK_LOAD_STATE_CTRL_CHAR, {
+	parse_text = function(body) return body end,
+	parse_binary = function(payload) return payload end,
+	handle = PK_handle_load_state,
+})
+--[[ end section Savestate Utilities ]]
+
+--[[ begin section Memory Utilities ]]
+-- Reads any number of "address:length" ranges (decimal) of the GBA address space in one request,
+-- e.g. "\x0733702276:100,33701929:1". Each range is sent back hex encoded, in request order.
+-- Binary form: one (u32 address, u32 length) record per range, answered with the raw bytes
+-- of every range back to back.
+local PK_READ_MEMORY_CTRL_CHAR = "\x07"
+
+function PK_to_hex(data)
+	return (string.gsub(data, ".", function(c) return string.format("%02x", string.byte(c)) end))
+end
+
+function PK_handle_read_memory(req, ranges)
+	local chunks = {}
+	for _, range in ipairs(ranges) do
+		local data = emu:readRange(range.address, range.length)
+		table.insert(chunks, req.binary and data or PK_to_hex(data))
+	end
+	PK_reply(req, PK_READ_MEMORY_CTRL_CHAR, table.concat(chunks, req.binary and "" or ","))
+end
+
+PK_register_command(PK_READ_MEMORY_CTRL_CHAR, {
+	parse_text = function(body)
+		local ranges = {}
+		for address, length in string.gmatch(body, "(%d+):(%d+)") do
+			table.insert(ranges, { address = tonumber(address), length = tonumber(length) })
+		end
+		return ranges
+	end,
+	parse_binary = function(payload)
+		local ranges = {}
+		for _, record in ipairs(PK_unpack_records(payload, "<I4I4")) do
+			table.insert(ranges, { address = record[1], length = record[2] })
+		end
+		return ranges
+	end,
+	handle = PK_handle_read_memory,
+	read_only = true,
+})
+--[[ end section Memory Utilities ]]
+
+--[[ begin section Frame Grab Utilities ]]
+-- Sends the current frame back as raw bytes (3 bytes RGB per pixel, row by row) instead of
+-- encoding a PNG to disk.
+local PK_GRAB_FRAME_CTRL_CHAR = "\x08"
+
+function PK_frame_rgb_bytes()
+	local img = emu:screenshotToImage()
+	local rows = {}
+	local pixels = {}
+	for y = 0, img.height - 1 do
+		for x = 0, img.width - 1 do
+			local color = img:getPixel(x, y)  -- ARGB
+			pixels[x + 1] = string.char((color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF)
+		end
+		rows[y + 1] = table.concat(pixels)
+	end
+	return table.concat(rows)
+end
+
+function PK_handle_grab_frame(req)
+	PK_reply_bulk(req, PK_GRAB_FRAME_CTRL_CHAR, PK_frame_rgb_bytes())
+end
+
+PK_register_command(PK_GRAB_FRAME_CTRL_CHAR, {
+	parse_text = function() end,
+	parse_binary = function() end,
+	handle = PK_handle_grab_frame,
+	read_only = true,
+})
+--[[ end section Frame Grab Utilities ]]
+
+--[[ begin section Probe Utilities ]]
+-- Samples "x,y" points and "x,y,w,h" rectangles separated by ";", e.g. "\x09105,38;0,0,240,16".
+-- Points are answered with their RGB color and rectangles with a 32-bit FNV-1a hash of their
+-- RGB bytes, both in hex, so a check costs a few bytes instead of a whole frame.
+-- Binary form: one (u16 x, u16 y, u16 w, u16 h) record per region, with w = h = 0 for a point,
+-- answered with one u32 per region.
+local PK_PROBE_CTRL_CHAR = "\x09"
+
+function PK_region_hash(img, x, y, w, h)
+	local hash = 0x811C9DC5
+	for py = y, y + h - 1 do
+		for px = x, x + w - 1 do
+			local color = img:getPixel(px, py)
+			hash = ((hash ~ ((color >> 16) & 0xFF)) * 0x01000193) & 0xFFFFFFFF
+			hash = ((hash ~ ((color >> 8) & 0xFF)) * 0x01000193) & 0xFFFFFFFF
+			hash = ((hash ~ (color & 0xFF)) * 0x01000193) & 0xFFFFFFFF
+		end
+	end
+	return hash
+end
+
+function PK_probe_value(img, region)
+	if region.w then
+		return PK_region_hash(img, region.x, region.y, region.w, region.h)
+	end
+	return img:getPixel(region.x, region.y) & 0xFFFFFF
+end
+
+function PK_handle_probe(req, regions)
+	local img = emu:screenshotToImage()
+	local values = {}
+	for _, region in ipairs(regions) do
+		local value = PK_probe_value(img, region)
+		if req.binary then
+			table.insert(values, string.pack("<I4", value))
+		else
+			table.insert(values, string.format(region.w and "%08x" or "%06x", value))
+		end
+	end
+	PK_reply(req, PK_PROBE_CTRL_CHAR, table.concat(values, req.binary and "" or ","))
+end
+
+PK_register_command(PK_PROBE_CTRL_CHAR, {
+	parse_text = function(body)
+		local regions = {}
+		for region_str in string.gmatch(body, "[^;]+") do
+			local nums = {}
+			for n in string.gmatch(region_str, "%d+") do
+				table.insert(nums, tonumber(n))
+			end
+			table.insert(regions, { x = nums[1], y = nums[2], w = nums[3], h = nums[4] })
+		end
+		return regions
+	end,
+	parse_binary = function(payload)
+		local regions = {}
+		for _, record in ipairs(PK_unpack_records(payload, "<I2I2I2I2")) do
+			local x, y, w, h = table.unpack(record, 1, 4)
+			if w == 0 and h == 0 then
+				w, h = nil, nil
+			end
+			table.insert(regions, { x = x, y = y, w = w, h = h })
+		end
+		return regions
+	end,
+	handle = PK_handle_probe,
+	read_only = true,
+})
+--[[ end section Probe Utilities ]]
+
+--[[ begin section Heartbeat Utilities ]]
+-- Heartbeats let the client measure round-trip time and notice a stalled emulator. They are
+-- answered with the current frame counter, e.g. "\x1042\x0c123456".
+local PK_HEARTBEAT_CTRL_CHAR = "\x0c"
+
+function PK_handle_heartbeat(req)
+	PK_reply(req, PK_HEARTBEAT_CTRL_CHAR, tostring(emu:currentFrame()))
+end
+
+PK_register_command(PK_HEARTBEAT_CTRL_CHAR, {
+	parse_text = function() end,
+	parse_binary = function() end,
+	handle = PK_handle_heartbeat,
+	read_only = true,
+})
+--[[ end section Heartbeat Utilities ]]
+
+--[[ begin section Speed Utilities ]]
+-- Every session is sent the frame counter about once per wall-clock second, as an untagged binary
+-- frame, so clients can work out how fast the emulator is running. Reports stop while the
+-- emulator is paused or frozen, since they are sent from the frame callback.
+local PK_FRAME_REPORT_CTRL_CHAR = "\x0f"
+PK_last_frame_report = nil
+
+function PK_report_frame()
+	local now = os.time()
+	if now == PK_last_frame_report then return end
+	PK_last_frame_report = now
+	local frame = tostring(emu:currentFrame())
+	for id in pairs(ST_sessions) do
+		PK_reply({ sock_id = id, binary = true }, PK_FRAME_REPORT_CTRL_CHAR, frame)
+	end
+end
+--[[ end section Speed Utilities ]]
+
+--[[ begin section Wait Utilities ]]
+-- A wait is answered once the emulator reaches a frame, with the frame counter at that point.
+-- "\x1042\x11+30" is answered 30 frames after it is received, "\x1042\x11123456" once frame
+-- 123456 is reached. Waits are checked on every frame and never change the emulator, so any
+-- session may send them. Waits without a request ID have nobody to answer and are ignored.
+local PK_WAIT_FRAME_CTRL_CHAR = "\x11"
+PK_waits = {}
+
+-- check returns the reply once the wait is over, and nothing until then
+function PK_add_wait(req, ctrl_char, check)
+	if not req.req_id then return end
+	local result = check()
+	if result then
+		PK_reply(req, ctrl_char, result)
+	else
+		table.insert(PK_waits, { req = req, ctrl_char = ctrl_char, check = check })
+	end
+end
+
+function PK_check_waits()
+	local i = 1
+	while i <= #PK_waits do
+		local wait = PK_waits[i]
+		-- false drops the wait of a session that has closed, nil keeps waiting
+		local result = ST_sessions[wait.req.sock_id] ~= nil and wait.check()
+		if result == nil then
+			i = i + 1
+		else
+			table.remove(PK_waits, i)
+			if result then
+				PK_reply(wait.req, wait.ctrl_char, result)
+			end
+		end
+	end
+end
+
+function PK_handle_wait_frame(req, frame, relative)
+	if not frame then
+		PK_reply(req, PK_WAIT_FRAME_CTRL_CHAR, "error invalid frame")
+		return
+	end
+	local target = relative and emu:currentFrame() + frame or frame
+	PK_add_wait(req, PK_WAIT_FRAME_CTRL_CHAR, function()
+		local current = emu:currentFrame()
+		if current >= target then
+			return tostring(current)
+		end
+	end)
+end
+
+PK_register_command(PK_WAIT_FRAME_CTRL_CHAR, {
+	parse_text = function(body)
+		if string.sub(body, 1, 1) == "+" then
+			return tonumber(string.sub(body, 2)), true
+		end
+		return tonumber(body), false
+	end,
+	parse_binary = function(payload)
+		local relative, frame = string.unpack("<BI4", payload)
+		return frame, relative == 1
+	end,
+	handle = PK_handle_wait_frame,
+	read_only = true,
+})
+--[[ end section Wait Utilities ]]
+
+--[[ begin section Condition Wait Utilities ]]
+-- Waits that are answered with the frame counter on the first frame a condition holds, so a
+-- script can wait exactly as long as the game needs instead of sleeping for a guess.
+-- Screen conditions compare a point's color or a rectangle's hash (see Probe Utilities), e.g.
+-- "\x1042\x12105,38=16766546;600" or "\x1042\x120,0,240,16!=2166136261;600". Memory conditions
+-- compare a 1, 2 or 4 byte little-endian value, optionally masked, e.g.
+-- "\x1042\x1333702276:1=5;600" or "\x1042\x1333702276:2&255!=0;600". "=" waits for the value to
+-- match and "!=" for it to differ. The number after ";" is how many frames to give up after
+-- (0 for never), answered with an error.
+-- Binary forms: (u8 equal, u32 frames, u32 value, u16 x, u16 y, u16 w, u16 h) with w = h = 0
+-- for a point, and (u8 equal, u32 frames, u32 value, u32 address, u8 size, u32 mask).
+local PK_WAIT_SCREEN_CTRL_CHAR = "\x12"
+local PK_WAIT_MEMORY_CTRL_CHAR = "\x13"
+local PK_MEMORY_READERS = {
+	[1] = function(address) return emu:read8(address) end,
+	[2] = function(address) return emu:read16(address) end,
+	[4] = function(address) return emu:read32(address) end,
+}
+
+-- Screen conditions share one screenshot per frame, however many are waiting
+local PK_frame_image = { frame = nil, img = nil }
+
+function PK_current_image()
+	local frame = emu:currentFrame()
+	if PK_frame_image.frame ~= frame then
+		PK_frame_image.frame = frame
+		PK_frame_image.img = emu:screenshotToImage()
+	end
+	return PK_frame_image.img
+end
+
+function PK_add_condition_wait(req, ctrl_char, condition, sample)
+	local deadline = condition.frames > 0 and emu:currentFrame() + condition.frames or nil
+	PK_add_wait(req, ctrl_char, function()
+		local current = emu:currentFrame()
+		if (sample() == condition.value) == condition.equal then
+			return tostring(current)
+		end
+		if deadline and current >= deadline then
+			return "error condition not met within " .. condition.frames .. " frames"
+		end
+	end)
+end
+
+-- The function giving the current value a parsed condition compares, nil if it is invalid
+function PK_condition_sampler(ctrl_char, condition)
+	if not condition then return nil end
+	if ctrl_char == PK_WAIT_SCREEN_CTRL_CHAR then
+		return function() return PK_probe_value(PK_current_image(), condition.region) end
+	end
+	local read = ctrl_char == PK_WAIT_MEMORY_CTRL_CHAR and PK_MEMORY_READERS[condition.size]
+	if not read then return nil end
+	return function() return read(condition.address) & condition.mask end
+end
+
+function PK_handle_wait_screen(req, condition)
+	local sample = PK_condition_sampler(PK_WAIT_SCREEN_CTRL_CHAR, condition)
+	if not sample then
+		PK_reply(req, PK_WAIT_SCREEN_CTRL_CHAR, "error invalid screen condition")
+		return
+	end
+	PK_add_condition_wait(req, PK_WAIT_SCREEN_CTRL_CHAR, condition, sample)
+end
+
+function PK_handle_wait_memory(req, condition)
+	local sample = PK_condition_sampler(PK_WAIT_MEMORY_CTRL_CHAR, condition)
+	if not sample then
+		PK_reply(req, PK_WAIT_MEMORY_CTRL_CHAR, "error invalid memory condition")
+		return
+	end
+	PK_add_condition_wait(req, PK_WAIT_MEMORY_CTRL_CHAR, condition, sample)
+end
+
+PK_register_command(PK_WAIT_SCREEN_CTRL_CHAR, {
+	parse_text = function(body)
+		local region_str, op, value, frames = string.match(body, "^([%d,]+)(!?=)(%d+);(%d+)$")
+		if not region_str then return nil end
+		local nums = {}
+		for n in string.gmatch(region_str, "%d+") do
+			table.insert(nums, tonumber(n))
+		end
+		if #nums ~= 2 and #nums ~= 4 then return nil end
+		return {
+			region = { x = nums[1], y = nums[2], w = nums[3], h = nums[4] },
+			value = tonumber(value), equal = op == "=", frames = tonumber(frames),
+		}
+	end,
+	parse_binary = function(payload)
+		local equal, frames, value, x, y, w, h = string.unpack("<BI4I4I2I2I2I2", payload)
+		if w == 0 and h == 0 then
+			w, h = nil, nil
+		end
+		return {
+			region = { x = x, y = y, w = w, h = h },
+			value = value, equal = equal == 1, frames = frames,
+		}
+	end,
+	handle = PK_handle_wait_screen,
+	read_only = true,
+})
+
+PK_register_command(PK_WAIT_MEMORY_CTRL_CHAR, {
+	parse_text = function(body)
+		local address, size, mask, op, value, frames = string.match(body, "^(%d+):(%d+)&?(%d*)(!?=)(%d+);(%d+)$")
+		if not address then return nil end
+		return {
+			address = tonumber(address), size = tonumber(size), mask = tonumber(mask) or 0xFFFFFFFF,
+			value = tonumber(value), equal = op == "=", frames = tonumber(frames),
+		}
+	end,
+	parse_binary = function(payload)
+		local equal, frames, value, address, size, mask = string.unpack("<BI4I4I4BI4", payload)
+		return {
+			address = address, size = size, mask = mask,
+			value = value, equal = equal == 1, frames = frames,
+		}
+	end,
+	handle = PK_handle_wait_memory,
+	read_only = true,
+})
+--[[ end section Condition Wait Utilities ]]
+
+--[[ begin section Conditional Program Utilities ]]
+-- An input program that stops as soon as any of its conditions holds, answered with the frame
+-- counter on the frame one first did, e.g. pacing left and right for at most so many steps until
+-- an egg hatches, without a round trip per step. Conditions are written as condition waits are
+-- (see Condition Wait Utilities), control character included, and are separated from each other
+-- and from the program's steps by "|": "\x1042\x15\x1333702419:1&4=0|32:80,16:80". Their frame
+-- limits are ignored, the program gives up with an error if it plays to the end instead. It
+-- replaces any running program, as programs do, and its keys are released when it stops.
+-- Binary form: u8 condition count, then each condition's u8 opcode, u16 length and payload,
+-- then the program's step records.
+local PK_PROGRAM_UNTIL_CTRL_CHAR = "\x15"
+
+-- nil for anything but a valid screen or memory condition
+function PK_parse_until_condition(ctrl_char, body, binary)
+	if ctrl_char ~= PK_WAIT_SCREEN_CTRL_CHAR and ctrl_char ~= PK_WAIT_MEMORY_CTRL_CHAR then
+		return nil
+	end
+	local command = PK_commands[ctrl_char]
+	local condition
+	if binary then
+		condition = command.parse_binary(body)
+	else
+		condition = command.parse_text(body)
+	end
+	return condition and { ctrl_char = ctrl_char, condition = condition }
+end
+
+function PK_handle_program_until(req, conditions, steps)
+	local samplers = {}
+	for i, parsed in ipairs(conditions) do
+		samplers[i] = parsed and PK_condition_sampler(parsed.ctrl_char, parsed.condition)
+		if not samplers[i] then
+			PK_reply(req, PK_PROGRAM_UNTIL_CTRL_CHAR, "error invalid condition " .. i)
+			return
+		end
+	end
+	if #samplers == 0 then
+		PK_reply(req, PK_PROGRAM_UNTIL_CTRL_CHAR, "error no condition")
+		return
+	end
+
+	PK_start_program(req, PK_PROGRAM_UNTIL_CTRL_CHAR, steps, function()
+		for i, sample in ipairs(samplers) do
+			local condition = conditions[i].condition
+			if (sample() == condition.value) == condition.equal then
+				return tostring(emu:currentFrame())
+			end
+		end
+	end, "error program ended before any condition was met")
+end
+
+PK_register_command(PK_PROGRAM_UNTIL_CTRL_CHAR, {
+	parse_text = function(body)
+		local parts = {}
+		for part in string.gmatch(body .. "|", "([^|]*)|") do
+			table.insert(parts, part)
+		end
+		local conditions = {}
+		for i = 1, #parts - 1 do
+			local part = parts[i]
+			conditions[i] = PK_parse_until_condition(string.sub(part, 1, 1), string.sub(part, 2), false) or false
+		end
+		return conditions, PK_commands[PK_PROGRAM_CTRL_CHAR].parse_text(parts[#parts] or "")
+	end,
+	parse_binary = function(payload)
+		local count, pos = string.unpack("<B", payload)
+		local conditions = {}
+		for i = 1, count do
+			local opcode, length
+			opcode, length, pos = string.unpack("<BI2", payload, pos)
+			local condition = string.sub(payload, pos, pos + length - 1)
+			conditions[i] = PK_parse_until_condition(string.char(opcode), condition, true) or false
+			pos = pos + length
+		end
+		return conditions, PK_commands[PK_PROGRAM_CTRL_CHAR].parse_binary(string.sub(payload, pos))
+	end,
+	handle = PK_handle_program_until,
+})
+--[[ end section Conditional Program Utilities ]]
+
+--[[ begin section Recording Utilities ]]
+-- Records the keys held on every frame, e.g. while someone plays, as "bitmask:frames" runs: the
+-- steps of an input program, so a recording can be played back as one. "\x1042\x14start" starts
+-- recording for the session, which is then sent the runs finished so far every 60 emulated frames
+-- (so often at fast-forward, and never while paused), as untagged binary frames.
+-- "\x1042\x14stop" stops it and is answered with the rest, "" if none.
+-- One session records at a time, and a recording is dropped when its session closes.
+-- Recording never changes the emulator, so any session may do it.
+local PK_RECORD_CTRL_CHAR = "\x14"
+local PK_RECORD_FLUSH_FRAMES = 60
+PK_recording = nil
+
+function PK_format_runs(runs)
+	local parts = {}
+	for i, run in ipairs(runs) do
+		parts[i] = run.bitmask .. ":" .. run.frames
+	end
+	return table.concat(parts, ",")
+end
+
+function PK_record_frame()
+	local recording = PK_recording
+	if not recording then return end
+	if not ST_sessions[recording.sock_id] then
+		PK_recording = nil
+		console:log("Recording dropped, its session closed")
+		return
+	end
+
+	local keys = emu:getKeys()
+	local run = recording.current
+	if run and run.bitmask == keys then
+		run.frames = run.frames + 1
+	else
+		if run then table.insert(recording.runs, run) end
+		recording.current = { bitmask = keys, frames = 1 }
+	end
+
+	recording.unsent_frames = recording.unsent_frames + 1
+	if recording.unsent_frames >= PK_RECORD_FLUSH_FRAMES and #recording.runs > 0 then
+		PK_reply({ sock_id = recording.sock_id, binary = true }, PK_RECORD_CTRL_CHAR, PK_format_runs(recording.runs))
+		recording.runs = {}
+		recording.unsent_frames = 0
+	end
+end
+
+function PK_handle_record(req, action)
+	if action == "start" then
+		if PK_recording then
+			PK_reply(req, PK_RECORD_CTRL_CHAR, "error already recording")
+			return
+		end
+		PK_recording = { sock_id = req.sock_id, runs = {}, current = nil, unsent_frames = 0 }
+		console:log("Recording keys for socket " .. req.sock_id)
+		PK_ack(req, PK_RECORD_CTRL_CHAR)
+	elseif action == "stop" then
+		local recording = PK_recording
+		if not recording or recording.sock_id ~= req.sock_id then
+			PK_reply(req, PK_RECORD_CTRL_CHAR, "error not recording")
+			return
+		end
+		PK_recording = nil
+		if recording.current then table.insert(recording.runs, recording.current) end
+		console:log("Stopped recording keys for socket " .. req.sock_id)
+		PK_reply(req, PK_RECORD_CTRL_CHAR, PK_format_runs(recording.runs))
+	else
+		PK_reply(req, PK_RECORD_CTRL_CHAR, "error unknown action " .. action)
+	end
+end
+
+PK_register_command(PK_RECORD_CTRL_CHAR, {
+	parse_text = function(body) return body end,
+	parse_binary = function(payload) return payload end,
+	handle = PK_handle_record,
+	read_only = true,
+})
+--[[ end section Recording Utilities ]]
+
+--[[ begin section Identity Utilities ]]
+-- The identity lets a client check which emulator it reached. It is a JSON object with the
+-- instance_id given by the launcher in PKBT_INSTANCE_ID, the emulator's pid (where /proc exists),
+-- rom_title, game_code and the port the server is listening on, as recorded in the instance
+-- registry (see state_manager.lua). It is pushed to every new session as an untagged binary frame,
+-- and can be requested again with "\x0e".
+local PK_IDENTIFY_CTRL_CHAR = "\x0e"
+
+-- The ROM is only known once a game is loaded, which may be after this script starts
+function PK_describe_instance()
+	if emu and not instance.rom_title then
+		instance.rom_title = emu:getGameTitle()
+		instance.game_code = emu:getGameCode()
+	end
+end
+
+function PK_identity()
+	PK_describe_instance()
+	local identity = {
+		instance_id = instance.instance_id,
+		pid = instance.pid,
+		rom_title = instance.rom_title,
+		game_code = instance.game_code,
+		port = instance.port,
+	}
+	-- Replies are single lines in the text framing
+	return (string.gsub(json.encode(identity), "\n%s*", ""))
+end
+
+function PK_handle_identify(req)
+	PK_reply(req, PK_IDENTIFY_CTRL_CHAR, PK_identity())
+end
+
+function PK_greet(sock_id)
+	PK_reply({ sock_id = sock_id, binary = true }, PK_IDENTIFY_CTRL_CHAR, PK_identity())
+end
+
+PK_register_command(PK_IDENTIFY_CTRL_CHAR, {
+	parse_text = function() end,
+	parse_binary = function() end,
+	handle = PK_handle_identify,
+	read_only = true,
+})
+--[[ end section Identity Utilities ]]
+
+--[[ begin section Session Utilities ]]
+-- A session has no role until it either asks for one, e.g. "\x0btelemetry", which is answered
+-- with "ok" or with an error if another session already has control, or sends a command that
+-- changes the emulator, which takes control if it is free. Connections that only look (discovery
+-- scans, monitors) therefore never hold control that the driving client is about to need.
+local PK_ROLE_CTRL_CHAR = "\x0b"
+PK_ROLE_CONTROL = "control"
+PK_ROLE_TELEMETRY = "telemetry"
+PK_control_session = nil
+
+function PK_assign_role(session, role)
+	if role == PK_ROLE_CONTROL then
+		if PK_control_session and PK_control_session ~= session.id then
+			return false
+		end
+		PK_control_session = session.id
+	elseif PK_control_session == session.id then
+		PK_control_session = nil
+	end
+	session.role = role
+	return true
+end
+
+function PK_handle_role(req, role)
+	local session = ST_sessions[req.sock_id]
+	if role ~= PK_ROLE_CONTROL and role ~= PK_ROLE_TELEMETRY then
+		PK_reply(req, PK_ROLE_CTRL_CHAR, "error unknown role " .. role)
+	elseif not PK_assign_role(session, role) then
+		PK_reply(req, PK_ROLE_CTRL_CHAR, "error another session has control")
+	else
+		console:log(ST_format(session.id, "Role set to " .. role))
+		PK_reply(req, PK_ROLE_CTRL_CHAR, "ok")
+	end
+end
+
+PK_register_command(PK_ROLE_CTRL_CHAR, {
+	parse_text = function(body) return body end,
+	parse_binary = function(payload) return payload end,
+	handle = PK_handle_role,
+	read_only = true,
+})
+--[[ end section Session Utilities ]]
+
+--[[ begin section Command Dispatch ]]
+-- Unknown commands (such as the "ping" keepalive sent by older clients) are ignored.
+-- Telemetry sessions are refused anything that would change the emulator's state. A session
+-- without a role takes control with its first such command, if no other session has it.
+function PK_run_command(req, command, ...)
+	local session = ST_sessions[req.sock_id]
+	if not command.read_only and session.role == nil then
+		PK_assign_role(session, PK_ROLE_CONTROL)
+	end
+	if not command.read_only and session.role ~= PK_ROLE_CONTROL then
+		if req.req_id then
+			PK_reply(req, req.ctrl_char, "error read-only session")
+		end
+		return
+	end
+	command.handle(req, ...)
+end
+
+function PK_dispatch_line(sock_id, raw_line)
+	local req, line = PK_parse_request(sock_id, raw_line)
+	req.ctrl_char = string.sub(line, 1, 1)
+	local command = PK_commands[req.ctrl_char]
+	if command then
+		PK_run_command(req, command, command.parse_text(string.sub(line, 2)))
+	end
+end
+
+function PK_dispatch_frame(sock_id, frame)
+	-- Request ID 0 means no reply is expected
+	local req_id = frame.req_id ~= 0 and frame.req_id or nil
+	local req = { sock_id = sock_id, req_id = req_id, binary = true, ctrl_char = string.char(frame.opcode) }
+	local command = PK_commands[req.ctrl_char]
+	if command then
+		PK_run_command(req, command, command.parse_binary(frame.payload))
+	end
+end
+
+function PK_dispatch(sock_id, message)
+	if message.line then
+		PK_dispatch_line(sock_id, message.line)
+	else
+		PK_dispatch_frame(sock_id, message)
+	end
+end
+--[[ end section Command Dispatch ]]
+
+--[[ begin section Frame Callback ]]
+function PK_on_frame()
+	-- Before the program sets the keys for the next frame, to record those the last one ran with
+	PK_record_frame()
+	PK_step_program()
+	PK_check_waits()
+	PK_report_frame()
+	ST_flush_all()
+	PK_describe_instance()
+	state_manager.heartbeat(instance)
+end
+callbacks:add("frame", PK_on_frame)
+callbacks:add("shutdown", function() state_manager.unregister(instance) end)
+--[[ end section Frame Callback ]]
+
 --[[ begin section Repurposed mGBA Example Scripts Code ]]
 server = nil
-ST_sockets = {}
+ST_sessions = {}
 nextID = 1
 
+-- Replies waiting in a session's outbox beyond this many bytes are reported once, since they
+-- mean the client is not keeping up. Nothing is ever dropped.
+local ST_BACKLOG_WARNING_BYTES = 4 * 1024 * 1024
+
 function ST_stop(id)
-	local sock = ST_sockets[id]
-	ST_sockets[id] = nil
-	sock:close()
+	local session = ST_sessions[id]
+	if not session then return end
+	ST_sessions[id] = nil
+	if PK_control_session == id then
+		PK_control_session = nil
+	end
+	session.sock:close()
 end
 
 function ST_format(id, msg, isError)
@@ -87,35 +987,65 @@ function ST_format(id, msg, isError)
 end
 
 function ST_error(id, err)
-	console:error(ST_format(id, err, true))
+	console:error(ST_format(id, err or "socket error", true))
 	ST_stop(id)
 end
 
-local _buf = ""  -- single-socket buffer
+-- Send as much of a session's outbox as the socket takes without blocking, keeping the rest
+-- (including the unsent part of a partial write) for the next flush
+function ST_flush(session)
+	while session.outbox_head <= session.outbox_tail do
+		local data = session.outbox[session.outbox_head]
+		local sent, err = session.sock:send(data)
+		if not sent then
+			if err ~= socket.ERRORS.AGAIN then
+				ST_error(session.id, err)
+			end
+			return
+		end
+		session.outbox_bytes = session.outbox_bytes - sent
+		if sent < #data then
+			session.outbox[session.outbox_head] = string.sub(data, sent + 1)
+			return
+		end
+		session.outbox[session.outbox_head] = nil
+		session.outbox_head = session.outbox_head + 1
+	end
+	session.backlog_warned = false
+end
+
+function ST_flush_all()
+	for _, session in pairs(ST_sessions) do
+		ST_flush(session)
+	end
+end
+
+function ST_queue(session, data)
+	session.outbox_tail = session.outbox_tail + 1
+	session.outbox[session.outbox_tail] = data
+	session.outbox_bytes = session.outbox_bytes + #data
+	ST_flush(session)
+	if session.outbox_bytes > ST_BACKLOG_WARNING_BYTES and not session.backlog_warned then
+		session.backlog_warned = true
+		console:warn(ST_format(session.id, session.outbox_bytes .. " bytes waiting to be sent", true))
+	end
+end
+
 function ST_received(id)
-    local sock = ST_sockets[id]
-    if not sock then return end
+    local session = ST_sessions[id]
+    if not session then return end
 
     while true do
-        local chunk, err = sock:receive(1024)
+        local chunk, err = session.sock:receive(4096)
         if not chunk then
             if err == socket.ERRORS.AGAIN then return end
             console:error(ST_format(id, err, true)); ST_stop(id); return
         end
 
-        _buf = _buf .. chunk
-        while true do
-            local line, rest = _buf:match("^(.-)\r?\n(.*)$")  -- CRLF or LF
-            if not line then break end
-            _buf = rest
-
-            if PK_is_valid_key_state_bitmask_str(line) then
-                PK_handle_key_state_bitmask(line)
-            elseif PK_is_reset_cmd(line) then
-                PK_handle_reset()
-            elseif PK_is_screenshot_cmd(line) then
-                PK_handle_screenshot(line)
-            end
+        for _, message in ipairs(wire_protocol.feed(session.decoder, chunk)) do
+            PK_dispatch(id, message)
+            -- The session may have been closed while handling the message
+            if not ST_sessions[id] then return end
         end
     end
 end
@@ -128,10 +1058,20 @@ function ST_accept()
 	end
 	local id = nextID
 	nextID = id + 1
-	ST_sockets[id] = sock
+	local session = {
+		id = id,
+		sock = sock,
+		decoder = wire_protocol.new_decoder(),
+		outbox = {},
+		outbox_head = 1,
+		outbox_tail = 0,
+		outbox_bytes = 0,
+	}
+	ST_sessions[id] = session
 	sock:add("received", function() ST_received(id) end)
 	sock:add("error", function() ST_error(id) end)
 	console:log(ST_format(id, "Connected"))
+	PK_greet(id)
 end
 
 --[[ begin Main loop ]]
@@ -153,10 +1093,13 @@ while not server do
 			server:close()
 			console:error(ST_format("Listen", err, true))
 		else
+			instance.port = port
+			PK_describe_instance()
+			state_manager.register(instance)
 			console:log("Socket Server Test: Listening on port " .. port)
 			server:add("received", ST_accept)
 		end
 	end
 end
 --[[ end Main loop ]]
---[[ end section Repurposed mGBA Example Scripts Code ]]
\ No newline at end of file
+--[[ end section Repurposed mGBA Example Scripts Code ]]
@@ -1,138 +1,100 @@
 --[[
-    Maintains things like the ports and times created of the running instances, so the client
+    Maintains the registry of running instances (ID, PID, port, ROM and heartbeat), so the client
     knows where to connect to them.
+
+    Every instance has its own entry file in temp/instances, named after its instance ID, and is
+    the only one ever writing it. Entries are written to a temporary file and renamed into place,
+    so readers never see half an entry, and instances starting at the same time never have to
+    read-modify-write a shared file. Ports are not handed out here: the server binds the first free
+    port from STARTING_PORT on, and binding is what makes a port one instance's alone.
+
+    Entries are refreshed every HEARTBEAT_INTERVAL seconds. The Python side (pkbt/state_manager.py)
+    removes entries whose heartbeat has stopped.
 ]]
 
 local json = require("json_utils")
 local log_manager = require("log_manager")
 local lm = log_manager.create_logger("STATE_MGR")
 
-local FILE_PATH = "temp/pkbt_app_state.json"
+local REGISTRY_DIR = "temp/instances"
 local STARTING_PORT = 8888
+local HEARTBEAT_INTERVAL = 5
 
 local state_manager = {}
 
--- Create a new instance with dynamically chosen port
-function state_manager.create_instance()
-    lm.log("Creating new instance", "STATE_MGR")
-    
-    -- Try to read existing file
-    local file = io.open(FILE_PATH, "r")
-    local content = ""
-    if file then
-        lm.log("Found existing file, reading content", "STATE_MGR")
-        content = file:read("*a")
-        file:close()
-    else
-        lm.log("No existing file found, starting with empty array", "STATE_MGR")
-        content = "[]"
-    end
-
-    -- Parse JSON
-    local state = json.decode(content)
-    if type(state) ~= "table" then
-        lm.error("Invalid JSON content", "STATE_MGR")
-        return nil
-    end
+-- Only available where /proc exists; elsewhere the launcher knows the PID of what it started
+local function read_pid()
+    local file = io.open("/proc/self/stat", "r")
+    if not file then return nil end
+    local pid = tonumber(string.match(file:read("*l") or "", "^(%d+)"))
+    file:close()
+    return pid
+end
 
-    -- Find the highest port number from existing instances
-    local highest_port = STARTING_PORT - 1
-    for _, instance in ipairs(state) do
-        if instance.port and instance.port > highest_port then
-            highest_port = instance.port
-        end
-    end
-    
-    -- Choose next port
-    local new_port = highest_port + 1
-    lm.log("Chose port: " .. new_port, "STATE_MGR")
-    
-    -- Create new instance object
-    local new_instance = {
-        port = new_port,
-        timestamp = os.time()
-    }
-    
-    -- Add to state
-    table.insert(state, new_instance)
-    lm.log("Added new instance, total items: " .. #state, "STATE_MGR")
+local function entry_path(instance)
+    return REGISTRY_DIR .. "/" .. instance.instance_id .. ".json"
+end
 
-    -- Write back to file
-    file = io.open(FILE_PATH, "w")
+local function write_entry(instance)
+    local path = entry_path(instance)
+    local tmp_path = path .. ".tmp"
+    local file = io.open(tmp_path, "w")
     if not file then
-        lm.error("Could not write to " .. FILE_PATH, "STATE_MGR")
-        return nil
+        lm.error("Could not write to " .. tmp_path, "STATE_MGR")
+        return false
     end
-    file:write(json.encode(state))
+    file:write(json.encode(instance))
     file:close()
-    lm.log("Successfully wrote state to " .. FILE_PATH, "STATE_MGR")
-    
-    return new_instance
-end
 
--- Avoid calling this function directly. Instead, use state_manager.create_instance()
--- to create a new instance with a dynamically chosen port.
-function state_manager.add_instance(new_obj)
-    lm.log("Attempting to read/write: " .. FILE_PATH, "STATE_MGR")
-    
-    -- Try to read existing file
-    local file = io.open(FILE_PATH, "r")
-    local content = ""
-    if file then
-        lm.log("Found existing file, reading content", "STATE_MGR")
-        content = file:read("*a")
-        file:close()
-    else
-        lm.log("No existing file found, starting with empty array", "STATE_MGR")
-        content = "[]"
+    -- Renaming over the old entry is atomic on POSIX, but Windows refuses to replace a file
+    local ok, err = os.rename(tmp_path, path)
+    if not ok then
+        os.remove(path)
+        ok, err = os.rename(tmp_path, path)
     end
-
-    -- Parse JSON
-    local state = json.decode(content)
-    if type(state) ~= "table" then
-        lm.error("Invalid JSON content", "STATE_MGR")
-        return
+    if not ok then
+        lm.error("Could not move " .. tmp_path .. " into place: " .. tostring(err), "STATE_MGR")
+        os.remove(tmp_path)
+        return false
     end
+    return true
+end
 
-    -- Add the new object
-    table.insert(state, new_obj)
-    lm.log("Added object to state, total items: " .. #state, "STATE_MGR")
+-- Create a new instance. Its ID is the one the launcher passed in PKBT_INSTANCE_ID, if any, and its
+-- port is only where the server starts looking for a free one.
+function state_manager.create_instance()
+    local instance = {
+        instance_id = os.getenv("PKBT_INSTANCE_ID") or string.format("%d-%06d", os.time(), math.random(0, 999999)),
+        pid = read_pid(),
+        port = STARTING_PORT,
+        started = os.time(),
+    }
+    lm.log("Created instance " .. instance.instance_id, "STATE_MGR")
+    return instance
+end
 
-    -- Write back to file
-    file = io.open(FILE_PATH, "w")
-    if not file then
-        lm.error("Could not write to " .. FILE_PATH, "STATE_MGR")
-        return
+-- Add the instance to the registry, once it has bound its port
+function state_manager.register(instance)
+    instance.heartbeat = os.time()
+    if write_entry(instance) then
+        lm.log("Registered instance " .. instance.instance_id .. " on port " .. instance.port, "STATE_MGR")
     end
-    file:write(json.encode(state))
-    file:close()
-    lm.log("Successfully wrote state to " .. FILE_PATH, "STATE_MGR")
 end
 
--- Initialize the state file with an empty array
-function state_manager.initialize_state()
-    -- Check if file exists
-    local file = io.open(FILE_PATH, "r")
-    if file then
-        lm.log("State file exists, clearing it", "STATE_MGR")
-        file:close()
-    else
-        lm.log("State file does not exist, creating it", "STATE_MGR")
-    end
-    
-    -- Create empty array
-    local empty_state = {}
-    
-    -- Write empty array to file
-    file = io.open(FILE_PATH, "w")
-    if not file then
-        lm.error("Could not write to " .. FILE_PATH, "STATE_MGR")
-        return false
+-- Refresh the instance's entry if it is due. Cheap enough to call every frame.
+function state_manager.heartbeat(instance)
+    if not instance.heartbeat or os.time() - instance.heartbeat < HEARTBEAT_INTERVAL then
+        return
     end
-    file:write(json.encode(empty_state))
-    file:close()
-    lm.log("Successfully initialized state file with empty array", "STATE_MGR")
-    return true
+    instance.heartbeat = os.time()
+    write_entry(instance)
+end
+
+-- Remove the instance from the registry
+function state_manager.unregister(instance)
+    os.remove(entry_path(instance))
+    instance.heartbeat = nil
+    lm.log("Unregistered instance " .. instance.instance_id, "STATE_MGR")
 end
 
-return state_manager
\ No newline at end of file
+return state_manager
@@ -0,0 +1,95 @@
+--[[
+    Framing for messages received from the client. Two formats can be mixed on one connection:
+
+    - Text lines: a control character, the command and a newline (the original protocol).
+    - Binary frames: a fixed 12-byte little-endian header (magic 0xFE, version, opcode, flags,
+      request ID, payload length) followed by the payload. The opcode is the byte value of the
+      equivalent text control character.
+
+    Received chunks are queued and only joined once enough bytes have arrived to finish the
+    pending message, so large payloads are not rebuilt on every receive.
+]]
+
+local log_manager = require("log_manager")
+local lm = log_manager.create_logger("WIRE")
+
+local wire_protocol = {}
+
+wire_protocol.MAGIC = 0xFE
+wire_protocol.VERSION = 1
+wire_protocol.HEADER_FORMAT = "<BBBBI4I4"
+wire_protocol.HEADER_SIZE = 12
+
+-- Encode a binary frame
+function wire_protocol.encode_frame(opcode, req_id, payload)
+    return string.pack(wire_protocol.HEADER_FORMAT, wire_protocol.MAGIC, wire_protocol.VERSION,
+        opcode, 0, req_id or 0, #payload) .. payload
+end
+
+-- Create the parsing state for one connection
+function wire_protocol.new_decoder()
+    return { chunks = {}, size = 0, need = 1 }
+end
+
+-- Parse as many complete messages as possible from buf, starting at pos.
+-- Returns the messages, the position of the first unparsed byte and the buffer size needed
+-- before parsing can make progress again.
+local function parse(buf, pos, messages)
+    local header_size = wire_protocol.HEADER_SIZE
+    while pos <= #buf do
+        if string.byte(buf, pos) == wire_protocol.MAGIC then
+            if #buf - pos + 1 < header_size then
+                return pos, header_size
+            end
+            local _, version, opcode, _, req_id, length = string.unpack(wire_protocol.HEADER_FORMAT, buf, pos)
+            if #buf - pos + 1 < header_size + length then
+                return pos, header_size + length
+            end
+            local payload_start = pos + header_size
+            if version == wire_protocol.VERSION then
+                table.insert(messages, {
+                    opcode = opcode,
+                    req_id = req_id,
+                    payload = string.sub(buf, payload_start, payload_start + length - 1),
+                })
+            else
+                lm.warn("Ignoring frame with unsupported version " .. version)
+            end
+            pos = payload_start + length
+        else
+            local newline = string.find(buf, "\n", pos, true)
+            if not newline then
+                -- Any new data could complete the line
+                return pos, #buf - pos + 2
+            end
+            local line_end = newline - 1
+            if line_end >= pos and string.byte(buf, line_end) == 13 then  -- CRLF
+                line_end = line_end - 1
+            end
+            table.insert(messages, { line = string.sub(buf, pos, line_end) })
+            pos = newline + 1
+        end
+    end
+    return pos, 1
+end
+
+-- Add a received chunk, returning the list of messages it completed: { line = "..." } for
+-- text lines and { opcode = n, req_id = n, payload = "..." } for binary frames.
+function wire_protocol.feed(decoder, chunk)
+    table.insert(decoder.chunks, chunk)
+    decoder.size = decoder.size + #chunk
+    if decoder.size < decoder.need then
+        return {}
+    end
+
+    local buf = table.concat(decoder.chunks)
+    local messages = {}
+    local pos, need = parse(buf, 1, messages)
+    local rest = string.sub(buf, pos)
+    decoder.chunks = { rest }
+    decoder.size = #rest
+    decoder.need = need
+    return messages
+end
+
+return wire_protocol
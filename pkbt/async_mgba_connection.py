@@ -0,0 +1,564 @@
+import asyncio
+import inspect
+import itertools
+import contextvars
+from contextlib import asynccontextmanager
+from typing import Optional, Callable
+import numpy as np
+from pkbt.input.key_event import KeyEvent
+from pkbt.input.key_event_type import KeyEventType
+from pkbt.input.key_state import KeyState
+from pkbt.input.input_program import InputProgram, GBA_FRAMES_PER_SECOND
+from pkbt.mgba_connection import InboundStats, HeartbeatStats
+from pkbt.emulation_speed import SpeedMeter, SpeedStats
+from pkbt.image_processing import hex_color
+from pkbt.config import (
+    HEARTBEAT_INTERVAL, HEARTBEAT_DEADLINE, RECONNECT_INITIAL_DELAY, RECONNECT_MAX_DELAY,
+    RECONNECT_MAX_ATTEMPTS,
+)
+from pkbt.protocol import (
+    IDENTIFY_CTRL_CHAR, FRAME_REPORT_CTRL_CHAR, RECORD_CTRL_CHAR, CONDITION_WAIT_FRAMES, BINARY_PROTOCOL, CONTROL_ROLE, Command, ReplyDecoder, InstanceIdentity,
+    validate_protocol, encode_message, encode_key_state, encode_program, encode_reset,
+    encode_screenshot, encode_save_state, encode_load_state, encode_read_memory, encode_grab_frame,
+    encode_probe, encode_role, encode_heartbeat, encode_identify, encode_wait_frame,
+    encode_wait_screen, encode_wait_memory, encode_record, encode_program_until, parse_ack, parse_state_reply,
+    parse_role_reply, parse_identity_reply, parse_frame_report, parse_wait_frame_reply, parse_recorded_steps, parse_read_memory_reply, parse_frame_reply,
+    parse_probe_reply, parse_heartbeat_reply,
+)
+
+class AsyncMGBAConnection:
+    """asyncio counterpart of MGBAConnection
+
+    Reading and heartbeats run as tasks on the event loop instead of threads, so any number of
+    connections can share a single loop, and waits are awaited rather than slept.
+    """
+
+    def __init__(self, host="localhost", port=8888, protocol: str = BINARY_PROTOCOL,
+                 inbound_queue_size: int = 1024, auto_reconnect: bool = True) -> None:
+        """protocol selects the framing commands are sent in: "binary", or "text" as a fallback
+
+        Messages that don't answer a request wait in a queue of up to inbound_queue_size messages
+        for a dispatch task, which passes them to the message callback (awaiting it if it is a
+        coroutine function). When the callback falls behind, the oldest messages are dropped.
+
+        Heartbeats and reconnects work as in MGBAConnection.
+        """
+        validate_protocol(protocol)
+        self._host: str = host
+        self._port: int = port
+        self._protocol: str = protocol
+        self._auto_reconnect: bool = auto_reconnect
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connected: bool = False
+        self._on_message: Optional[Callable] = None
+        self._key_state: KeyState = KeyState()
+        self._role: Optional[str] = None
+        self._identity: Optional[InstanceIdentity] = None
+        self._decoder: ReplyDecoder = ReplyDecoder()
+        self._listen_task: Optional[asyncio.Task] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._reconnect_task: Optional[asyncio.Task] = None
+        self._request_ids = itertools.count(1)
+        self._pending: dict[int, asyncio.Future] = {}
+        # Each task batches on its own, so a heartbeat never lands in (or flushes) a caller's batch
+        self._batch: contextvars.ContextVar = contextvars.ContextVar(f"batch_{id(self)}", default=None)  # (task, messages)
+        self._inbound: asyncio.Queue = asyncio.Queue(maxsize=inbound_queue_size)
+        self._dispatch_task: Optional[asyncio.Task] = None
+        self._received: int = 0
+        self._dropped: int = 0
+        self._closing: bool = False
+        self._heartbeats_sent: int = 0
+        self._heartbeats_missed: int = 0
+        self._rtts: list[float] = []
+        self._last_frame: Optional[int] = None
+        self._recorded: Optional[list[tuple[int, int]]] = None  # while recording
+        self._reconnects: int = 0
+        self._speed: SpeedMeter = SpeedMeter()
+
+    @property
+    def port(self) -> int:
+        """Get the port number (read-only)"""
+        return self._port
+
+    @property
+    def connected(self) -> bool:
+        """Check if the client is connected (read-only)"""
+        return self._connected
+
+    @property
+    def reconnecting(self) -> bool:
+        """Check if the connection was lost and is being reopened (read-only)"""
+        return self._reconnect_task is not None and not self._reconnect_task.done()
+
+    @property
+    def identity(self) -> Optional[InstanceIdentity]:
+        """Get the identity the server announced, once it has been received (read-only)"""
+        return self._identity
+
+    @property
+    def protocol(self) -> str:
+        """Get the framing commands are sent in (read-only)"""
+        return self._protocol
+
+    async def connect(self, timeout: float = 5.0, on_message: Optional[Callable] = None) -> bool:
+        """Connect to the mGBA server and start the background read, heartbeat and dispatch tasks"""
+        self._closing = False
+        if not await self._open(timeout):
+            return False
+
+        self._on_message = on_message
+        self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+        self._dispatch_task = asyncio.create_task(self._dispatch_loop())
+        print(f"Connected to mGBA on {self._host}:{self._port}")
+        return True
+
+    async def _open(self, timeout: float = 5.0) -> bool:
+        """Open new streams and start reading from them"""
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self._host, self._port), timeout)
+        except Exception as e:
+            print(f"Connection failed: {e}")
+            return False
+
+        self._connected = True
+        self._decoder.reset()
+        self._listen_task = asyncio.create_task(self._listen_loop(self._reader))
+        return True
+
+    async def _close_streams(self):
+        self._connected = False
+        if self._listen_task and not self._listen_task.done() and self._listen_task is not asyncio.current_task():
+            self._listen_task.cancel()
+        writer, self._writer = self._writer, None
+        if writer:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def disconnect(self):
+        """Disconnect from mGBA"""
+        self._closing = True
+        for task in (self._heartbeat_task, self._reconnect_task, self._dispatch_task):
+            if task and not task.done() and task is not asyncio.current_task():
+                task.cancel()
+        await self._close_streams()
+        self._fail_pending()
+        print(f"Disconnected from MGBA on {self._host}:{self._port}")
+
+    def _connection_lost(self, reason: str):
+        """Mark the connection as lost and, with auto_reconnect, start reopening it"""
+        if self._closing or self.reconnecting or not self._connected:
+            return
+        self._connected = False
+        print(f"Lost connection to mGBA on port {self._port}: {reason}")
+        self._fail_pending()
+        if self._auto_reconnect:
+            self._reconnect_task = asyncio.create_task(self._reconnect_loop())
+
+    def _fail_pending(self):
+        """Wake up every request waiting for a reply that will never come"""
+        for waiting in self._pending.values():
+            if not waiting.done():
+                waiting.set_result(None)
+
+    async def _reconnect_loop(self):
+        """Background task reopening a lost connection with exponential backoff"""
+        delay = RECONNECT_INITIAL_DELAY
+        for attempt in range(1, RECONNECT_MAX_ATTEMPTS + 1):
+            await self._close_streams()
+            if await self._open() and await self._restore_session():
+                self._reconnects += 1
+                print(f"Reconnected to mGBA on port {self._port} after {attempt} attempt(s)")
+                return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        print(f"Giving up reconnecting to mGBA on port {self._port} after {RECONNECT_MAX_ATTEMPTS} attempts")
+        await self._close_streams()
+
+    async def _restore_session(self) -> bool:
+        """Take back this connection's role and the keys it was holding (see MGBAConnection._restore_session)"""
+        if self._identity is not None:
+            identity = await self.identify(timeout=HEARTBEAT_DEADLINE)
+            if identity is None:
+                return False
+            if identity.instance_id != self._identity.instance_id:
+                print(f"Port {self._port} now belongs to instance {identity.instance_id}, "
+                      f"not {self._identity.instance_id}")
+                return False
+        if not await self.set_role(self._role or CONTROL_ROLE, timeout=HEARTBEAT_DEADLINE):
+            return False
+        command = encode_key_state(self._key_state.bitmask())
+        return parse_ack(await self._request(command, timeout=HEARTBEAT_DEADLINE))
+
+    async def ping(self) -> Optional[float]:
+        """Send a heartbeat, returning its round-trip time in seconds (None if it got no reply)"""
+        self._heartbeats_sent += 1
+        loop = asyncio.get_running_loop()
+        sent_at = loop.time()
+        frame = parse_heartbeat_reply(await self._request(encode_heartbeat(), timeout=HEARTBEAT_DEADLINE))
+        if frame is None:
+            self._heartbeats_missed += 1
+            return None
+        self._rtts.append(loop.time() - sent_at)
+        del self._rtts[:-1000]  # Only the most recent heartbeats count
+        self._last_frame = frame
+        self._speed.record(frame, heartbeat=True)
+        return self._rtts[-1]
+
+    async def _heartbeat_loop(self):
+        """Background task sending periodic heartbeats and detecting a dead or stalled server"""
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            if not self._connected:
+                continue
+            if await self.ping() is None and self._connected:
+                self._connection_lost(f"no heartbeat reply within {HEARTBEAT_DEADLINE}s")
+
+    def heartbeat_stats(self) -> HeartbeatStats:
+        """Get the heartbeat round-trip times measured so far, and the number of reconnects"""
+        rtts = self._rtts
+        return HeartbeatStats(
+            sent=self._heartbeats_sent,
+            missed=self._heartbeats_missed,
+            last_rtt=rtts[-1] if rtts else None,
+            mean_rtt=sum(rtts) / len(rtts) if rtts else None,
+            min_rtt=min(rtts) if rtts else None,
+            max_rtt=max(rtts) if rtts else None,
+            last_frame=self._last_frame,
+            reconnects=self._reconnects,
+        )
+
+    def _record_frame(self, frame: Optional[int]) -> None:
+        if frame is not None:
+            self._speed.record(frame)
+
+    def speed_stats(self) -> SpeedStats:
+        """Get the emulation speed measured from reported frame counters (see MGBAConnection.speed_stats)"""
+        return self._speed.stats()
+
+    async def send(self, message: str | bytes) -> bool:
+        """Send a message to mGBA, or add it to the current batch (see batch)"""
+        if not self._connected or not self._writer:
+            print("Not connected to mGBA")
+            return False
+
+        data = message.encode() if isinstance(message, str) else message
+        batch = self._current_batch()
+        if batch is not None:
+            batch.append(data)
+            return True
+        return await self._write(data)
+
+    async def _write(self, data: bytes) -> bool:
+        try:
+            self._writer.write(data)
+            await self._writer.drain()
+            return True
+        except Exception as e:
+            self._connection_lost(f"send failed: {e}")
+            return False
+
+    async def send_command(self, command: Command) -> bool:
+        """Send a command without waiting for the server to apply it"""
+        return await self.send(encode_message(command, protocol=self._protocol))
+
+    @asynccontextmanager
+    async def batch(self):
+        """Collect the messages sent inside the block and send them in a single write (see MGBAConnection.batch)
+
+        Batches belong to the task that opened them: other tasks, including ones it starts, keep
+        sending as usual.
+        """
+        if self._current_batch() is not None:
+            yield self
+            return
+        token = self._batch.set((asyncio.current_task(), []))
+        try:
+            yield self
+        finally:
+            await self.flush()
+            self._batch.reset(token)
+
+    def _current_batch(self) -> Optional[list[bytes]]:
+        """The batch the current task has open, if any"""
+        # Tasks started inside a batch inherit the variable, but not the batch
+        current = self._batch.get()
+        return current[1] if current is not None and current[0] is asyncio.current_task() else None
+
+    async def flush(self) -> bool:
+        """Send the messages collected so far by the current task's batch"""
+        batch = self._current_batch()
+        if not batch:
+            return True
+        data = b"".join(batch)
+        batch.clear()
+        return await self._write(data)
+
+    async def _listen_loop(self, reader: asyncio.StreamReader):
+        """Background task reading messages and routing replies to waiting requests"""
+        reason = "mGBA closed the connection"
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for reply in self._decoder.feed(data):
+                    if reply.request_id is None and reply.ctrl == IDENTIFY_CTRL_CHAR:
+                        self._set_identity(parse_identity_reply(reply.payload))
+                    elif reply.request_id is None and reply.ctrl == FRAME_REPORT_CTRL_CHAR:
+                        self._record_frame(parse_frame_report(reply.payload))
+                    elif reply.request_id is None and reply.ctrl == RECORD_CTRL_CHAR:
+                        self._add_recorded(parse_recorded_steps(reply.payload))
+                    elif reply.request_id is not None:
+                        # Replies to requests that already timed out are dropped
+                        waiting = self._pending.get(reply.request_id)
+                        if waiting is not None and not waiting.done():
+                            waiting.set_result(reply.payload)
+                    else:
+                        self._received += 1
+                        self._queue_inbound(reply.payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            reason = f"listen failed: {e}"
+        # Streams replaced by a reconnect were not lost
+        if reader is self._reader:
+            self._connection_lost(reason)
+
+    def _set_identity(self, identity: Optional[InstanceIdentity]) -> None:
+        """Remember the first instance this connection reached, which a reconnect must reach again"""
+        if identity is not None and self._identity is None:
+            self._identity = identity
+
+    def _queue_inbound(self, message) -> None:
+        """Queue a message for the dispatch task, making room by dropping the oldest if needed"""
+        while True:
+            try:
+                self._inbound.put_nowait(message)
+                return
+            except asyncio.QueueFull:
+                self._inbound.get_nowait()
+                self._dropped += 1
+
+    async def _dispatch_loop(self):
+        """Background task handing received messages to the message callback"""
+        while True:
+            message = await self._inbound.get()
+            if not self._on_message:
+                print(f"Received: {message}")
+                continue
+            try:
+                result = self._on_message(message)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                print(f"Message callback failed: {e}")
+
+    def inbound_stats(self) -> InboundStats:
+        """Get the number of received messages waiting for, handed to and dropped before the callback"""
+        return InboundStats(self._inbound.qsize(), self._received, self._dropped)
+
+    async def _request(self, command: Command, timeout: Optional[float]) -> Optional[str | bytes]:
+        """Send a command tagged with a new request ID and await the server's reply to it
+
+        Returns None on failure or timeout.
+        """
+        request_id = next(self._request_ids)
+        waiting = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = waiting
+        try:
+            message = encode_message(command, request_id, self._protocol)
+            if not await self.send(message) or not await self.flush():
+                return None
+            return await asyncio.wait_for(waiting, timeout)
+        except asyncio.TimeoutError:
+            print(f"Timed out waiting for reply to request {request_id} on port {self._port}")
+            return None
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def _send_key_state(self, wait: bool) -> bool:
+        if wait:
+            return parse_ack(await self._request(encode_key_state(self._key_state.bitmask()), timeout=5.0))
+        return await self.send_command(encode_key_state(self._key_state.bitmask()))
+
+    async def execute_event(self, key_event: KeyEvent, wait: bool = False):
+        """Execute a key event (see MGBAConnection.execute_event)"""
+        match key_event.event_type:
+            case KeyEventType.PUSH:
+                self._key_state.set_key(key_event.key_type, True)
+                await self._send_key_state(wait)
+                await asyncio.sleep(key_event.push_time)
+                self._key_state.set_key(key_event.key_type, False)
+                await self._send_key_state(wait)
+            case KeyEventType.HOLD:
+                self._key_state.set_key(key_event.key_type, True)
+                await self._send_key_state(wait)
+            case KeyEventType.RELEASE:
+                self._key_state.set_key(key_event.key_type, False)
+                await self._send_key_state(wait)
+
+    async def reset_game(self, timeout: float = 5.0) -> bool:
+        """Reset the game, returning once the server has reset it"""
+        self._key_state.clear()
+        return parse_ack(await self._request(encode_reset(), timeout))
+
+    async def run_program(self, program: InputProgram, wait: bool = True, timeout: Optional[float] = None) -> bool:
+        """Play back an input program on the emulator's frame callback (see MGBAConnection.run_program)"""
+        self._key_state.clear()
+        if not wait:
+            return await self.send_command(encode_program(program))
+
+        if timeout is None:
+            timeout = program.duration_seconds() + 5.0
+        return await self._request(encode_program(program), timeout) == "done"
+
+    async def run_program_until(self, program: InputProgram, conditions: list[Command],
+                                timeout: Optional[float] = None) -> Optional[int]:
+        """Play back an input program until any condition holds (see MGBAConnection.run_program_until)"""
+        self._key_state.clear()
+        if timeout is None:
+            timeout = program.duration_seconds() + 5.0
+        reached = parse_wait_frame_reply(await self._request(encode_program_until(program, conditions), timeout))
+        self._record_frame(reached)
+        return reached
+
+    async def save_state(self, slot: str, wait: bool = True, timeout: float = 5.0) -> bool:
+        """Capture a savestate into a named in-memory slot on the emulator (see MGBAConnection.save_state)"""
+        command = encode_save_state(slot)
+        if not wait:
+            return await self.send_command(command)
+        return parse_state_reply(await self._request(command, timeout), self._port)
+
+    async def load_state(self, slot: str, wait: bool = True, timeout: float = 5.0) -> bool:
+        """Restore a savestate previously captured with save_state (see MGBAConnection.load_state)"""
+        command = encode_load_state(slot)
+        self._key_state.clear()
+        if not wait:
+            return await self.send_command(command)
+        return parse_state_reply(await self._request(command, timeout), self._port)
+
+    async def read_memory(self, addr: int, length: int, timeout: float = 5.0) -> Optional[bytes]:
+        """Read a range of the GBA address space"""
+        ranges = await self.read_memory_ranges([(addr, length)], timeout)
+        return ranges[0] if ranges is not None else None
+
+    async def read_memory_ranges(self, ranges: list[tuple[int, int]], timeout: float = 5.0) -> Optional[list[bytes]]:
+        """Read several (address, length) ranges of the GBA address space in a single request"""
+        if not ranges:
+            return []
+        command = encode_read_memory(ranges)
+        return parse_read_memory_reply(await self._request(command, timeout), [length for _, length in ranges])
+
+    async def grab_frame(self, as_array: bool = True, timeout: float = 5.0) -> Optional[np.ndarray | memoryview]:
+        """Get the current frame as raw RGB bytes (see MGBAConnection.grab_frame)"""
+        return parse_frame_reply(await self._request(encode_grab_frame(), timeout), as_array)
+
+    async def probe(self, regions: list[tuple[int, ...]], timeout: float = 5.0) -> Optional[list[int]]:
+        """Sample points or rectangles of the current frame (see MGBAConnection.probe)"""
+        if not regions:
+            return []
+        command = encode_probe(regions)
+        return parse_probe_reply(await self._request(command, timeout), len(regions))
+
+    async def wait_frames(self, frames: int, timeout: Optional[float] = None) -> Optional[int]:
+        """Wait until the emulator has run the given number of frames (see MGBAConnection.wait_frames)"""
+        return await self._wait_frame(frames, True, timeout)
+
+    async def wait_until_frame(self, frame: int, timeout: Optional[float] = None) -> Optional[int]:
+        """Wait until the emulator's frame counter reaches frame (see MGBAConnection.wait_until_frame)"""
+        return await self._wait_frame(frame, False, timeout)
+
+    async def _wait_frame(self, frame: int, relative: bool, timeout: Optional[float]) -> Optional[int]:
+        if timeout is None:
+            timeout = self._wait_frame_timeout(frame, relative)
+        reached = parse_wait_frame_reply(await self._request(encode_wait_frame(frame, relative), timeout))
+        self._record_frame(reached)
+        return reached
+
+    async def wait_for_pixel(self, x: int, y: int, color: int | str, equal: bool = True,
+                             frames: int = CONDITION_WAIT_FRAMES, timeout: Optional[float] = None) -> Optional[int]:
+        """Wait until a pixel has the given color (see MGBAConnection.wait_for_pixel)"""
+        if isinstance(color, str):
+            color = hex_color(color)
+        return await self._wait_condition(encode_wait_screen((x, y), color, equal, frames), frames, timeout)
+
+    async def wait_for_screen(self, region: tuple[int, int, int, int], region_hash: int, equal: bool = True,
+                              frames: int = CONDITION_WAIT_FRAMES, timeout: Optional[float] = None) -> Optional[int]:
+        """Wait until a rectangle of the screen has the given hash (see MGBAConnection.wait_for_screen)"""
+        return await self._wait_condition(encode_wait_screen(region, region_hash, equal, frames), frames, timeout)
+
+    async def wait_for_memory(self, addr: int, value: int, size: int = 1, mask: Optional[int] = None,
+                              equal: bool = True, frames: int = CONDITION_WAIT_FRAMES,
+                              timeout: Optional[float] = None) -> Optional[int]:
+        """Wait until a value in memory matches (see MGBAConnection.wait_for_memory)"""
+        command = encode_wait_memory(addr, size, value, mask, equal, frames)
+        return await self._wait_condition(command, frames, timeout)
+
+    async def _wait_condition(self, command: Command, frames: int, timeout: Optional[float]) -> Optional[int]:
+        if timeout is None and frames:
+            timeout = self._wait_frame_timeout(frames, True)
+        reached = parse_wait_frame_reply(await self._request(command, timeout))
+        self._record_frame(reached)
+        return reached
+
+    def _wait_frame_timeout(self, frame: int, relative: bool) -> float:
+        if not relative:
+            frame -= self._speed.stats().frame or 0
+        return max(frame, 0) / GBA_FRAMES_PER_SECOND + HEARTBEAT_DEADLINE
+
+    async def start_recording(self, timeout: float = 5.0) -> bool:
+        """Start recording the keys held on every frame (see MGBAConnection.start_recording)"""
+        recorded, self._recorded = self._recorded, []
+        reply = await self._request(encode_record("start"), timeout)
+        if reply != "ok":
+            if reply is not None:
+                print(f"Recording refused on port {self._port}: {reply}")
+            # Refused or lost, so nothing new is being recorded for this connection
+            self._recorded = recorded
+            return False
+        return True
+
+    async def stop_recording(self, timeout: float = 5.0) -> Optional[InputProgram]:
+        """Stop recording, returning what was recorded as an input program (see MGBAConnection.stop_recording)"""
+        rest = parse_recorded_steps(await self._request(encode_record("stop"), timeout))
+        recorded, self._recorded = self._recorded, None
+        if rest is None or recorded is None:
+            return None
+        return InputProgram.from_steps(recorded + rest)
+
+    def _add_recorded(self, steps: Optional[list[tuple[int, int]]]) -> None:
+        if steps is not None and self._recorded is not None:
+            self._recorded.extend(steps)
+
+    async def identify(self, timeout: float = 5.0) -> Optional[InstanceIdentity]:
+        """Ask the server which instance it belongs to (see InstanceIdentity)"""
+        identity = parse_identity_reply(await self._request(encode_identify(), timeout))
+        self._set_identity(identity)
+        return identity
+
+    async def set_role(self, role: str, timeout: float = 5.0) -> bool:
+        """Ask to be the "control" client or a read-only "telemetry" client (see MGBAConnection.set_role)"""
+        if not parse_role_reply(await self._request(encode_role(role), timeout), self._port):
+            return False
+        self._role = role
+        return True
+
+    async def save_screenshot_to_file(self, filename: str, wait: bool = True, timeout: float = 5.0) -> bool:
+        """Take a screenshot and save it to a file, by default awaiting until it is written"""
+        if not wait:
+            return await self.send_command(encode_screenshot(filename))
+        return parse_ack(await self._request(encode_screenshot(filename), timeout))
+
+    async def __aenter__(self):
+        """Async context manager entry"""
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        """Async context manager exit"""
+        await self.disconnect()
@@ -0,0 +1,57 @@
+"""Requirements
+
+    - mGBA executable and Pokemon ROM paths have been set in config.toml
+    - Run this script by using the command line from repo root:
+        $ run.bat -m pkbt.automation.demos.async_fleet_demo
+"""
+
+from pkbt.config import MGBA_DEV, SERVER_SCRIPT, INPUT_DISPLAY_SCRIPT, POKEMON_RED_ROM
+from pkbt.orchestrator import AsyncOrchestrator, perform_task_on_all
+from pkbt.input.key_type import KeyType
+from pkbt.input.input_program import InputProgram
+from pkbt.state_manager import initialize_state_manager
+from pkbt.emulator import EmulatorProc
+from pkbt.async_mgba_connection import AsyncMGBAConnection
+from pkbt.discovery import candidate_ports, locate_async
+import asyncio
+
+"""Tweak as desired"""
+NUM_INSTANCES = 4
+STARTING_PORT = 8888 # Leave me alone
+
+# A task is a coroutine, so waiting on one instance never blocks the others
+async def my_task(e: EmulatorProc, c: AsyncMGBAConnection) -> None:
+    await c.connect()
+    await c.reset_game()
+    await c.wait_frames(60)
+    for _ in range(3):
+        await c.run_program(InputProgram().press(KeyType.A).wait(30))
+
+async def main():
+    initialize_state_manager()
+
+    emulators = [
+        EmulatorProc(MGBA_DEV, POKEMON_RED_ROM, [SERVER_SCRIPT, INPUT_DISPLAY_SCRIPT])
+        for _ in range(NUM_INSTANCES)
+    ]
+
+    print("Starting mGBA instances...")
+    for e in emulators:
+        e.start()
+
+    # Each server announces which emulator it belongs to, so none is driven through the wrong port
+    identities = await locate_async(emulators, candidate_ports(STARTING_PORT, NUM_INSTANCES))
+    orchestrators = [
+        AsyncOrchestrator(e, AsyncMGBAConnection('localhost', identity.port))
+        for e, identity in zip(emulators, identities) if identity is not None
+    ]
+
+    print("Performing task on every instance from a single event loop")
+    for result in await perform_task_on_all(orchestrators, my_task):
+        if isinstance(result, Exception):
+            print(f"Task failed: {result}")
+
+    print("Disconnecting from mGBA and closing emulators...")
+    await asyncio.gather(*(o.exit() for o in orchestrators))
+
+asyncio.run(main())
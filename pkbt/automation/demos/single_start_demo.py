@@ -10,26 +10,39 @@ from pkbt.orchestrator import Orchestrator
 from pkbt.input.key_event import KeyEventType
 from pkbt.input.key_type import KeyType
 from pkbt.input.key_event import KeyEvent
+from pkbt.input.input_program import InputProgram
 from pkbt.state_manager import initialize_state_manager
 from pkbt.emulator import EmulatorProc
 from pkbt.mgba_connection import MGBAConnection
+from pkbt.clock import FrameClock
+from pkbt.discovery import candidate_ports, locate
+import sys
 import time
 
+"""Constants"""
+STARTING_PORT = 8888 # Leave me alone
+
 
 """Running the demo"""
 
 # Initialize runtime data (required at the start of the program)
 initialize_state_manager()
 
-# Create orchestrator for managing client/host and performing automation.
 # INPUT_DISPLAY_SCRIPT is optional, but useful for seeing the input events in real-time (see center-top of game view).
-orchestrator = Orchestrator(
-    EmulatorProc(MGBA_DEV, POKEMON_RED_ROM, [SERVER_SCRIPT, INPUT_DISPLAY_SCRIPT]),
-    MGBAConnection('localhost', 8888)) # The starting port is always 8888, subsequent ports are incremented by 1
+emulator = EmulatorProc(MGBA_DEV, POKEMON_RED_ROM, [SERVER_SCRIPT, INPUT_DISPLAY_SCRIPT])
 
 print("Starting mGBA instance...")
-orchestrator.emu.start()
-time.sleep(3)
+emulator.start()
+
+# The server takes the first free port from STARTING_PORT, so find the one announcing this emulator
+identity = locate([emulator], candidate_ports(STARTING_PORT, 1))[0]
+if identity is None:
+    print("The mGBA instance did not announce itself")
+    emulator.process.terminate()
+    sys.exit(1)
+
+# Create orchestrator for managing client/host and performing automation.
+orchestrator = Orchestrator(emulator, MGBAConnection('localhost', identity.port))
 
 print("Connecting to mGBA...")
 orchestrator.client.connect()
@@ -37,26 +50,34 @@ time.sleep(3)
 
 # A "task" is any function that has the following signature
 def my_task(e: EmulatorProc, c: MGBAConnection) -> None:
+    # Waits are counted in frames by the emulator, so they last the same in-game at any speed
+    clock = FrameClock(c)
 
     print("Resetting game")
     c.reset_game()
-    time.sleep(1)
+    clock.wait(60)
 
     print("Pressing A for default duration")
     c.execute_event(KeyEvent(KeyEventType.PUSH, KeyType.A))
-    time.sleep(1)
+    clock.wait(60)
 
     print("Pressing A for .5s duration")
     c.execute_event(KeyEvent(KeyEventType.PUSH, KeyType.A, push_time=0.5))
-    time.sleep(1)
+    clock.wait(60)
 
     print("Setting A to held indefinitely")
     c.execute_event(KeyEvent(KeyEventType.HOLD, KeyType.A))
-    time.sleep(1)
+    clock.wait(60)
 
     print("Releasing A")
     c.execute_event(KeyEvent(KeyEventType.RELEASE, KeyType.A))
-    time.sleep(1)
+    clock.wait(60)
+
+    print("Pressing A three times, timed in frames by the emulator")
+    program = InputProgram()
+    for _ in range(3):
+        program.press(KeyType.A).wait(30)
+    c.run_program(program)
 
 print("Performing user-defined task")
 orchestrator.perform_task(my_task)
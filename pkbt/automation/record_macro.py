@@ -0,0 +1,71 @@
+"""Requirements
+
+    - mGBA executable and the ROM's path have been set in config.toml
+    - Run this script by using the command line from repo root, with the ROM (a key of [roms] in
+      config.toml) and the macro file to write:
+        $ run.bat -m pkbt.automation.record_macro pokemon_emerald pkbt/automation/hunts/macros/walk.txt
+    - Play up to where the macro should start, press Enter, play the macro, press Enter again
+    - The macro is played back from where recording started, to check it does the same thing.
+      Hands off the keys while it plays.
+    - Macros can be played with MGBAConnection.run_program(load_macro(path)), at any speed, or
+      used as a step of a hunt spec: { macro = "macros/walk.txt" }
+"""
+
+import sys
+import time
+from pkbt.config import MGBA_DEV, SERVER_SCRIPT, ROMS
+from pkbt.state_manager import initialize_state_manager
+from pkbt.fleet import Fleet
+from pkbt.image_processing import SCREEN_WIDTH, SCREEN_HEIGHT
+from pkbt.input.macro import save_macro, trim_leading_wait
+
+"""Constants"""
+STARTING_PORT = 8888 # Leave me alone
+MACRO_SLOT = "macro"
+
+if len(sys.argv) != 3 or sys.argv[1] not in ROMS:
+    print(f"Usage: record_macro <{'|'.join(ROMS)}> <macro file>")
+    sys.exit(1)
+rom, path = ROMS[sys.argv[1]], sys.argv[2]
+
+"""Putting it all together and running it"""
+initialize_state_manager()
+
+fleet = Fleet(MGBA_DEV, rom, [SERVER_SCRIPT], 1, STARTING_PORT)
+orchestrators = fleet.boot_all()
+if not orchestrators:
+    print("The instance did not start")
+    sys.exit(1)
+o = orchestrators[0]
+c = o.client
+
+input("Play up to where the macro starts, then press Enter to start recording")
+# Sent in one write, so recording starts on the frame the state is saved on
+with c.batch():
+    recording = c.save_state(MACRO_SLOT, wait=False) and c.start_recording()
+if not recording:
+    o.exit()
+    sys.exit(1)
+started = time.monotonic()
+input("Recording, press Enter to stop")
+recorded = c.stop_recording()
+end_screen = c.probe([(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)])
+if recorded is None:
+    print("Recording failed")
+    o.exit()
+    sys.exit(1)
+
+# Whatever was played before the first key press is not part of the macro
+macro = trim_leading_wait(recorded)
+save_macro(macro, path, f"Recorded on {sys.argv[1]} on {time.strftime('%Y-%m-%d %H:%M:%S')}")
+print(f"Recorded {recorded.total_frames} frames in {time.monotonic() - started:.0f}s, "
+      f"saved {len(macro)} steps ({macro.total_frames} frames) to {path}")
+
+# The emulator is deterministic, so playing the recording from the same state ends on the same screen
+print("Playing it back")
+with c.batch():
+    played = c.load_state(MACRO_SLOT, wait=False) and c.run_program(recorded)
+if played:
+    same = c.probe([(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)]) == end_screen
+    print("Playback ended on the same screen" if same else "Playback ended on a different screen")
+o.exit()
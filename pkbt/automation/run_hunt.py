@@ -0,0 +1,56 @@
+"""Requirements
+
+    - The save file is set up as the spec's comments describe
+    - User sets all mGBA instances to unbounded fast-forward mode (Shift+Tab)
+    - Run this script by using the command line from repo root, with the hunt spec to run:
+        $ run.bat -m pkbt.automation.run_hunt pkbt/automation/hunts/hatch_shiny_eevee.toml
+"""
+
+import sys
+import time
+from pkbt.config import MGBA_DEV, SERVER_SCRIPT
+from pkbt.state_manager import initialize_state_manager
+from pkbt.fleet import Fleet
+from pkbt.hunt.spec import load_hunt_spec
+from pkbt.hunt.profile import load_profile, apply_profile, profile_path
+from pkbt.hunt.runner import HuntRunner
+from pkbt.windowing import Window, arrange_windows_auto_grid, minimize_windows_starting_with, get_primary_screen_width
+
+"""Constants"""
+STARTING_PORT = 8888 # Leave me alone
+
+if len(sys.argv) != 2:
+    print("Usage: run_hunt <spec.toml>")
+    sys.exit(1)
+spec = load_hunt_spec(sys.argv[1])
+print(f"Hunting: {spec.name}")
+
+# Waits found by tune_hunt replace the spec's own
+profile = load_profile(spec)
+if profile is not None:
+    spec = apply_profile(spec, profile)
+    print(f"Using the tuned waits in {profile_path(spec)}")
+
+"""Putting it all together and running it"""
+initialize_state_manager()
+
+# Start the emulators a few at a time, connecting to each as soon as its server is up
+fleet = Fleet(MGBA_DEV, spec.rom, [SERVER_SCRIPT], spec.instances, STARTING_PORT)
+orchestrators = fleet.boot_all()
+fleet.print_timeline()
+if profile is not None and orchestrators:
+    identity = orchestrators[0].client.identity
+    if identity is not None and identity.game_code != profile.game_code:
+        print(f"Tuned waits are for {profile.game_code}, but the ROM is {identity.game_code}")
+
+# Arrange the windows in a grid
+windows = [Window.from_pid(o.emu.process.pid) for o in orchestrators]
+arrange_windows_auto_grid(windows, max_width=get_primary_screen_width())
+minimize_windows_starting_with("Scripting")
+
+# User is given time to set all mGBA instances to unbounded fast-forward mode
+time.sleep(10)
+fleet.print_speed_report()
+
+# Every cycle is played back in emulated frames, so the hunt keeps its timing at any speed
+HuntRunner(spec).run(fleet, orchestrators)
@@ -11,14 +11,15 @@ from pkbt.input.key_event import KeyEventType
 from pkbt.input.key_type import KeyType
 from pkbt.input.key_event import KeyEvent
 from pkbt.state_manager import initialize_state_manager
-from pkbt.emulator import EmulatorProc
-from pkbt.mgba_connection import MGBAConnection
-from pkbt.config import MGBA_DEV, SERVER_SCRIPT, TEMP_DIR
+from pkbt.fleet import Fleet
+from pkbt.supervisor import Supervisor
+from pkbt.config import MGBA_DEV, SERVER_SCRIPT
 from pkbt.windowing import Window, arrange_windows_auto_grid, minimize_windows_starting_with, get_primary_screen_width
-from pkbt.image_processing import pixel_hex, save_with_crosshair
+from pkbt.image_processing import color_hex
 from pkbt.audio import play_success
+from pkbt.hunt.spec import Hatch
+from pkbt.hunt.hatching import hatch_eggs
 import time
-import threading
 import random
 
 """Constants"""
@@ -28,17 +29,16 @@ STARTING_PORT = 8888 # Leave me alone
 NUM_INSTANCES = 15
 CROSSHAIR = (105, 38)
 SHINY_STAR_HEX = "#ffd652"
+HATCH_WALK = Hatch(slots=[2], frames=48, times=150) # The egg joins the party in slot 2
 
 """Shared thread-safe variables"""
 runs = 0
 found_shiny = False
-kill_all_threads = False
 
 """The task that will be performed by each orchestrator"""
 def task(o: Orchestrator, idx: int):
     global runs
     global found_shiny
-    global kill_all_threads
 
     o.client.connect()
 
@@ -62,7 +62,7 @@ def task(o: Orchestrator, idx: int):
         time.sleep(0.7)
 
     def offset_clock():
-        time.sleep((o.client._port - 8888) * 0.25)
+        time.sleep(idx * 0.25)
 
     def pick_up_egg():
         o.client.execute_event(KeyEvent(KeyEventType.PUSH, KeyType.A))
@@ -99,18 +99,14 @@ def task(o: Orchestrator, idx: int):
         time.sleep(1)
         o.client.execute_event(KeyEvent(KeyEventType.RELEASE, KeyType.DOWN))
 
-    def hatch_egg():
+    def hatch_egg() -> bool:
         o.client.execute_event(KeyEvent(KeyEventType.PUSH, KeyType.DOWN))
         time.sleep(0.3)
         o.client.execute_event(KeyEvent(KeyEventType.PUSH, KeyType.SELECT))
         time.sleep(0.7)
-        for _ in range(150):
-            o.client.execute_event(KeyEvent(KeyEventType.HOLD, KeyType.LEFT))
-            time.sleep(0.3)
-            o.client.execute_event(KeyEvent(KeyEventType.RELEASE, KeyType.LEFT))
-            o.client.execute_event(KeyEvent(KeyEventType.HOLD, KeyType.RIGHT))
-            time.sleep(0.3)
-            o.client.execute_event(KeyEvent(KeyEventType.RELEASE, KeyType.RIGHT))
+        # Paced by the server, which stops on the frame the egg hatches
+        identity = o.client.identity or o.client.identify()
+        return identity is not None and hatch_eggs(o.client, HATCH_WALK, identity.game_code)
 
     def go_through_hatching_sequences():
         o.client.execute_event(KeyEvent(KeyEventType.PUSH, KeyType.A))
@@ -136,12 +132,9 @@ def task(o: Orchestrator, idx: int):
         o.client.execute_event(KeyEvent(KeyEventType.PUSH, KeyType.A))
         time.sleep(0.7)
 
-    def save_screenshot():
-        o.client.save_screenshot_to_file(f"{idx}.png")
-        time.sleep(1)
-
     def shiny_star_is_visible() -> bool:
-        return SHINY_STAR_HEX == pixel_hex(f"{TEMP_DIR}/{idx}.png", CROSSHAIR[0], CROSSHAIR[1])
+        colors = o.client.probe([CROSSHAIR])
+        return colors is not None and SHINY_STAR_HEX == color_hex(colors[0])
 
     def save_game():
         o.client.execute_event(KeyEvent(KeyEventType.PUSH, KeyType.B))
@@ -164,23 +157,23 @@ def task(o: Orchestrator, idx: int):
         time.sleep(0.7)
 
     # Main loop
-    while found_shiny == False and kill_all_threads == False:
+    while found_shiny == False:
 
         if not o.is_healthy():
-            print(f"Orchestrator for port {idx} is unhealthy, likely affects all timing, killing all threads")
-            kill_all_threads = True
+            print(f"Orchestrator {idx} is unhealthy, handing it back to the supervisor")
             break
 
-        runs += 1
-        if o.client._port == 8888:
-            print(f"Runs: {runs}")
         start_game()
         offset_clock()
         pick_up_egg()
-        hatch_egg()
+        # An egg that didn't hatch leaves nothing to check, so the cycle starts over
+        if not hatch_egg():
+            continue
+        runs += 1
+        if idx == 0:
+            print(f"Runs: {runs}")
         go_through_hatching_sequences()
         enter_summary()
-        save_screenshot()
         if shiny_star_is_visible():
             found_shiny = True
             print(f"Shiny found on {idx}")
@@ -192,38 +185,21 @@ def task(o: Orchestrator, idx: int):
 """Putting it all together and running it"""
 initialize_state_manager()
 
-# Create the orchestrators
-orchestrators = []
-for i in range(NUM_INSTANCES):
-    orch = Orchestrator(
-        EmulatorProc(MGBA_DEV, POKEMON_RED_ROM, [SERVER_SCRIPT]),
-        MGBAConnection('localhost', STARTING_PORT + i))
-    orchestrators.append(orch)
-
-# Start the emulators
-emu_pids: list[int] = []
-for i in range(NUM_INSTANCES):
-    pid = orchestrators[i].perform_task(lambda e, c: e.process.pid if e.start() else None)
-    emu_pids.append(pid)
+# Start the emulators a few at a time, connecting to each as soon as its server is up
+fleet = Fleet(MGBA_DEV, POKEMON_RED_ROM, [SERVER_SCRIPT], NUM_INSTANCES, STARTING_PORT)
+orchestrators = fleet.boot_all()
+fleet.print_timeline()
 
 # Arrange the windows in a grid
-time.sleep(5)
-windows = [Window.from_pid(pid) for pid in emu_pids]
+windows = [Window.from_pid(o.emu.process.pid) for o in orchestrators]
 # arrange_in_grid(windows, num_cols=3, num_rows=1)
 arrange_windows_auto_grid(windows, max_width=get_primary_screen_width())
 minimize_windows_starting_with("Scripting")
 
 # User is given time to set all mGBA instances to unbounded fast-forward mode
 time.sleep(10)
+fleet.print_speed_report()
 
-# Start the tasks
-threads = []
-for i, orchestrator in enumerate(orchestrators):
-    t = threading.Thread(target=task, args=(orchestrator, i), daemon=True)
-    t.start()
-    threads.append(t)
-
-# Without this, the main program will exit immediately, 
-# causing daemon threads to be killed before they complete their tasks
-for t in threads:
-    t.join()
\ No newline at end of file
+# Run the task on every instance, replacing any that crash or hang so the rest keep going
+supervisor = Supervisor(fleet, task)
+supervisor.run(orchestrators)
\ No newline at end of file
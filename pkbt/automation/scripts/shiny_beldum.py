@@ -11,14 +11,13 @@ from pkbt.input.key_event import KeyEventType
 from pkbt.input.key_type import KeyType
 from pkbt.input.key_event import KeyEvent
 from pkbt.state_manager import initialize_state_manager
-from pkbt.emulator import EmulatorProc
-from pkbt.mgba_connection import MGBAConnection
-from pkbt.config import MGBA_DEV, SERVER_SCRIPT, TEMP_DIR
+from pkbt.fleet import Fleet
+from pkbt.supervisor import Supervisor
+from pkbt.config import MGBA_DEV, SERVER_SCRIPT
 from pkbt.windowing import Window, arrange_windows_auto_grid, minimize_windows_starting_with, get_primary_screen_width
-from pkbt.image_processing import pixel_hex
+from pkbt.image_processing import color_hex
 from pkbt.audio import play_success
 import time
-import threading
 import random
 
 """Constants"""
@@ -77,24 +76,21 @@ def task(o: Orchestrator, idx: int):
         o.client.execute_event(KeyEvent(KeyEventType.PUSH, KeyType.A))
         time.sleep(0.7)
 
-    def save_screenshot():
-        o.client.save_screenshot_to_file(f"{idx}.png")
-        time.sleep(1)
-
     def color_is_normal() -> bool:
-        return BLUEISH_HEX == pixel_hex(f"{TEMP_DIR}/{idx}.png", CROSSHAIR[0], CROSSHAIR[1])
+        colors = o.client.probe([CROSSHAIR])
+        # A failed probe is not evidence of a shiny
+        return colors is None or BLUEISH_HEX == color_hex(colors[0])
 
     # Main loop
-    while True:
+    while o.is_healthy():
         runs += 1
-        if o.client._port == 8888:
+        if idx == 0:
             print(f"Runs: {runs}")
         start_game()
         time.sleep(random.uniform(0, 1))
         pick_up_pokeball()
         time.sleep(random.uniform(0, 1))
         enter_summary()
-        save_screenshot()
         if not color_is_normal():
             print(f"Shiny found on {idx}")
             play_success(blocking=True)
@@ -103,38 +99,21 @@ def task(o: Orchestrator, idx: int):
 """Putting it all together and running it"""
 initialize_state_manager()
 
-# Create the orchestrators
-orchestrators = []
-for i in range(NUM_INSTANCES):
-    orch = Orchestrator(
-        EmulatorProc(MGBA_DEV, POKEMON_EMERALD_ROM, [SERVER_SCRIPT]),
-        MGBAConnection('localhost', STARTING_PORT + i))
-    orchestrators.append(orch)
-
-# Start the emulators
-emu_pids: list[int] = []
-for i in range(NUM_INSTANCES):
-    pid = orchestrators[i].perform_task(lambda e, c: e.process.pid if e.start() else None)
-    emu_pids.append(pid)
+# Start the emulators a few at a time, connecting to each as soon as its server is up
+fleet = Fleet(MGBA_DEV, POKEMON_EMERALD_ROM, [SERVER_SCRIPT], NUM_INSTANCES, STARTING_PORT)
+orchestrators = fleet.boot_all()
+fleet.print_timeline()
 
 # Arrange the windows in a grid
-time.sleep(5)
-windows = [Window.from_pid(pid) for pid in emu_pids]
+windows = [Window.from_pid(o.emu.process.pid) for o in orchestrators]
 # arrange_in_grid(windows, num_cols=3, num_rows=1)
 arrange_windows_auto_grid(windows, max_width=get_primary_screen_width())
 minimize_windows_starting_with("Scripting")
 
 # User is given time to set all mGBA instances to unbounded fast-forward mode
 time.sleep(10)
+fleet.print_speed_report()
 
-# Start the tasks
-threads = []
-for i, orchestrator in enumerate(orchestrators):
-    t = threading.Thread(target=task, args=(orchestrator, i), daemon=True)
-    t.start()
-    threads.append(t)
-
-# Without this, the main program will exit immediately, 
-# causing daemon threads to be killed before they complete their tasks
-for t in threads:
-    t.join()
\ No newline at end of file
+# Run the task on every instance, replacing any that crash or hang so the rest keep going
+supervisor = Supervisor(fleet, task)
+supervisor.run(orchestrators)
\ No newline at end of file
@@ -0,0 +1,56 @@
+"""Requirements
+
+    - The save file is set up as the spec's comments describe
+    - Optionally set the mGBA instance to unbounded fast-forward mode (Shift+Tab), tuning is timed
+      in frames either way and only finishes sooner
+    - Run this script by using the command line from repo root, with the hunt spec to tune:
+        $ run.bat -m pkbt.automation.tune_hunt pkbt/automation/hunts/hatch_shiny_eevee.toml
+    - The tuned waits are written to the spec's profile, which run_hunt picks up
+"""
+
+import sys
+import time
+import random
+from pkbt.config import MGBA_DEV, SERVER_SCRIPT
+from pkbt.state_manager import initialize_state_manager
+from pkbt.fleet import Fleet
+from pkbt.hunt.spec import load_hunt_spec
+from pkbt.hunt.profile import save_profile, apply_profile
+from pkbt.hunt.compiler import compile_cycle
+from pkbt.hunt.tuner import DelayTuner
+
+"""Constants"""
+STARTING_PORT = 8888 # Leave me alone
+
+if len(sys.argv) != 2:
+    print("Usage: tune_hunt <spec.toml>")
+    sys.exit(1)
+spec = load_hunt_spec(sys.argv[1])
+print(f"Tuning: {spec.name}")
+
+"""Putting it all together and running it"""
+initialize_state_manager()
+
+# Tuning takes a single instance
+fleet = Fleet(MGBA_DEV, spec.rom, [SERVER_SCRIPT], 1, STARTING_PORT)
+orchestrators = fleet.boot_all()
+if not orchestrators:
+    print("The instance did not start")
+    sys.exit(1)
+o = orchestrators[0]
+
+# User is given time to set the instance to unbounded fast-forward mode
+time.sleep(10)
+
+started = time.monotonic()
+profile = DelayTuner(spec, o.client).tune()
+if profile is None:
+    print("Tuning failed, the instance stopped responding")
+else:
+    path = save_profile(spec, profile)
+    print(f"Tuned {len(profile.waits)} waits in {time.monotonic() - started:.0f}s, saved to {path}")
+    # Jitter and stagger left out, they are the same either way
+    before = compile_cycle(spec, 0, random.Random(0)).total_frames
+    after = compile_cycle(apply_profile(spec, profile), 0, random.Random(0)).total_frames
+    print(f"A cycle now takes {after} frames instead of {before}")
+o.exit()
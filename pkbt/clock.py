@@ -0,0 +1,85 @@
+"""Waits written in game frames rather than wall-clock seconds
+
+Under fast-forward, how long a number of frames takes depends on how fast the emulator happens
+to be running, which changes with load. A fixed sleep is then either wasted time or too short.
+A FrameClock turns frames into wall-clock time using the instance's measured emulation speed
+(see emulation_speed.py), or has the server answer once the frames have actually gone by.
+"""
+
+import time
+import asyncio
+from typing import Optional
+from pkbt.input.input_program import GBA_FRAMES_PER_SECOND
+from pkbt.mgba_connection import MGBAConnection
+from pkbt.async_mgba_connection import AsyncMGBAConnection
+
+class FrameClock:
+    """Frame-based clock of one instance
+
+    wait and wait_until are exact: the server answers once the frame is reached, so they cost a
+    round trip but never wake up early. sleep only converts frames into seconds at the measured
+    speed, which is cheaper but only as accurate as the last few seconds of frame reports. Until
+    there are enough reports (the connection must be listening), nominal_fps is assumed.
+    """
+
+    def __init__(self, client: MGBAConnection, nominal_fps: float = GBA_FRAMES_PER_SECOND) -> None:
+        self.client = client
+        self.nominal_fps = nominal_fps
+
+    def now(self) -> Optional[int]:
+        """Get the latest frame counter received from the server, if any"""
+        return self.client.speed_stats().frame
+
+    def fps(self) -> float:
+        """Get the emulated frames per wall-clock second"""
+        fps = self.client.speed_stats().fps
+        return fps if fps else self.nominal_fps
+
+    def seconds(self, frames: int) -> float:
+        """Convert frames into wall-clock seconds at the current speed"""
+        return frames / self.fps()
+
+    def frames(self, seconds: float) -> int:
+        """Convert wall-clock seconds into frames at the current speed"""
+        return max(0, round(seconds * self.fps()))
+
+    def sleep(self, frames: int) -> None:
+        """Sleep for about as long as the emulator takes to run the given number of frames"""
+        time.sleep(self.seconds(frames))
+
+    def wait(self, frames: int, timeout: Optional[float] = None) -> Optional[int]:
+        """Wait until the emulator has run the given number of frames (see MGBAConnection.wait_frames)"""
+        return self.client.wait_frames(frames, timeout)
+
+    def wait_until(self, frame: int, timeout: Optional[float] = None) -> Optional[int]:
+        """Wait until the emulator reaches frame (see MGBAConnection.wait_until_frame)"""
+        return self.client.wait_until_frame(frame, timeout)
+
+class AsyncFrameClock:
+    """Frame-based clock of one instance driven through an AsyncMGBAConnection (see FrameClock)"""
+
+    def __init__(self, client: AsyncMGBAConnection, nominal_fps: float = GBA_FRAMES_PER_SECOND) -> None:
+        self.client = client
+        self.nominal_fps = nominal_fps
+
+    def now(self) -> Optional[int]:
+        return self.client.speed_stats().frame
+
+    def fps(self) -> float:
+        fps = self.client.speed_stats().fps
+        return fps if fps else self.nominal_fps
+
+    def seconds(self, frames: int) -> float:
+        return frames / self.fps()
+
+    def frames(self, seconds: float) -> int:
+        return max(0, round(seconds * self.fps()))
+
+    async def sleep(self, frames: int) -> None:
+        await asyncio.sleep(self.seconds(frames))
+
+    async def wait(self, frames: int, timeout: Optional[float] = None) -> Optional[int]:
+        return await self.client.wait_frames(frames, timeout)
+
+    async def wait_until(self, frame: int, timeout: Optional[float] = None) -> Optional[int]:
+        return await self.client.wait_until_frame(frame, timeout)
@@ -19,13 +19,48 @@ MGBA_DEV = CONFIG["emulator"]["mgba_dev"]
 POKEMON_RED_ROM = REPO_ROOT / CONFIG["roms"]["pokemon_red"]
 POKEMON_SAPPHIRE_ROM = REPO_ROOT / CONFIG["roms"]["pokemon_sapphire"]
 POKEMON_EMERALD_ROM = REPO_ROOT / CONFIG["roms"]["pokemon_emerald"]
+ROMS = {name: REPO_ROOT / path for name, path in CONFIG["roms"].items()}
 
 """Runtime"""
 TEMP_DIR = REPO_ROOT / CONFIG["runtime"]["temp_directory"]
-STATE_MANAGER = TEMP_DIR / CONFIG["runtime"]["state_manager"]
+INSTANCE_REGISTRY = TEMP_DIR / CONFIG["runtime"]["instance_registry"]
+CRASH_LOG = TEMP_DIR / CONFIG["runtime"]["crash_log"]
 
 """Input"""
 DEFAULT_PUSH_TIME = CONFIG["input"]["default_push_time"]
+DEFAULT_PUSH_FRAMES = CONFIG["input"]["default_push_frames"]
+
+"""Connection"""
+HEARTBEAT_INTERVAL = CONFIG["connection"]["heartbeat_interval"]
+HEARTBEAT_DEADLINE = CONFIG["connection"]["heartbeat_deadline"]
+RECONNECT_INITIAL_DELAY = CONFIG["connection"]["reconnect_initial_delay"]
+RECONNECT_MAX_DELAY = CONFIG["connection"]["reconnect_max_delay"]
+RECONNECT_MAX_ATTEMPTS = CONFIG["connection"]["reconnect_max_attempts"]
+
+"""Fleet"""
+BOOT_CONCURRENCY = CONFIG["fleet"]["boot_concurrency"]
+BOOT_TIMEOUT = CONFIG["fleet"]["boot_timeout"]
+
+"""Discovery"""
+DISCOVERY_PORT_SLACK = CONFIG["discovery"]["port_slack"]
+IDENTIFY_TIMEOUT = CONFIG["discovery"]["identify_timeout"]
+REGISTRY_STALE_AFTER = CONFIG["discovery"]["registry_stale_after"]
+
+"""Telemetry"""
+SPEED_WINDOW = CONFIG["telemetry"]["speed_window"]
+THROTTLED_BELOW = CONFIG["telemetry"]["throttled_below"]
+STALL_TIMEOUT = CONFIG["telemetry"]["stall_timeout"]
+
+"""Supervisor"""
+SUPERVISOR_MAX_RESTARTS = CONFIG["supervisor"]["max_restarts"]
+SUPERVISOR_RESTART_WINDOW = CONFIG["supervisor"]["restart_window"]
+SUPERVISOR_HANG_TIMEOUT = CONFIG["supervisor"]["hang_timeout"]
+SUPERVISOR_CHECK_INTERVAL = CONFIG["supervisor"]["check_interval"]
+
+"""Delay tuner"""
+TUNER_MARGIN = CONFIG["tuner"]["margin"]
+TUNER_MARGIN_FRAMES = CONFIG["tuner"]["margin_frames"]
+TUNER_MAX_CHECK_FRAMES = CONFIG["tuner"]["max_check_frames"]
 
 """Audio"""
 AUDIO_DIR = REPO_ROOT / CONFIG["audio"]["audio_dir"]
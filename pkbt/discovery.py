@@ -0,0 +1,149 @@
+"""Finding which port each emulator's server actually ended up on
+
+Servers listen on the first free port from the starting port on, so which port an emulator ends
+up on depends on the order they started in and on what else holds a port (for example a stale
+emulator from an earlier run). Every server announces its identity to each new connection (see InstanceIdentity),
+and each EmulatorProc passes its own instance ID to the emulator it launches, so scanning the
+likely ports and matching identities binds every emulator to its real server. The ports recorded
+in the instance registry (see state_manager.py) are always scanned as well.
+"""
+
+import time
+import asyncio
+import threading
+from typing import Callable, Iterable, Optional
+from pkbt.config import DISCOVERY_PORT_SLACK, IDENTIFY_TIMEOUT
+from pkbt.emulator import EmulatorProc
+from pkbt.protocol import IDENTIFY_CTRL_CHAR, InstanceIdentity, ReplyDecoder, parse_identity_reply
+from pkbt.state_manager import read_instances
+
+"""Seconds between scans while waiting for instances to come up"""
+SCAN_INTERVAL = 0.25
+
+def candidate_ports(starting_port: int, count: int) -> range:
+    """Ports that count instances assigned from starting_port may be listening on"""
+    return range(starting_port, starting_port + count + DISCOVERY_PORT_SLACK)
+
+def _ports_to_scan(ports: list[int], identified: set[int]) -> list[int]:
+    """The given ports and those in the registry, leaving out ones whose server is already known"""
+    registered = [record.port for record in read_instances()]
+    return [port for port in dict.fromkeys([*ports, *registered]) if port not in identified]
+
+async def identify_async(port: int, host: str = "localhost",
+                         timeout: float = IDENTIFY_TIMEOUT) -> Optional[InstanceIdentity]:
+    """Connect to one port and read the identity its server announces, or None if there is none"""
+    writer = None
+    try:
+        async with asyncio.timeout(timeout):
+            reader, writer = await asyncio.open_connection(host, port)
+            decoder = ReplyDecoder()
+            while data := await reader.read(4096):
+                for reply in decoder.feed(data):
+                    if reply.request_id is None and reply.ctrl == IDENTIFY_CTRL_CHAR:
+                        return parse_identity_reply(reply.payload)
+    except (OSError, TimeoutError, UnicodeDecodeError):
+        pass
+    finally:
+        if writer is not None:
+            writer.close()
+    return None
+
+async def scan_async(ports: Iterable[int], host: str = "localhost",
+                     timeout: float = IDENTIFY_TIMEOUT) -> dict[int, InstanceIdentity]:
+    """Identify the servers on all of the given ports at once, keyed by the port they answered on"""
+    ports = list(ports)
+    identities = await asyncio.gather(*(identify_async(port, host, timeout) for port in ports))
+    return {port: identity for port, identity in zip(ports, identities) if identity is not None}
+
+def scan(ports: Iterable[int], host: str = "localhost",
+         timeout: float = IDENTIFY_TIMEOUT) -> dict[int, InstanceIdentity]:
+    """Blocking form of scan_async, for code that is not running an event loop"""
+    return asyncio.run(scan_async(ports, host, timeout))
+
+class InstanceLocator:
+    """Waits for instances to show up on a range of ports, sharing one scan between all waiters
+
+    Any number of threads can wait for their own instance at the same time; whichever of them is
+    free runs the next scan on behalf of all of them. Ports whose server has been identified are
+    not scanned again.
+    """
+
+    def __init__(self, ports: Iterable[int], host: str = "localhost",
+                 timeout: float = IDENTIFY_TIMEOUT) -> None:
+        self.ports = list(ports)
+        self.host = host
+        self.timeout = timeout
+        self._found: dict[str, InstanceIdentity] = {}
+        self._identified_ports: set[int] = set()
+        self._scanning: bool = False
+        self._last_scan: float = 0.0
+        self._condition = threading.Condition()
+
+    def found(self) -> dict[str, InstanceIdentity]:
+        """Get every identity seen so far, keyed by instance ID"""
+        with self._condition:
+            return dict(self._found)
+
+    def forget(self, instance_id: str) -> None:
+        """Drop an instance that is gone, so its port is scanned again for whoever takes it over"""
+        with self._condition:
+            identity = self._found.pop(instance_id, None)
+            if identity is not None:
+                self._identified_ports.discard(identity.port)
+
+    def wait_for(self, instance_id: str, timeout: float,
+                 alive: Optional[Callable[[], bool]] = None) -> Optional[InstanceIdentity]:
+        """Wait up to timeout seconds for the instance to be found, giving up early if alive() is False"""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while instance_id not in self._found:
+                now = time.monotonic()
+                if now >= deadline or (alive and not alive()):
+                    return None
+                if self._scanning or now - self._last_scan < SCAN_INTERVAL:
+                    self._condition.wait(min(SCAN_INTERVAL, deadline - now))
+                    continue
+                self._scanning = True
+                ports = _ports_to_scan(self.ports, self._identified_ports)
+                self._condition.release()
+                try:
+                    identities = scan(ports, self.host, self.timeout)
+                finally:
+                    self._condition.acquire()
+                    self._scanning = False
+                    self._last_scan = time.monotonic()
+                for port, identity in identities.items():
+                    self._identified_ports.add(port)
+                    self._found[identity.instance_id] = identity
+                self._condition.notify_all()
+            return self._found[instance_id]
+
+async def locate_async(emulators: list[EmulatorProc], ports: Iterable[int], host: str = "localhost",
+                       timeout: float = 30.0) -> list[Optional[InstanceIdentity]]:
+    """Find the server of every emulator, in the same order, waiting up to timeout seconds for them
+
+    Emulators whose server did not show up in time (or whose process exited) get None.
+    """
+    ports = list(ports)
+    found: dict[str, InstanceIdentity] = {}
+    wanted = {e.instance_id for e in emulators}
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    identified: set[int] = set()
+    while True:
+        for port, identity in (await scan_async(_ports_to_scan(ports, identified), host)).items():
+            identified.add(port)
+            found[identity.instance_id] = identity
+        waiting = [e for e in emulators if e.instance_id not in found and e.is_alive()]
+        if not waiting or loop.time() >= deadline:
+            break
+        await asyncio.sleep(SCAN_INTERVAL)
+    missing = wanted - found.keys()
+    if missing:
+        print(f"{len(missing)} of {len(emulators)} instances were not found on ports {ports[0]}-{ports[-1]}")
+    return [found.get(e.instance_id) for e in emulators]
+
+def locate(emulators: list[EmulatorProc], ports: Iterable[int], host: str = "localhost",
+           timeout: float = 30.0) -> list[Optional[InstanceIdentity]]:
+    """Blocking form of locate_async"""
+    return asyncio.run(locate_async(emulators, ports, host, timeout))
@@ -0,0 +1,89 @@
+"""Emulation speed of an instance, worked out from the frame counters its server reports
+
+The server reports its frame counter about once a second (see server.lua), and heartbeat replies
+carry it too. How fast it advances against wall-clock time gives the emulated frames per second,
+and from that the speed as a multiple of real hardware. Instances that are expected to be in
+unbounded fast-forward can then be flagged when they are not.
+"""
+
+import time
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+from pkbt.config import SPEED_WINDOW, THROTTLED_BELOW, STALL_TIMEOUT
+from pkbt.input.input_program import GBA_FRAMES_PER_SECOND
+
+"""Shortest span of reports that a rate is worked out over, in seconds"""
+MIN_SPAN = 0.5
+
+"""What an instance's emulation speed says about it"""
+SPEED_UNKNOWN = "unknown"        # not enough reports yet
+FAST_FORWARD = "fast-forward"
+THROTTLED = "throttled"          # running, but not much faster than real hardware
+PAUSED = "paused"                # still answering heartbeats, but its frame counter stopped
+FROZEN = "frozen"                # neither advancing nor answering
+
+@dataclass
+class SpeedStats:
+    """Snapshot of an instance's emulation speed"""
+    fps: Optional[float]    # emulated frames per wall-clock second
+    speed: Optional[float]  # multiple of real hardware speed
+    frame: Optional[int]    # latest frame counter received
+    stalled_for: float      # seconds since the frame counter last advanced
+    status: str
+
+    def __str__(self) -> str:
+        if self.fps is None:
+            return self.status
+        return f"{self.fps:.0f} fps ({self.speed:.1f}x), {self.status}"
+
+class SpeedMeter:
+    """Turns frame counters received over time into emulation speed
+
+    Thread-safe, so the listening thread can record while anything else reads stats.
+    """
+
+    def __init__(self, window: float = SPEED_WINDOW, throttled_below: float = THROTTLED_BELOW,
+                 stall_timeout: float = STALL_TIMEOUT) -> None:
+        self.window = window
+        self.throttled_below = throttled_below
+        self.stall_timeout = stall_timeout
+        self._samples: deque[tuple[float, int]] = deque()
+        self._progress_at: Optional[float] = None
+        self._answered_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def record(self, frame: int, heartbeat: bool = False) -> None:
+        """Add a frame counter received just now, from a heartbeat reply or a frame report"""
+        now = time.monotonic()
+        with self._lock:
+            if heartbeat:
+                self._answered_at = now
+            if self._samples and frame < self._samples[-1][1]:
+                # The counter went backwards, so earlier samples no longer compare
+                self._samples.clear()
+            if not self._samples or frame > self._samples[-1][1]:
+                self._progress_at = now
+            self._samples.append((now, frame))
+            while len(self._samples) > 2 and now - self._samples[0][0] > self.window:
+                self._samples.popleft()
+
+    def stats(self) -> SpeedStats:
+        now = time.monotonic()
+        with self._lock:
+            if not self._samples:
+                return SpeedStats(None, None, None, 0.0, SPEED_UNKNOWN)
+            (first_at, first_frame), (last_at, last_frame) = self._samples[0], self._samples[-1]
+            progress_at, answered_at = self._progress_at, self._answered_at
+
+        stalled_for = now - progress_at
+        if stalled_for > self.stall_timeout:
+            answering = answered_at is not None and now - answered_at < self.stall_timeout
+            return SpeedStats(0.0, 0.0, last_frame, stalled_for, PAUSED if answering else FROZEN)
+        if last_at - first_at < MIN_SPAN:
+            return SpeedStats(None, None, last_frame, stalled_for, SPEED_UNKNOWN)
+        fps = (last_frame - first_frame) / (last_at - first_at)
+        speed = fps / GBA_FRAMES_PER_SECOND
+        status = THROTTLED if speed < self.throttled_below else FAST_FORWARD
+        return SpeedStats(fps, speed, last_frame, stalled_for, status)
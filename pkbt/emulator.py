@@ -1,12 +1,18 @@
 from pathlib import Path
+import os
+import uuid
 import subprocess
 
+"""Passed to the emulator so its server can tell clients which instance it is (see server.lua)"""
+INSTANCE_ID_ENV_VAR = "PKBT_INSTANCE_ID"
+
 class EmulatorProc:
 
     def __init__(self, exe: Path, rom: Path, scripts: list[Path] | None = None) -> None:
         self.exe = exe
         self.rom = rom
         self.scripts = scripts
+        self.instance_id = uuid.uuid4().hex
 
     def start(self) -> bool:
         """Starts the emulator with (optionally) the given scripts."""
@@ -18,7 +24,7 @@ class EmulatorProc:
             str(self.exe),
             *scripting_args,
             str(self.rom)
-        ])
+        ], env={**os.environ, INSTANCE_ID_ENV_VAR: self.instance_id})
 
         if p is None:
             print("Failed to start emulator")
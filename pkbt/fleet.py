@@ -0,0 +1,191 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, Optional
+from pkbt.config import BOOT_CONCURRENCY, BOOT_TIMEOUT
+from pkbt.discovery import InstanceLocator, candidate_ports
+from pkbt.emulation_speed import FAST_FORWARD, SPEED_UNKNOWN
+from pkbt.input.input_program import GBA_FRAMES_PER_SECOND
+from pkbt.emulator import EmulatorProc
+from pkbt.mgba_connection import MGBAConnection
+from pkbt.orchestrator import Orchestrator
+
+# Do not change, hard-coded in state_manager.lua
+STARTING_PORT = 8888
+
+@dataclass
+class BootRecord:
+    """When one instance of a fleet was launched and became ready, in seconds since the boot began"""
+    index: int
+    port: Optional[int] = None  # where the instance's server turned out to be listening
+    launched: Optional[float] = None
+    ready: Optional[float] = None
+    error: Optional[str] = None
+
+    @property
+    def boot_time(self) -> Optional[float]:
+        """Seconds from launching the emulator to being connected to its server"""
+        if self.launched is None or self.ready is None:
+            return None
+        return self.ready - self.launched
+
+class Fleet:
+    """Boots several emulators at once and connects to each as soon as its server is up
+
+    At most concurrency emulators are starting up at any time. An instance is ready once its
+    socket server has been found and accepts the connection, instead of after a fixed sleep.
+    Servers are found by the identity they announce rather than assumed to be on
+    starting_port + index, since a server moves on to the next port if its own is taken.
+    """
+
+    def __init__(self, exe: Path, rom: Path, scripts: list[Path], size: int,
+                 starting_port: int = STARTING_PORT, concurrency: int = BOOT_CONCURRENCY,
+                 boot_timeout: float = BOOT_TIMEOUT, host: str = "localhost") -> None:
+        self.exe = exe
+        self.rom = rom
+        self.scripts = scripts
+        self.size = size
+        self.starting_port = starting_port
+        self.concurrency = concurrency
+        self.boot_timeout = boot_timeout
+        self.host = host
+        self.orchestrators: list[Orchestrator] = []
+        self.timeline: list[BootRecord] = [BootRecord(i) for i in range(size)]
+        self._locator = InstanceLocator(candidate_ports(starting_port, size), host)
+        self._boot_started: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def boot(self) -> Iterator[Orchestrator]:
+        """Start every instance, yielding each connected orchestrator as soon as it is live
+
+        Orchestrators are yielded in the order they become ready. Instances that fail to start
+        are left out and their error is recorded in the timeline.
+        """
+        self._boot_started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(self._boot_instance, record) for record in self.timeline]
+            for future in as_completed(futures):
+                orchestrator = future.result()
+                if orchestrator is not None:
+                    with self._lock:
+                        self.orchestrators.append(orchestrator)
+                    yield orchestrator
+
+    def boot_all(self) -> list[Orchestrator]:
+        """Start every instance and wait for all of them, returning the ready ones in port order"""
+        for _ in self.boot():
+            pass
+        return sorted(self.orchestrators, key=lambda o: o.client.port)
+
+    def relaunch(self, old: Orchestrator) -> Optional[Orchestrator]:
+        """Replace an instance that failed with a new one running the same ROM and scripts
+
+        The old instance is shut down first. The new one gets its own entry in the timeline, and
+        takes the old one's place among the fleet's orchestrators once it is ready.
+        """
+        old.exit()
+        self._locator.forget(old.emu.instance_id)
+        with self._lock:
+            if old in self.orchestrators:
+                self.orchestrators.remove(old)
+            record = BootRecord(len(self.timeline))
+            self.timeline.append(record)
+        if self._boot_started is None:
+            self._boot_started = time.perf_counter()
+        orchestrator = self._boot_instance(record)
+        if orchestrator is not None:
+            with self._lock:
+                self.orchestrators.append(orchestrator)
+        return orchestrator
+
+    def _elapsed(self) -> float:
+        return time.perf_counter() - self._boot_started
+
+    def _boot_instance(self, record: BootRecord) -> Optional[Orchestrator]:
+        emu = EmulatorProc(self.exe, self.rom, self.scripts)
+        record.launched = self._elapsed()
+        try:
+            started = emu.start()
+        except Exception as e:
+            started = False
+            print(f"Failed to start emulator for instance {record.index}: {e}")
+        if not started:
+            record.error = "emulator failed to start"
+            return None
+
+        identity = self._locator.wait_for(emu.instance_id, self.boot_timeout, alive=emu.is_alive)
+        client = MGBAConnection(self.host, identity.port) if identity else None
+        if not emu.is_alive():
+            record.error = "emulator exited during startup"
+        elif identity is None:
+            record.error = f"server not found after {self.boot_timeout}s"
+        elif not client.connect():
+            record.error = f"server on port {identity.port} not accepting connections"
+        if record.error:
+            print(f"Instance {record.index} did not become ready: {record.error}")
+            emu.stop()
+            return None
+
+        record.port = identity.port
+        record.ready = self._elapsed()
+        # Frame reports are only received while listening, and give the speed from the start
+        client.listen(None)
+        return Orchestrator(emu, client)
+
+    def timeline_report(self) -> str:
+        """Summarize when each instance was launched and became ready"""
+        lines = []
+        for r in self.timeline:
+            if r.error:
+                lines.append(f"  instance {r.index}: failed ({r.error})")
+            elif r.ready is not None:
+                lines.append(f"  instance {r.index} on port {r.port}: launched at {r.launched:6.2f}s, "
+                             f"ready at {r.ready:6.2f}s (booted in {r.boot_time:.2f}s)")
+            else:
+                lines.append(f"  instance {r.index}: not started")
+
+        ready = [r for r in self.timeline if r.ready is not None]
+        if ready:
+            first = min(r.ready for r in ready)
+            last = max(r.ready for r in ready)
+            mean = sum(r.boot_time for r in ready) / len(ready)
+            summary = (f"{len(ready)}/{len(self.timeline)} instances ready in {last:.2f}s "
+                       f"(first after {first:.2f}s, mean boot {mean:.2f}s, concurrency {self.concurrency})")
+        else:
+            summary = f"0/{len(self.timeline)} instances ready"
+        return "\n".join([summary, *lines])
+
+    def print_timeline(self) -> None:
+        print(self.timeline_report())
+
+    def speed_report(self) -> str:
+        """Summarize how fast every instance is emulating, flagging any that are not fast-forwarding"""
+        with self._lock:
+            orchestrators = sorted(self.orchestrators, key=lambda o: o.client.port)
+        stats = [(o, o.client.speed_stats()) for o in orchestrators]
+        total = sum(s.fps for _, s in stats if s.fps is not None)
+        flagged = sum(1 for _, s in stats if s.status not in (FAST_FORWARD, SPEED_UNKNOWN))
+        lines = [f"{total:.0f} emulated fps across {len(stats)} instances "
+                 f"({total / GBA_FRAMES_PER_SECOND:.1f}x real hardware), {flagged} flagged"]
+        for o, s in stats:
+            marker = "    " if s.status in (FAST_FORWARD, SPEED_UNKNOWN) else "  ! "
+            lines.append(f"{marker}port {o.client.port}: {s}")
+        return "\n".join(lines)
+
+    def print_speed_report(self) -> None:
+        print(self.speed_report())
+
+    def exit(self) -> None:
+        """Disconnect from and close every instance"""
+        for o in self.orchestrators:
+            o.exit()
+
+    def __enter__(self):
+        """Context manager entry"""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Context manager exit"""
+        self.exit()
@@ -0,0 +1,242 @@
+"""Decoder for generation 3 (Ruby/Sapphire/Emerald/FireRed/LeafGreen) Pokemon data structures.
+
+Each Pokemon is stored as an 80-byte box structure, extended to 100 bytes in the party with
+battle stats. The 48-byte data block at offset 0x20 holds four 12-byte substructures (Growth,
+Attacks, EVs/Condition, Misc) that are XOR encrypted with PID ^ OTID and shuffled in one of 24
+orders chosen by PID % 24. See https://bulbapedia.bulbagarden.net/wiki/Pok%C3%A9mon_data_structure_(Generation_III)
+
+Species are the game's internal species index, which only matches the National Dex up to #251.
+"""
+
+import struct
+from dataclasses import dataclass
+import numpy as np
+
+"""Structure sizes"""
+BOX_SIZE = 80
+PARTY_SIZE = 100
+PARTY_SLOTS = 6
+
+"""Offsets within the structure"""
+_FLAGS_OFFSET = 0x13
+_CHECKSUM_OFFSET = 0x1C
+_DATA_OFFSET = 0x20
+_DATA_SIZE = 48
+_SUBSTRUCTURE_SIZE = 12
+_LEVEL_OFFSET = 0x54
+
+"""Party addresses (gPlayerParty, gPlayerPartyCount) for supported games, keyed by game code"""
+PARTY_ADDRESSES = {
+    "BPRE": 0x02024284,  # Fire Red
+    "BPGE": 0x02024284,  # Leaf Green
+    "BPEE": 0x020244EC,  # Emerald
+    "AXVE": 0x03004360,  # Ruby
+    "AXPE": 0x03004360,  # Sapphire
+}
+PARTY_COUNT_ADDRESSES = {
+    "BPRE": 0x02024029,
+    "BPGE": 0x02024029,
+    "BPEE": 0x020244E9,
+    "AXVE": 0x03004350,
+    "AXPE": 0x03004350,
+}
+
+"""Bit of the unencrypted flags byte that is set while a Pokemon is an egg, cleared when it hatches"""
+EGG_FLAG = 0x04
+
+NATURES = [
+    "Hardy", "Lonely", "Brave", "Adamant", "Naughty",
+    "Bold", "Docile", "Relaxed", "Impish", "Lax",
+    "Timid", "Hasty", "Serious", "Jolly", "Naive",
+    "Modest", "Mild", "Quiet", "Bashful", "Rash",
+    "Calm", "Gentle", "Sassy", "Careful", "Quirky",
+]
+
+"""Order of the (G)rowth, (A)ttacks, (E)Vs and (M)isc substructures for each value of PID % 24"""
+SUBSTRUCTURE_ORDERS = [
+    "GAEM", "GAME", "GEAM", "GEMA", "GMAE", "GMEA",
+    "AGEM", "AGME", "AEGM", "AEMG", "AMGE", "AMEG",
+    "EGAM", "EGMA", "EAGM", "EAMG", "EMGA", "EMAG",
+    "MGAE", "MGEA", "MAGE", "MAEG", "MEGA", "MEAG",
+]
+
+"""Position of the G, A, E and M substructures in the data block, for each value of PID % 24"""
+_SUBSTRUCTURE_POSITIONS = np.array(
+    [[order.index(s) for s in "GAEM"] for order in SUBSTRUCTURE_ORDERS], dtype=np.intp)
+
+"""Bit offsets of the HP, Attack, Defense, Speed, Sp. Attack and Sp. Defense IVs in the IV word"""
+_IV_SHIFTS = np.array([0, 5, 10, 15, 20, 25], dtype=np.uint32)
+
+def party_address(game_code: str, slot: int = 0) -> int:
+    """Address of a party slot's structure (0-based), for a game code such as "BPRE" (mGBA reports "AGB-BPRE")"""
+    code = game_code[-4:]
+    if code not in PARTY_ADDRESSES:
+        raise ValueError(f"No party address for game {game_code!r}, expected one of {list(PARTY_ADDRESSES)}")
+    if not 0 <= slot < PARTY_SLOTS:
+        raise ValueError(f"Invalid party slot {slot}")
+    return PARTY_ADDRESSES[code] + slot * PARTY_SIZE
+
+def egg_flag_address(game_code: str, slot: int) -> int:
+    """Address of the flags byte holding EGG_FLAG for a party slot (0-based), readable without
+    decrypting anything
+    """
+    return party_address(game_code, slot) + _FLAGS_OFFSET
+
+def nature_of(pid: int) -> str:
+    """Nature determined by a PID"""
+    return NATURES[pid % 25]
+
+def is_shiny(pid: int, otid: int) -> bool:
+    """Whether a PID is shiny for the given trainer (TID in the low half of OTID, SID in the high half)"""
+    return ((otid & 0xFFFF) ^ (otid >> 16) ^ (pid & 0xFFFF) ^ (pid >> 16)) < 8
+
+def decrypt_data(data: bytes) -> bytes:
+    """Decrypt the 48-byte substructure block of an 80 or 100-byte structure (order left as stored)"""
+    pid, otid = struct.unpack_from("<II", data, 0)
+    key = pid ^ otid
+    words = struct.unpack_from("<12I", data, _DATA_OFFSET)
+    return struct.pack("<12I", *(w ^ key for w in words))
+
+@dataclass(frozen=True)
+class Gen3Pokemon:
+    pid: int
+    otid: int
+    species: int
+    held_item: int
+    experience: int
+    friendship: int
+    moves: tuple[int, int, int, int]
+    evs: tuple[int, int, int, int, int, int]
+    ivs: tuple[int, int, int, int, int, int]
+    is_egg: bool
+    ability_bit: int
+    checksum_valid: bool
+    level: int | None = None  # Only stored in the party structure
+
+    @property
+    def tid(self) -> int:
+        return self.otid & 0xFFFF
+
+    @property
+    def sid(self) -> int:
+        return self.otid >> 16
+
+    @property
+    def nature(self) -> str:
+        return nature_of(self.pid)
+
+    @property
+    def is_shiny(self) -> bool:
+        return is_shiny(self.pid, self.otid)
+
+    @property
+    def is_empty(self) -> bool:
+        """Empty party/box slots are all zeroes"""
+        return self.species == 0
+
+def decode(data: bytes) -> Gen3Pokemon:
+    """Decode a single 80-byte box or 100-byte party structure"""
+    if len(data) not in (BOX_SIZE, PARTY_SIZE):
+        raise ValueError(f"Expected {BOX_SIZE} or {PARTY_SIZE} bytes, got {len(data)}")
+
+    pid, otid = struct.unpack_from("<II", data, 0)
+    (checksum,) = struct.unpack_from("<H", data, _CHECKSUM_OFFSET)
+    decrypted = decrypt_data(data)
+    checksum_valid = sum(struct.unpack("<24H", decrypted)) & 0xFFFF == checksum
+
+    def substructure(name: str) -> bytes:
+        offset = SUBSTRUCTURE_ORDERS[pid % 24].index(name) * _SUBSTRUCTURE_SIZE
+        return decrypted[offset:offset + _SUBSTRUCTURE_SIZE]
+
+    species, held_item, experience, _, friendship = struct.unpack_from("<HHIBB", substructure("G"))
+    moves = struct.unpack_from("<4H", substructure("A"))
+    evs = struct.unpack_from("<6B", substructure("E"))
+    (iv_word,) = struct.unpack_from("<I", substructure("M"), 4)
+    ivs = tuple((iv_word >> int(shift)) & 0x1F for shift in _IV_SHIFTS)
+
+    return Gen3Pokemon(
+        pid=pid,
+        otid=otid,
+        species=species,
+        held_item=held_item,
+        experience=experience,
+        friendship=friendship,
+        moves=moves,
+        evs=evs,
+        ivs=ivs,
+        is_egg=bool((iv_word >> 30) & 1),
+        ability_bit=(iv_word >> 31) & 1,
+        checksum_valid=checksum_valid,
+        level=data[_LEVEL_OFFSET] if len(data) == PARTY_SIZE else None,
+    )
+
+def decode_party(data: bytes) -> list[Gen3Pokemon]:
+    """Decode a party (up to six 100-byte structures), skipping empty slots"""
+    if len(data) % PARTY_SIZE:
+        raise ValueError(f"Party data must be a multiple of {PARTY_SIZE} bytes, got {len(data)}")
+    party = [decode(data[i:i + PARTY_SIZE]) for i in range(0, len(data), PARTY_SIZE)]
+    return [p for p in party if not p.is_empty]
+
+@dataclass(frozen=True)
+class Gen3Batch:
+    """Columns decoded from many structures at once, one row per structure"""
+    pid: np.ndarray             # uint32 (N,)
+    otid: np.ndarray            # uint32 (N,)
+    species: np.ndarray         # uint32 (N,)
+    ivs: np.ndarray             # uint32 (N, 6)
+    nature: np.ndarray          # uint32 (N,), index into NATURES
+    is_egg: np.ndarray          # bool (N,)
+    is_shiny: np.ndarray        # bool (N,)
+    checksum_valid: np.ndarray  # bool (N,)
+
+    @property
+    def is_empty(self) -> np.ndarray:
+        return self.species == 0
+
+    def __len__(self) -> int:
+        return len(self.pid)
+
+def decode_batch(data: bytes | np.ndarray, stride: int = PARTY_SIZE) -> Gen3Batch:
+    """Decode many consecutive structures (e.g. a whole party or PC box dump) with NumPy
+
+    `stride` is the size of each structure: PARTY_SIZE for party data, BOX_SIZE for PC boxes.
+    """
+    if stride not in (BOX_SIZE, PARTY_SIZE):
+        raise ValueError(f"Stride must be {BOX_SIZE} or {PARTY_SIZE}, got {stride}")
+    raw = np.frombuffer(data, dtype=np.uint8) if not isinstance(data, np.ndarray) else data.astype(np.uint8, copy=False)
+    if raw.size % stride:
+        raise ValueError(f"Data must be a multiple of {stride} bytes, got {raw.size}")
+
+    # Only the shared 80-byte box part is needed; view it as little-endian 32-bit words
+    structs = raw.reshape(-1, stride)
+    words = np.ascontiguousarray(structs[:, :BOX_SIZE]).view("<u4").astype(np.uint32)
+    pid = words[:, 0]
+    otid = words[:, 1]
+    checksum = words[:, _CHECKSUM_OFFSET // 4] & 0xFFFF
+
+    first_word = _DATA_OFFSET // 4
+    decrypted = words[:, first_word:first_word + _DATA_SIZE // 4] ^ (pid ^ otid)[:, None]
+    halves = np.stack([decrypted & 0xFFFF, decrypted >> 16], axis=-1).reshape(len(pid), -1)
+    checksum_valid = (halves.sum(axis=1, dtype=np.uint64) & 0xFFFF) == checksum
+
+    # Gather the growth and misc substructures according to each row's shuffle order
+    rows = np.arange(len(pid))
+    substructures = decrypted.reshape(len(pid), 4, _SUBSTRUCTURE_SIZE // 4)
+    positions = _SUBSTRUCTURE_POSITIONS[pid % 24]
+    growth = substructures[rows, positions[:, 0]]
+    misc = substructures[rows, positions[:, 3]]
+
+    iv_word = misc[:, 1]
+    tsv = (otid & 0xFFFF) ^ (otid >> 16)
+    psv = (pid & 0xFFFF) ^ (pid >> 16)
+
+    return Gen3Batch(
+        pid=pid,
+        otid=otid,
+        species=growth[:, 0] & 0xFFFF,
+        ivs=(iv_word[:, None] >> _IV_SHIFTS) & 0x1F,
+        nature=pid % 25,
+        is_egg=((iv_word >> 30) & 1).astype(bool),
+        is_shiny=(tsv ^ psv) < 8,
+        checksum_valid=checksum_valid,
+    )
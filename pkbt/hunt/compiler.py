@@ -0,0 +1,94 @@
+"""Turns the steps of a hunt spec (see spec.py) into input programs
+
+A whole cycle, from the soft reset to the checked screen, becomes one program that the server
+plays back on its frame callback, instead of one message and one sleep per key event. Repeats are
+unrolled, and consecutive steps with the same key state are merged as they are appended (see
+InputProgram), so back-to-back waits, jitter and stagger become a single wait, and a hold
+followed by a hold of the same keys becomes one longer hold.
+
+Hatch steps stop as soon as an egg hatches, so a cycle with them is played in segments (see
+compile_cycle_segments): programs, and the hatch steps between them, which hatching.py plays.
+"""
+
+import random
+from pkbt.config import DEFAULT_PUSH_FRAMES
+from pkbt.input.key_type import KeyType
+from pkbt.input.input_program import InputProgram
+from pkbt.protocol import Command, memory_condition
+from pkbt.gamedata.gen3 import EGG_FLAG, egg_flag_address
+from pkbt.hunt.spec import HuntSpec, Step, Press, Hold, Wait, Jitter, Stagger, Repeat, Macro, Hatch
+
+"""Frames released between two presses, so the game doesn't see one long press"""
+MIN_RELEASE_FRAMES = 1
+
+def compile_steps(steps: list[Step], slot: int = 0, rng: random.Random | None = None,
+                  program: InputProgram | None = None) -> InputProgram:
+    """Append steps to a program (a new one by default)
+
+    slot is the index of the instance the program is for, used by stagger steps, and rng the
+    source of jitter.
+    """
+    program = InputProgram() if program is None else program
+    rng = rng or random
+    for step in steps:
+        match step:
+            case Press(keys, times, frames, wait):
+                for _ in range(times):
+                    program.hold(keys, frames).wait(max(wait, MIN_RELEASE_FRAMES))
+            case Hold(keys, frames):
+                program.hold(keys, frames)
+            case Wait(frames):
+                program.wait(frames)
+            case Jitter(frames):
+                program.wait(rng.randint(0, frames))
+            case Stagger(frames):
+                program.wait(frames * slot)
+            case Repeat(times, inner):
+                for _ in range(times):
+                    compile_steps(inner, slot, rng, program)
+            case Macro(_, macro):
+                program.extend(macro)
+            case Hatch(after=after):
+                # The whole walk, for programs that can't stop early
+                program.extend(compile_hatch_walk(step))
+                compile_steps(after, slot, rng, program)
+    return program
+
+def compile_hatch_walk(step: Hatch) -> InputProgram:
+    """Pace left and right, tapping B as each way starts: a hatch begins with an "Oh?" that waits
+    for a button before the egg hatches
+
+    B isn't free everywhere: on foot it runs with the Running Shoes, and on Emerald's Acro Bike it
+    pops a wheelie. The hatch specs ride the Fire Red bike, where it does nothing. Walks on foot
+    cover more ground than their frames suggest, and the Acro Bike should not be used.
+    """
+    program = InputProgram()
+    tap = min(DEFAULT_PUSH_FRAMES, step.frames)
+    for _ in range(step.times):
+        for key in (KeyType.LEFT, KeyType.RIGHT):
+            program.hold([key, KeyType.B], tap).hold(key, step.frames - tap)
+    return program
+
+def hatch_conditions(game_code: str, slots: list[int]) -> list[Command]:
+    """Conditions that hold once the egg in any of the party slots (from 1) has hatched"""
+    return [memory_condition(egg_flag_address(game_code, slot - 1), 0, mask=EGG_FLAG) for slot in slots]
+
+def compile_cycle(spec: HuntSpec, slot: int = 0, rng: random.Random | None = None) -> InputProgram:
+    """Compile everything played after a soft reset, up to the screen that is checked"""
+    program = compile_steps(spec.reset, slot, rng)
+    return compile_steps(spec.encounter, slot, rng, program)
+
+def compile_cycle_segments(spec: HuntSpec, slot: int = 0,
+                           rng: random.Random | None = None) -> list[InputProgram | Hatch]:
+    """Compile a cycle as compile_cycle does, split around its hatch steps"""
+    segments: list[InputProgram | Hatch] = [InputProgram()]
+    for step in [*spec.reset, *spec.encounter]:
+        if isinstance(step, Hatch):
+            segments += [step, InputProgram()]
+        else:
+            compile_steps([step], slot, rng, segments[-1])
+    return [segment for segment in segments if isinstance(segment, Hatch) or len(segment)]
+
+def compile_success(spec: HuntSpec) -> InputProgram:
+    """Compile the steps played once a shiny is found"""
+    return compile_steps(spec.success)
@@ -0,0 +1,55 @@
+"""Plays the hatch steps of a hunt (see spec.py), and reads the party they hatch into
+
+Eggs and the Pokemon that hatch from them are read straight from the party in memory, all six
+slots in one read, so a batch of eggs needs no summary screen per egg. Walking is left to the
+server, which stops on the frame an egg hatches (see MGBAConnection.run_program_until).
+"""
+
+import random
+from typing import Optional
+from pkbt.mgba_connection import MGBAConnection
+from pkbt.gamedata.gen3 import Gen3Batch, PARTY_SIZE, PARTY_SLOTS, NATURES, party_address, decode_batch
+from pkbt.hunt.spec import Hatch
+from pkbt.hunt.compiler import compile_steps, compile_hatch_walk, hatch_conditions
+
+def read_party(client: MGBAConnection, game_code: str) -> Optional[Gen3Batch]:
+    """Decode all six party slots, read in a single request"""
+    data = client.read_memory(party_address(game_code), PARTY_SIZE * PARTY_SLOTS)
+    return decode_batch(data) if data is not None else None
+
+def egg_slots(party: Gen3Batch, slots: list[int]) -> list[int]:
+    """Which of the party slots (from 1) hold an egg"""
+    return [slot for slot in slots if party.is_egg[slot - 1] and party.checksum_valid[slot - 1]]
+
+def shiny_slots(party: Gen3Batch, slots: list[int]) -> list[int]:
+    """Which of the party slots (from 1) hold a shiny Pokemon or egg"""
+    return [slot for slot in slots
+            if not party.is_empty[slot - 1] and party.checksum_valid[slot - 1] and party.is_shiny[slot - 1]]
+
+def describe_slot(party: Gen3Batch, slot: int) -> str:
+    i = slot - 1
+    ivs = "/".join(str(iv) for iv in party.ivs[i])
+    egg = " (egg)" if party.is_egg[i] else ""
+    return f"slot {slot}: species {party.species[i]}{egg}, {NATURES[party.nature[i]]}, IVs {ivs}"
+
+def hatch_eggs(client: MGBAConnection, step: Hatch, game_code: str, slot: int = 0,
+               rng: random.Random | None = None) -> bool:
+    """Walk until every egg in the step's slots has hatched, playing its after steps after each
+
+    Returns False if an egg didn't hatch within the step's walk, or the instance stopped responding.
+    slot and rng are used by the after steps, as in compile_steps.
+    """
+    walk = compile_hatch_walk(step)
+    after = compile_steps(step.after, slot, rng)
+    while True:
+        party = read_party(client, game_code)
+        if party is None:
+            return False
+        eggs = egg_slots(party, step.slots)
+        if not eggs:
+            return True
+        if client.run_program_until(walk, hatch_conditions(game_code, eggs)) is None:
+            print(f"No egg in party slots {eggs} hatched within {walk.total_frames} frames of walking")
+            return False
+        if len(after) and not client.run_program(after):
+            return False
@@ -0,0 +1,80 @@
+"""Tuned timings of a hunt, found by the delay tuner (see tuner.py) and loaded by the hunt runners
+
+A profile belongs to one spec and one game, and lives in profiles/ next to the spec, named after
+it. It holds the wait after individual presses, keyed by "phase.step.press": "reset.1.3" is the
+third press of the first step of [reset]. Presses it doesn't list keep the spec's wait.
+"""
+
+import time
+import tomllib
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import Optional
+from pkbt.hunt.spec import HuntSpec, Step, Press
+
+"""Phases whose presses are tuned, in the order they are played"""
+TUNED_PHASES = ("reset", "encounter")
+
+@dataclass
+class TuningProfile:
+    spec: str                   # name of the spec it was tuned for
+    game_code: str              # game it was tuned on, e.g. "AGB-BPRE"
+    waits: dict[str, int] = field(default_factory=dict)
+    tuned_at: int = 0           # Unix time
+
+def press_id(phase: str, step: int, press: int) -> str:
+    """Key of one press in a profile, from its 0-based step and press indices"""
+    return f"{phase}.{step + 1}.{press + 1}"
+
+def profile_path(spec: HuntSpec) -> Path:
+    if spec.path is None:
+        raise ValueError(f"Hunt spec {spec.name!r} was not loaded from a file, so has no profile path")
+    return spec.path.parent / "profiles" / f"{spec.path.stem}.toml"
+
+def load_profile(spec: HuntSpec) -> Optional[TuningProfile]:
+    """Read the spec's profile, if it has been tuned"""
+    path = profile_path(spec)
+    if not path.exists():
+        return None
+    try:
+        with path.open("rb") as f:
+            raw = tomllib.load(f)
+        waits = {str(k): int(v) for k, v in raw.get("waits", {}).items()}
+        return TuningProfile(str(raw["spec"]), str(raw["game_code"]), waits, int(raw.get("tuned_at", 0)))
+    except (OSError, tomllib.TOMLDecodeError, KeyError, TypeError, ValueError) as e:
+        print(f"Ignoring invalid tuning profile {path}: {e}")
+        return None
+
+def save_profile(spec: HuntSpec, profile: TuningProfile) -> Path:
+    path = profile_path(spec)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(profile.tuned_at))
+    lines = [
+        f"# Tuned by the delay tuner on {when}, see pkbt/hunt/tuner.py",
+        f"spec = \"{profile.spec}\"",
+        f"game_code = \"{profile.game_code}\"",
+        f"tuned_at = {profile.tuned_at}",
+        "",
+        "[waits]",
+        *(f"\"{key}\" = {wait}" for key, wait in profile.waits.items()),
+    ]
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return path
+
+def _apply(phase: str, steps: list[Step], waits: dict[str, int]) -> list[Step]:
+    applied: list[Step] = []
+    for i, step in enumerate(steps):
+        if not isinstance(step, Press):
+            applied.append(step)
+            continue
+        # Each press of a repeated press may have its own wait
+        for k in range(step.times):
+            wait = waits.get(press_id(phase, i, k), step.wait)
+            applied.append(replace(step, times=1, wait=wait))
+    return applied
+
+def apply_profile(spec: HuntSpec, profile: TuningProfile) -> HuntSpec:
+    """Get a copy of the spec with the profile's waits"""
+    if profile.spec != spec.name:
+        print(f"Tuning profile was made for {profile.spec!r}, not {spec.name!r}")
+    return replace(spec, **{phase: _apply(phase, getattr(spec, phase), profile.waits) for phase in TUNED_PHASES})
@@ -0,0 +1,104 @@
+import time
+import random
+import threading
+from typing import Optional
+from pkbt.orchestrator import Orchestrator
+from pkbt.fleet import Fleet
+from pkbt.supervisor import Supervisor
+from pkbt.hunt.spec import HuntSpec, ShinyCheck, Hatch
+from pkbt.hunt.compiler import compile_cycle_segments, compile_success
+from pkbt.hunt.hatching import hatch_eggs, read_party, shiny_slots, describe_slot
+from pkbt.audio import play_success
+
+"""Seconds an instance waits before trying again, while reconnecting or after a failed cycle"""
+RETRY_INTERVAL = 0.5
+
+class HuntRunner:
+    """Runs a hunt spec on every instance of a fleet until a shiny is found
+
+    Each cycle soft-resets the game, plays the whole cycle as one input program, then probes the
+    checked pixel, or reads the checked party slots from memory, reporting every shiny among them.
+    Hatch steps split the cycle, their walks stopping on the frame an egg hatches. Instances are
+    supervised (see Supervisor), so one that crashes or hangs is replaced and picks the hunt up
+    again.
+    """
+
+    def __init__(self, spec: HuntSpec) -> None:
+        self.spec = spec
+        self.runs = 0
+        self.found = threading.Event()
+        self._lock = threading.Lock()
+
+    def task(self, o: Orchestrator, idx: int) -> None:
+        """Hunt on one instance (the task handed to the supervisor)"""
+        spec = self.spec
+        rng = random.Random()
+        o.client.connect()
+
+        while not (spec.stop_fleet and self.found.is_set()):
+            if not o.is_healthy():
+                print(f"Orchestrator {idx} is unhealthy, handing it back to the supervisor")
+                return
+
+            # Nothing can be sent until the connection is back
+            if o.client.reconnecting or not o.client.reset_game():
+                time.sleep(RETRY_INTERVAL)
+                continue
+
+            with self._lock:
+                self.runs += 1
+                runs = self.runs
+            if idx == 0:
+                print(f"Runs: {runs}")
+
+            if not self._play_cycle(o, idx, rng):
+                time.sleep(RETRY_INTERVAL)
+                continue
+            if self._found_shiny(o, idx):
+                self._on_shiny(o, idx, runs)
+                return
+
+    @staticmethod
+    def _game_code(o: Orchestrator) -> Optional[str]:
+        identity = o.client.identity or o.client.identify()
+        return identity.game_code if identity is not None else None
+
+    def _play_cycle(self, o: Orchestrator, idx: int, rng: random.Random) -> bool:
+        for segment in compile_cycle_segments(self.spec, idx, rng):
+            if isinstance(segment, Hatch):
+                game_code = self._game_code(o)
+                if game_code is None or not hatch_eggs(o.client, segment, game_code, idx, rng):
+                    return False
+            elif not o.client.run_program(segment):
+                return False
+        return True
+
+    def _found_shiny(self, o: Orchestrator, idx: int) -> bool:
+        check = self.spec.check
+        if isinstance(check, ShinyCheck):
+            colors = o.client.probe([check.pixel])
+            return check.is_shiny(colors[0] if colors else None)
+
+        game_code = self._game_code(o)
+        party = read_party(o.client, game_code) if game_code is not None else None
+        if party is None:
+            return False
+        shinies = shiny_slots(party, check.slots)
+        for slot in shinies:
+            print(f"Shiny on {idx} in party {describe_slot(party, slot)}")
+        return bool(shinies)
+
+    def _on_shiny(self, o: Orchestrator, idx: int, runs: int) -> None:
+        self.found.set()
+        print(f"Shiny found on {idx}")
+        if self.spec.screenshot:
+            o.client.save_screenshot_to_file(f"found-at-runs-{runs}.png")
+        play_success(blocking=True)
+        if self.spec.success:
+            o.client.run_program(compile_success(self.spec))
+
+    def run(self, fleet: Fleet, orchestrators: list[Orchestrator]) -> None:
+        """Hunt on the given instances of the fleet until a shiny is found (or every instance has
+        been retired)
+        """
+        Supervisor(fleet, self.task).run(orchestrators)
@@ -0,0 +1,257 @@
+"""Hunt specifications: what a shiny hunt does each cycle, written as TOML instead of a script
+
+A spec has these tables:
+
+- [hunt]: name, rom (a key of [roms] in config.toml), instances, and the defaults wait (frames
+  after each press) and press (frames each press is held)
+- [reset]: steps played right after soft-resetting the game, up to where the save is loaded
+- [encounter]: steps from there until the screen that is checked
+- [check]: the pixel that is checked, and either the shiny_color it has on a shiny or the
+  normal_color it has on anything else. Or instead, the party slots whose Pokemon are read from
+  memory, e.g. party = [2, 3, 4, 5, 6] or party = "all", which finds every shiny among them.
+- [success]: steps played once a shiny is found (e.g. saving the game), whether to take a
+  screenshot first, and whether to stop_fleet or only the instance that found it
+- [tune] (optional): the regions, [x, y, w, h], that the delay tuner compares to tell whether a
+  step worked (see tuner.py). Leave out animated parts of the screen. The whole screen by default.
+
+Steps are a list. A key name such as "A" is a press followed by the default wait, and tables give
+more control:
+
+    { press = "A", times = 4, wait = 60, frames = 3 }   press one or more keys ("A+B"), maybe repeatedly
+    { hold = "LEFT", frames = 18 }                      hold keys down, with no wait after
+    { wait = 30 }                                       release everything
+    { jitter = 180 }                                    release everything for a random 0-180 frames
+    { stagger = 15 }                                    release everything for 15 frames per instance index
+    { repeat = 285, steps = [...] }                     play the inner steps several times
+    { macro = "macros/walk.txt" }                       play a recorded macro file, relative to the spec (see macro.py)
+    { hatch = 2, frames = 80, times = 250 }             pace left and right until the egg in party slot 2 hatches
+    { hatch = "all", frames = 80, times = 250, after = [...] }   hatch every egg in the party, one after another
+
+Durations are frames, or seconds at 1x speed written as a string like "0.5s". See compiler.py for
+how steps become input programs.
+
+A hatch step walks frames each way, at most times times per egg, and stops on the frame an egg
+hatches, which is read from memory by the server. With several slots, e.g. hatch = [2, 3] or
+"all", it plays the after steps once each egg has hatched (getting through the hatching screens),
+then walks on until the next one hatches, until none of the slots holds an egg (see hatching.py).
+Hatch steps can't be repeated, and only stop early in [reset] and [encounter].
+"""
+
+import tomllib
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional, Any
+from pkbt.config import ROMS, DEFAULT_PUSH_FRAMES
+from pkbt.input.key_type import KeyType
+from pkbt.input.input_program import InputProgram, frames_from_seconds
+from pkbt.input.macro import load_macro
+from pkbt.image_processing import SCREEN_WIDTH, SCREEN_HEIGHT, hex_color
+from pkbt.gamedata.gen3 import PARTY_SLOTS
+
+"""Defaults for specs that leave them out"""
+DEFAULT_WAIT_FRAMES = 120
+DEFAULT_INSTANCES = 1
+FULL_SCREEN = (0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)
+
+@dataclass
+class Press:
+    keys: list[KeyType]
+    times: int
+    frames: int      # held for
+    wait: int        # released for, after each press
+
+@dataclass
+class Hold:
+    keys: list[KeyType]
+    frames: int
+
+@dataclass
+class Wait:
+    frames: int
+
+@dataclass
+class Jitter:
+    frames: int      # most frames waited
+
+@dataclass
+class Stagger:
+    frames: int      # per instance index
+
+@dataclass
+class Repeat:
+    times: int
+    steps: list["Step"]
+
+@dataclass
+class Macro:
+    path: Path
+    program: InputProgram
+
+@dataclass
+class Hatch:
+    slots: list[int]  # party slots of the eggs, from 1
+    frames: int       # each way
+    times: int        # most walks there and back, per egg
+    after: list["Step"] = field(default_factory=list)  # played after each egg hatches
+
+Step = Press | Hold | Wait | Jitter | Stagger | Repeat | Macro | Hatch
+
+@dataclass
+class ShinyCheck:
+    """One pixel of the checked screen, compared against the color it has on a shiny or on anything else"""
+    pixel: tuple[int, int]
+    color: int
+    shiny_if_equal: bool
+
+    def is_shiny(self, color: Optional[int]) -> bool:
+        # A failed probe is not evidence of a shiny
+        if color is None:
+            return False
+        return (color == self.color) == self.shiny_if_equal
+
+@dataclass
+class PartyCheck:
+    """Party slots read from memory in one go, any shiny Pokemon (or egg) among them being a find"""
+    slots: list[int]  # from 1
+
+@dataclass
+class HuntSpec:
+    name: str
+    rom: Path
+    instances: int
+    reset: list[Step]
+    encounter: list[Step]
+    check: ShinyCheck | PartyCheck
+    success: list[Step] = field(default_factory=list)
+    screenshot: bool = True
+    stop_fleet: bool = True
+    tune_regions: list[tuple[int, int, int, int]] = field(default_factory=lambda: [FULL_SCREEN])
+    path: Optional[Path] = None
+
+def _frames(value: Any, where: str) -> int:
+    if isinstance(value, str) and value.endswith("s"):
+        try:
+            return frames_from_seconds(float(value[:-1]))
+        except ValueError:
+            pass
+    if isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+        return value
+    raise ValueError(f"{where}: expected a number of frames or seconds like \"0.5s\", got {value!r}")
+
+def _keys(value: Any, where: str) -> list[KeyType]:
+    try:
+        return [KeyType[name.strip().upper()] for name in str(value).split("+")]
+    except KeyError:
+        raise ValueError(f"{where}: unknown key in {value!r}, expected one of {[k.name for k in KeyType]}") from None
+
+def _count(value: Any, where: str) -> int:
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+        raise ValueError(f"{where}: expected a positive count, got {value!r}")
+    return value
+
+def _slots(value: Any, where: str) -> list[int]:
+    if value == "all":
+        return list(range(1, PARTY_SLOTS + 1))
+    slots = value if isinstance(value, list) else [value]
+    if not slots or not all(isinstance(v, int) and not isinstance(v, bool) and 1 <= v <= PARTY_SLOTS for v in slots):
+        raise ValueError(f"{where}: expected \"all\" or party slots from 1 to {PARTY_SLOTS}, got {value!r}")
+    return slots
+
+def _parse_step(raw: Any, defaults: dict[str, int], base: Path, where: str) -> Step:
+    if isinstance(raw, str):
+        raw = {"press": raw}
+    if not isinstance(raw, dict):
+        raise ValueError(f"{where}: expected a key name or a table, got {raw!r}")
+    if "press" in raw:
+        return Press(_keys(raw["press"], where), _count(raw.get("times", 1), where),
+                     _frames(raw.get("frames", defaults["press"]), where),
+                     _frames(raw.get("wait", defaults["wait"]), where))
+    if "hold" in raw:
+        return Hold(_keys(raw["hold"], where), _frames(raw.get("frames"), where))
+    if "repeat" in raw:
+        inner = _parse_steps(raw.get("steps"), defaults, base, where)
+        if any(isinstance(step, Hatch) for step in inner):
+            raise ValueError(f"{where}: hatch steps can't be repeated, give them more times instead")
+        return Repeat(_count(raw["repeat"], where), inner)
+    if "hatch" in raw:
+        after = _parse_steps(raw.get("after"), defaults, base, f"{where} after")
+        if any(isinstance(step, Hatch) for step in after):
+            raise ValueError(f"{where}: hatch steps can't be nested")
+        return Hatch(_slots(raw["hatch"], where), _frames(raw.get("frames"), where),
+                     _count(raw.get("times"), where), after)
+    if "macro" in raw:
+        path = base / str(raw["macro"])
+        try:
+            return Macro(path, load_macro(path))
+        except OSError as e:
+            raise ValueError(f"{where}: cannot read macro {path}: {e}") from None
+    for kind in (Wait, Jitter, Stagger):
+        name = kind.__name__.lower()
+        if name in raw:
+            return kind(_frames(raw[name], where))
+    raise ValueError(f"{where}: unknown step {raw!r}")
+
+def _parse_steps(raw: Any, defaults: dict[str, int], base: Path, where: str) -> list[Step]:
+    if raw is None:
+        return []
+    if not isinstance(raw, list):
+        raise ValueError(f"{where}: steps must be a list")
+    return [_parse_step(step, defaults, base, f"{where} step {i + 1}") for i, step in enumerate(raw)]
+
+def _parse_check(raw: dict) -> ShinyCheck | PartyCheck:
+    if "party" in raw:
+        return PartyCheck(_slots(raw["party"], "[check] party"))
+    pixel = raw.get("pixel")
+    if not (isinstance(pixel, list) and len(pixel) == 2 and all(isinstance(v, int) for v in pixel)):
+        raise ValueError(f"[check]: pixel must be [x, y] (or give party slots instead), got {pixel!r}")
+    if ("shiny_color" in raw) == ("normal_color" in raw):
+        raise ValueError("[check]: give exactly one of shiny_color and normal_color")
+    shiny = "shiny_color" in raw
+    color = raw["shiny_color" if shiny else "normal_color"]
+    try:
+        color = hex_color(color) if isinstance(color, str) else int(color)
+    except ValueError:
+        raise ValueError(f"[check]: invalid color {color!r}") from None
+    return ShinyCheck((pixel[0], pixel[1]), color, shiny)
+
+def _parse_regions(raw: Any) -> list[tuple[int, int, int, int]]:
+    if not isinstance(raw, list) or not raw:
+        raise ValueError(f"[tune]: regions must be a list of [x, y, w, h], got {raw!r}")
+    regions = []
+    for region in raw:
+        if not (isinstance(region, list) and len(region) == 4 and all(isinstance(v, int) for v in region)):
+            raise ValueError(f"[tune]: regions must be [x, y, w, h], got {region!r}")
+        regions.append((region[0], region[1], region[2], region[3]))
+    return regions
+
+def load_hunt_spec(path: Path | str) -> HuntSpec:
+    """Read and validate a hunt spec, raising ValueError with where it went wrong"""
+    path = Path(path)
+    with path.open("rb") as f:
+        raw = tomllib.load(f)
+
+    hunt = raw.get("hunt", {})
+    rom = hunt.get("rom")
+    if rom not in ROMS:
+        raise ValueError(f"[hunt]: rom must be one of {list(ROMS)}, got {rom!r}")
+    defaults = {
+        "wait": _frames(hunt.get("wait", DEFAULT_WAIT_FRAMES), "[hunt] wait"),
+        "press": _frames(hunt.get("press", DEFAULT_PUSH_FRAMES), "[hunt] press"),
+    }
+    if "check" not in raw:
+        raise ValueError("Missing [check]")
+    success = raw.get("success", {})
+    tune = raw.get("tune", {})
+    return HuntSpec(
+        name=str(hunt.get("name", path.stem)),
+        rom=ROMS[rom],
+        instances=_count(hunt.get("instances", DEFAULT_INSTANCES), "[hunt] instances"),
+        reset=_parse_steps(raw.get("reset", {}).get("steps"), defaults, path.parent, "[reset]"),
+        encounter=_parse_steps(raw.get("encounter", {}).get("steps"), defaults, path.parent, "[encounter]"),
+        check=_parse_check(raw["check"]),
+        success=_parse_steps(success.get("steps"), defaults, path.parent, "[success]"),
+        screenshot=bool(success.get("screenshot", True)),
+        stop_fleet=bool(success.get("stop_fleet", True)),
+        tune_regions=_parse_regions(tune.get("regions", [list(FULL_SCREEN)])),
+        path=path,
+    )
@@ -0,0 +1,169 @@
+"""Finds the shortest safe wait after every press of a hunt, instead of a padded guess
+
+The tuner plays a hunt's cycle once on a single instance, and stops at every press to search for
+its shortest wait. A wait is good enough when the game ends up in the same state as with the spec's
+wait once the following step has also been played, because a press the game was not ready for is
+dropped and shows up there. The state is compared through region hashes and the checked pixel
+(see HuntSpec.tune_regions), so animated parts of the screen must be left out of the regions.
+The following steps, up to the next one that presses a key, are played with the spec's timing,
+and the comparison is padded to the same frame as with the spec's wait. After the last press,
+the screen is compared without padding, since that is when it gets checked. Presses followed by a
+hatch step keep the spec's wait, and hatch steps are walked until their eggs hatch, as in a hunt.
+
+Every candidate is tried from a savestate taken before the press. The savestate is restored in
+the same write as the program played from it, so the server starts the program on the frame it
+restored, however fast the emulator runs. Emulation is deterministic, so one try is enough. The search is a binary search, which assumes that any wait longer than one that
+works also works. The result gets a safety margin and is never longer than the spec's wait.
+"""
+
+import math
+import time
+import random
+from dataclasses import dataclass, replace
+from typing import Optional
+from pkbt.config import TUNER_MARGIN, TUNER_MARGIN_FRAMES, TUNER_MAX_CHECK_FRAMES
+from pkbt.input.input_program import InputProgram
+from pkbt.mgba_connection import MGBAConnection
+from pkbt.hunt.spec import HuntSpec, Press, Hatch, ShinyCheck
+from pkbt.hunt.compiler import compile_steps
+from pkbt.hunt.hatching import hatch_eggs
+from pkbt.hunt.profile import TuningProfile, TUNED_PHASES, press_id
+
+"""Savestate slot the tuner works from"""
+TUNE_SLOT = "tune"
+
+"""Extra frames the state must stay the same for, for a press to be tuned at all"""
+STABILITY_FRAMES = 30
+
+@dataclass
+class _Unit:
+    """One press that can be tuned, or a step that is played as the spec has it"""
+    program: InputProgram           # played with the spec's timing
+    press: Optional[Press] = None
+    press_id: Optional[str] = None
+    hatch: Optional[Hatch] = None   # played until the egg hatches
+
+class DelayTuner:
+    """Tunes the waits after the presses of a hunt spec on one instance (see the module docstring)"""
+
+    def __init__(self, spec: HuntSpec, client: MGBAConnection, margin: float = TUNER_MARGIN,
+                 margin_frames: int = TUNER_MARGIN_FRAMES, max_check_frames: int = TUNER_MAX_CHECK_FRAMES) -> None:
+        self.spec = spec
+        self.client = client
+        self.margin = margin
+        self.margin_frames = margin_frames
+        self.max_check_frames = max_check_frames
+        self.regions: list[tuple[int, ...]] = list(spec.tune_regions)
+        if isinstance(spec.check, ShinyCheck):
+            self.regions.append(spec.check.pixel)
+
+    def tune(self) -> Optional[TuningProfile]:
+        """Tune every press of the cycle, returning None if the instance stopped responding"""
+        units = self._units()
+        waits: dict[str, int] = {}
+        identity = self.client.identity or self.client.identify()
+        if identity is None or not self.client.reset_game():
+            return None
+        for i, unit in enumerate(units):
+            if unit.press is not None:
+                if not self.client.save_state(TUNE_SLOT):
+                    return None
+                wait = self._tune_press(unit, *self._check_program(units, i))
+                if wait is None:
+                    return None
+                waits[unit.press_id] = wait
+                # Carry on from the savestate with the tuned wait
+                if not self._restore_and_play(self._press_program(unit.press, wait)):
+                    return None
+            elif unit.hatch is not None:
+                if not hatch_eggs(self.client, unit.hatch, identity.game_code):
+                    print("Eggs didn't hatch, tuning stopped")
+                    return None
+            elif not self.client.run_program(unit.program):
+                return None
+
+        return TuningProfile(self.spec.name, identity.game_code, waits, int(time.time()))
+
+    def _units(self) -> list[_Unit]:
+        # Jitter and stagger are played as for the first instance, the same on every try
+        rng = random.Random(0)
+        units = []
+        for phase in TUNED_PHASES:
+            for i, step in enumerate(getattr(self.spec, phase)):
+                if isinstance(step, Hatch):
+                    units.append(_Unit(compile_steps([step], 0, rng), hatch=step))
+                    continue
+                if not isinstance(step, Press):
+                    units.append(_Unit(compile_steps([step], 0, rng)))
+                    continue
+                for k in range(step.times):
+                    press = replace(step, times=1)
+                    units.append(_Unit(self._press_program(press, press.wait), press, press_id(phase, i, k)))
+        return units
+
+    def _check_program(self, units: list[_Unit], index: int) -> tuple[Optional[InputProgram], bool]:
+        """What a press's wait is verified with: the steps after it up to the next one that presses
+        a key, and whether there is one (there is none after the last press)
+        """
+        check = InputProgram()
+        for unit in units[index + 1:]:
+            # A walk that stops when the egg hatches can't be lined up frame for frame
+            if unit.hatch is not None:
+                return None, False
+            check.extend(unit.program)
+            if check.total_frames > self.max_check_frames:
+                return None, False
+            if any(bitmask for bitmask, _ in unit.program.steps):
+                return check, True
+        return check, False
+
+    @staticmethod
+    def _press_program(press: Press, wait: int) -> InputProgram:
+        return compile_steps([replace(press, wait=wait)])
+
+    def _restore_and_play(self, program: InputProgram) -> bool:
+        """Restore the savestate and play the program from the frame it was restored on"""
+        with self.client.batch():
+            return self.client.load_state(TUNE_SLOT, wait=False) and self.client.run_program(program)
+
+    def _fingerprint(self, press: Press, wait: int, check: InputProgram, pad: bool,
+                     extra: int = 0) -> Optional[list[int]]:
+        """Play the press with the given wait from the savestate, then the check, and hash the regions"""
+        program = self._press_program(press, wait).extend(check)
+        if pad:
+            # Line up with where the spec's wait would have got to
+            program.wait(press.wait - wait)
+        program.wait(extra)
+        if not self._restore_and_play(program):
+            return None
+        return self.client.probe(self.regions)
+
+    def _tune_press(self, unit: _Unit, check: Optional[InputProgram], pad: bool) -> Optional[int]:
+        press, spec_wait = unit.press, unit.press.wait
+        if check is None:
+            print(f"{unit.press_id}: followed by a long step, keeping {spec_wait} frames")
+            return spec_wait
+
+        reference = self._fingerprint(press, spec_wait, check, pad)
+        settled = self._fingerprint(press, spec_wait, check, pad, STABILITY_FRAMES)
+        if reference is None or settled is None:
+            return None
+        if reference != settled:
+            print(f"{unit.press_id}: screen still changing, keeping {spec_wait} frames")
+            return spec_wait
+
+        # Shortest wait that reaches the same state; spec_wait is known to
+        low, high = 0, spec_wait
+        while low < high:
+            mid = (low + high) // 2
+            fingerprint = self._fingerprint(press, mid, check, pad)
+            if fingerprint is None:
+                return None
+            if fingerprint == reference:
+                high = mid
+            else:
+                low = mid + 1
+
+        wait = min(spec_wait, math.ceil(high * (1 + self.margin)) + self.margin_frames)
+        print(f"{unit.press_id}: {spec_wait} -> {wait} frames (shortest that worked: {high})")
+        return wait
@@ -1,12 +1,42 @@
 from PIL import Image, ImageDraw
 
+"""GBA screen dimensions"""
+SCREEN_WIDTH = 240
+SCREEN_HEIGHT = 160
+
+def rgb_hex(r, g, b):
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+def color_hex(color):
+    # Packed 0xRRGGBB color, as returned by MGBAConnection.probe for a point
+    return f"#{color & 0xFFFFFF:06x}"
+
+def hex_color(color):
+    # Inverse of color_hex, e.g. for MGBAConnection.wait_for_pixel
+    return int(color.lstrip("#"), 16)
+
+def region_hash(frame, x, y, w, h):
+    # 32-bit FNV-1a over the RGB bytes of a region, row by row.
+    # Matches the hash MGBAConnection.probe returns for a rectangle.
+    hash_value = 0x811C9DC5
+    for byte in frame[y:y + h, x:x + w].tobytes():
+        hash_value = ((hash_value ^ byte) * 0x01000193) & 0xFFFFFFFF
+    return hash_value
+
+def frame_pixel_rgb(frame, x, y):
+    # Frames from MGBAConnection.grab_frame are indexed [row, column]
+    r, g, b = frame[y, x]
+    return int(r), int(g), int(b)
+
+def frame_pixel_hex(frame, x, y):
+    return rgb_hex(*frame_pixel_rgb(frame, x, y))
+
 def pixel_rgb(path, x, y):
     im = Image.open(path).convert("RGB")  # 3 channels, no alpha
     return im.getpixel((x, y))            # Normal: (x, y)
 
 def pixel_hex(path, x, y):
-    r, g, b = pixel_rgb(path, x, y)
-    return f"#{r:02x}{g:02x}{b:02x}"
+    return rgb_hex(*pixel_rgb(path, x, y))
 
 def save_with_crosshair(src_path, out_path, x, y):
     # Load image as RGB
@@ -0,0 +1,85 @@
+from typing import Iterable
+from pkbt.input.key_type import KeyType
+from pkbt.input.key_state import keys_to_bitmask
+from pkbt.config import DEFAULT_PUSH_FRAMES
+
+# Do not change, hard-coded in mGBA socket server
+PROGRAM_CTRL_CHAR = "\x04"
+
+"""Native GBA refresh rate, used to convert between frames and seconds at 1x speed"""
+GBA_FRAMES_PER_SECOND = 59.7275
+
+def frames_from_seconds(seconds: float) -> int:
+    """Convert a duration at 1x emulation speed into a whole number of frames"""
+    return max(0, round(seconds * GBA_FRAMES_PER_SECOND))
+
+class InputProgram:
+    """A sequence of (bitmask, frames) steps that the mGBA server plays back on its frame callback.
+
+    Each step sets the emulator's keys to the bitmask for the given number of frames, so a wait
+    is just a step with no keys held. Keys are released once the last step has run.
+    Note that two consecutive presses of the same key need a wait between them, otherwise
+    the game sees a single long press.
+    """
+
+    def __init__(self) -> None:
+        self._steps: list[tuple[int, int]] = []
+
+    @classmethod
+    def from_steps(cls, steps: Iterable[tuple[int, int]]) -> "InputProgram":
+        """Build a program from (bitmask, frames) steps, e.g. a recording"""
+        program = cls()
+        for bitmask, frames in steps:
+            program._append(bitmask, frames)
+        return program
+
+    @property
+    def steps(self) -> list[tuple[int, int]]:
+        """Get a copy of the (bitmask, frames) steps (read-only)"""
+        return list(self._steps)
+
+    @property
+    def total_frames(self) -> int:
+        """Number of frames the program takes to play back"""
+        return sum(frames for _, frames in self._steps)
+
+    def duration_seconds(self) -> float:
+        """Duration of the program at 1x emulation speed"""
+        return self.total_frames / GBA_FRAMES_PER_SECOND
+
+    def hold(self, keys: KeyType | Iterable[KeyType], frames: int) -> "InputProgram":
+        """Hold the given key(s) for a number of frames"""
+        return self._append(keys_to_bitmask(keys), frames)
+
+    def press(self, key: KeyType | Iterable[KeyType], frames: int = DEFAULT_PUSH_FRAMES) -> "InputProgram":
+        """Press the given key(s) for a short number of frames"""
+        return self.hold(key, frames)
+
+    def wait(self, frames: int) -> "InputProgram":
+        """Release all keys for a number of frames"""
+        return self._append(0, frames)
+
+    def extend(self, other: "InputProgram") -> "InputProgram":
+        """Append every step of another program"""
+        for bitmask, frames in other._steps:
+            self._append(bitmask, frames)
+        return self
+
+    def _append(self, bitmask: int, frames: int) -> "InputProgram":
+        if frames < 0:
+            raise ValueError(f"Frame count must not be negative, got {frames}")
+        if frames == 0:
+            return self
+        # Merge with the previous step when the key state does not change
+        if self._steps and self._steps[-1][0] == bitmask:
+            self._steps[-1] = (bitmask, self._steps[-1][1] + frames)
+        else:
+            self._steps.append((bitmask, frames))
+        return self
+
+    def serialize(self) -> str:
+        steps_str = ",".join(f"{bitmask}:{frames}" for bitmask, frames in self._steps)
+        return f"{PROGRAM_CTRL_CHAR}{steps_str}\n"
+
+    def __len__(self) -> int:
+        return len(self._steps)
@@ -1,27 +1,49 @@
-from typing import Dict
+from typing import Dict, Iterable
 from pkbt.input.key_type import KeyType, KEY_TYPES
 
 # Do not change, hard-coded in mGBA socket server
 KEY_STATE_CTRL_CHAR = "\x01"
 
+def key_bit(key_type: KeyType) -> int:
+    """Bit associated with a key in the mGBA key bitmask"""
+    return 1 << KEY_TYPES.index(key_type)
+
+def keys_to_bitmask(keys: KeyType | Iterable[KeyType]) -> int:
+    """Combine one or more keys into a single bitmask"""
+    if isinstance(keys, KeyType):
+        return key_bit(keys)
+    bitmask = 0
+    for k in keys:
+        bitmask |= key_bit(k)
+    return bitmask
+
+def bitmask_to_keys(bitmask: int) -> list[KeyType]:
+    """Split a bitmask into the keys it holds"""
+    return [k for k in KEY_TYPES if bitmask & key_bit(k)]
+
 class KeyState:
     
     def __init__(self):
         self._key_states: Dict[KeyType, bool] = {}
+        self._bitmask: int = 0
         self.clear()
 
     def clear(self):
         for k in KEY_TYPES:
             self._key_states[k] = False
+        self._bitmask = 0
 
     def set_key(self, key_type: KeyType, is_held: bool):
         self._key_states[key_type] = is_held
+        # Keep the bitmask up to date so sending it costs nothing
+        if is_held:
+            self._bitmask |= key_bit(key_type)
+        else:
+            self._bitmask &= ~key_bit(key_type)
+
+    def bitmask(self) -> int:
+        return self._bitmask
 
     def serialize_bitmask(self) -> str:
-        # Build bitmask on client side
-        keys = 0
-        for i, key_type in enumerate(KEY_TYPES):
-            if self._key_states[key_type]:
-                keys |= (1 << i)
-        bitmask_str = f"{KEY_STATE_CTRL_CHAR}{keys}\n"
-        return bitmask_str
\ No newline at end of file
+        bitmask_str = f"{KEY_STATE_CTRL_CHAR}{self.bitmask()}\n"
+        return bitmask_str
@@ -0,0 +1,62 @@
+"""Macros: input programs saved to a file, usually recorded while playing (see record_macro.py)
+
+A macro file has one step per line: the keys held, joined with "+" or "-" for none, and the
+number of frames they are held for. Lines starting with "#" are comments.
+
+    # Walk into the grass and open the menu
+    - 40
+    LEFT 48
+    START 3
+    - 60
+"""
+
+from pathlib import Path
+from pkbt.input.key_type import KeyType
+from pkbt.input.key_state import keys_to_bitmask, bitmask_to_keys
+from pkbt.input.input_program import InputProgram
+
+"""Written in place of keys for steps that hold none"""
+NO_KEYS = "-"
+
+def format_keys(bitmask: int) -> str:
+    keys = bitmask_to_keys(bitmask)
+    return "+".join(k.name for k in keys) if keys else NO_KEYS
+
+def parse_keys(text: str) -> int:
+    if text == NO_KEYS:
+        return 0
+    try:
+        return keys_to_bitmask([KeyType[name.upper()] for name in text.split("+")])
+    except KeyError:
+        raise ValueError(f"Unknown key in {text!r}, expected one of {[k.name for k in KeyType]}") from None
+
+def trim_leading_wait(program: InputProgram) -> InputProgram:
+    """Drop the frames before the first key is pressed, e.g. before the player started playing"""
+    steps = program.steps
+    if steps and steps[0][0] == 0:
+        steps = steps[1:]
+    return InputProgram.from_steps(steps)
+
+def save_macro(program: InputProgram, path: Path | str, comment: str = "") -> Path:
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    lines = [f"# {line}" for line in comment.splitlines()]
+    lines.append(f"# {program.total_frames} frames, {program.duration_seconds():.1f}s at 1x speed")
+    lines.extend(f"{format_keys(bitmask)} {frames}" for bitmask, frames in program.steps)
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return path
+
+def load_macro(path: Path | str) -> InputProgram:
+    """Read a macro file, raising ValueError with the line that is wrong"""
+    path = Path(path)
+    steps = []
+    for number, line in enumerate(path.read_text(encoding="utf-8").splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            keys, frames = line.split()
+            steps.append((parse_keys(keys), int(frames)))
+        except ValueError as e:
+            raise ValueError(f"{path}:{number}: expected keys and a frame count, got {line!r} ({e})") from None
+    return InputProgram.from_steps(steps)
@@ -1,27 +1,134 @@
 import socket
 import time
+import queue
+import itertools
 import threading
-from typing import Optional, Callable
+from contextlib import contextmanager
+from dataclasses import dataclass
+from concurrent.futures import Executor
+from typing import NamedTuple, Optional, Callable
+import numpy as np
 from pkbt.input.key_event import KeyEvent
 from pkbt.input.key_event_type import KeyEventType
 from pkbt.input.key_type import KeyType, KEY_TYPES
-from pkbt.input.key_state import KeyState
+from pkbt.input.key_state import KeyState, KEY_STATE_CTRL_CHAR
+from pkbt.input.input_program import InputProgram, GBA_FRAMES_PER_SECOND
+from pkbt.config import (
+    HEARTBEAT_INTERVAL, HEARTBEAT_DEADLINE, RECONNECT_INITIAL_DELAY, RECONNECT_MAX_DELAY,
+    RECONNECT_MAX_ATTEMPTS,
+)
+from pkbt.emulation_speed import SpeedMeter, SpeedStats
+from pkbt.image_processing import hex_color
+from pkbt.protocol import (
+    RESET_CTRL_CHAR, SCREENSHOT_CTRL_CHAR, IDENTIFY_CTRL_CHAR, FRAME_REPORT_CTRL_CHAR, RECORD_CTRL_CHAR, CONDITION_WAIT_FRAMES, BINARY_PROTOCOL, CONTROL_ROLE, Command,
+    ReplyDecoder, InstanceIdentity, validate_protocol, encode_message, encode_key_state, encode_program, encode_reset,
+    encode_screenshot, encode_save_state, encode_load_state, encode_read_memory, encode_grab_frame,
+    encode_probe, encode_role, encode_heartbeat, encode_identify, encode_wait_frame,
+    encode_wait_screen, encode_wait_memory, encode_record, encode_program_until, parse_ack, parse_state_reply,
+    parse_role_reply, parse_identity_reply, parse_frame_report, parse_wait_frame_reply, parse_recorded_steps,
+    parse_read_memory_reply, parse_frame_reply, parse_probe_reply, parse_heartbeat_reply,
+)
 
-"""Control characters for other non-key state messages"""
-RESET_CTRL_CHAR = "\x02"
-SCREENSHOT_CTRL_CHAR = "\x03"
+class _Outgoing(NamedTuple):
+    data: bytes
+    queued_at: float
+    key_state: bool  # an untagged key state update, superseded by the next one queued right behind it
+
+@dataclass
+class WriterStats:
+    """Snapshot of a connection's outbound queue and writer thread"""
+    queue_depth: int            # messages waiting to be written
+    messages: int               # messages written so far
+    writes: int                 # socket writes; several queued messages go out in one write
+    bytes_written: int
+    coalesced: int              # key state updates skipped because a newer one followed them
+    mean_write_latency: float   # seconds from queueing a message to it being written
+    max_write_latency: float
+
+@dataclass
+class InboundStats:
+    """Snapshot of a connection's queue of received messages that don't answer a request"""
+    queue_depth: int  # messages waiting for the message callback
+    received: int
+    dropped: int      # oldest messages discarded because the callback fell behind
+
+@dataclass
+class HeartbeatStats:
+    """Snapshot of a connection's heartbeat round-trip times and reconnects"""
+    sent: int
+    missed: int                  # heartbeats that got no reply within the deadline
+    last_rtt: Optional[float]    # seconds
+    mean_rtt: Optional[float]
+    min_rtt: Optional[float]
+    max_rtt: Optional[float]
+    last_frame: Optional[int]    # emulator frame counter from the latest heartbeat reply
+    reconnects: int
+
+"""Seconds between attempts while waiting for a server to start accepting connections"""
+CONNECT_RETRY_INTERVAL = 0.25
+
+"""Tells the dispatch thread to exit"""
+_STOP_DISPATCH = object()
 
 class MGBAConnection:
 
-    def __init__(self, host="localhost", port=8888) -> None:
+    def __init__(self, host="localhost", port=8888, protocol: str = BINARY_PROTOCOL,
+                 inbound_queue_size: int = 1024, executor: Optional[Executor] = None,
+                 auto_reconnect: bool = True) -> None:
+        """protocol selects the framing commands are sent in: "binary", or "text" as a fallback
+
+        Messages that don't answer a request (see listen) wait in a queue of up to
+        inbound_queue_size messages for a dispatch thread, which runs the message callback on
+        each of them in turn, or submits it to executor if one is given.
+
+        Once listening, a heartbeat is sent every HEARTBEAT_INTERVAL seconds. If the server
+        stops answering for HEARTBEAT_DEADLINE seconds, or the socket fails, the connection is
+        considered lost and, with auto_reconnect, is reopened with exponential backoff.
+        """
+        validate_protocol(protocol)
         self._host: str = host
         self._port: int = port
+        self._protocol: str = protocol
+        self._auto_reconnect: bool = auto_reconnect
         self._socket: Optional[socket.socket] = None
         self._connected: bool = False
         self._on_message: Optional[Callable] = None
         self._key_state: KeyState = KeyState()
-        self._ping_thread: Optional[threading.Thread] = None
-        self._stop_ping: bool = False
+        self._role: Optional[str] = None
+        self._identity: Optional[InstanceIdentity] = None
+        self._listening: bool = False
+        self._stop_listening: bool = False
+        self._listen_thread: Optional[threading.Thread] = None
+        self._decoder: ReplyDecoder = ReplyDecoder()
+        self._request_ids = itertools.count(1)
+        self._pending: dict[int, queue.Queue] = {}
+        self._pending_lock: threading.Lock = threading.Lock()
+        # Each thread batches on its own, so a heartbeat never lands in (or flushes) a caller's batch
+        self._batches: threading.local = threading.local()
+        # Everything is written by a single thread, in the order it was queued
+        self._outbound: queue.Queue[Optional[_Outgoing]] = queue.Queue()
+        self._writer_thread: Optional[threading.Thread] = None
+        self._stats_lock: threading.Lock = threading.Lock()
+        self._reset_writer_stats()
+        # Received messages are handed off so a slow callback never stalls the socket
+        self._inbound: queue.Queue = queue.Queue(maxsize=inbound_queue_size)
+        self._executor: Optional[Executor] = executor
+        self._dispatch_thread: Optional[threading.Thread] = None
+        self._received: int = 0
+        self._dropped: int = 0
+        # Health
+        self._heartbeat_thread: Optional[threading.Thread] = None
+        self._stop_heartbeat: threading.Event = threading.Event()
+        self._closing: bool = False
+        self._reconnecting: bool = False
+        self._reconnect_lock: threading.Lock = threading.Lock()
+        self._heartbeats_sent: int = 0
+        self._heartbeats_missed: int = 0
+        self._rtts: list[float] = []
+        self._last_frame: Optional[int] = None
+        self._recorded: Optional[list[tuple[int, int]]] = None  # while recording
+        self._reconnects: int = 0
+        self._speed: SpeedMeter = SpeedMeter()
 
     @property
     def port(self) -> int:
@@ -33,66 +140,342 @@ class MGBAConnection:
         """Check if the client is connected (read-only)"""
         return self._connected
 
-    def connect(self) -> bool:
-        """Connect to the MGBA server (see socket_server.lua)"""
-        try:
-            self._socket = socket.socket()
-            self._socket.settimeout(5.0)
-            self._socket.connect((self._host, self._port))
-            self._connected = True
-            print (f"Connected to mGBA on {self._host}:{self._port}")
+    @property
+    def reconnecting(self) -> bool:
+        """Check if the connection was lost and is being reopened (read-only)"""
+        return self._reconnecting
+
+    @property
+    def identity(self) -> Optional[InstanceIdentity]:
+        """Get the identity the server announced, once it has been received (read-only)"""
+        return self._identity
+
+    @property
+    def protocol(self) -> str:
+        """Get the framing commands are sent in (read-only)"""
+        return self._protocol
+
+    def connect(self, retry_for: float = 0.0, retry_while: Optional[Callable[[], bool]] = None) -> bool:
+        """Connect to the MGBA server (see socket_server.lua)
+
+        Does nothing if already connected. With retry_for, keeps trying for up to that many
+        seconds while the server starts up, or until retry_while (if given) returns False.
+        """
+        if self._connected:
             return True
+        self._closing = False
+        deadline = time.monotonic() + retry_for
+        while not self._open(report_failure=time.monotonic() >= deadline):
+            if time.monotonic() >= deadline or (retry_while and not retry_while()):
+                return False
+            time.sleep(CONNECT_RETRY_INTERVAL)
+        print (f"Connected to mGBA on {self._host}:{self._port}")
+        return True
+
+    def _open(self, report_failure: bool = True) -> bool:
+        """Open a new socket, and start writing to (and, if listening, reading from) it"""
+        try:
+            sock = socket.create_connection((self._host, self._port), timeout=5.0)
+            # Commands are small and latency matters more than packet count
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.settimeout(None)
         except Exception as e:
-            print(f"Connection failed: {e}")
+            if report_failure:
+                print(f"Connection failed: {e}")
             return False
 
-    def disconnect(self):
-        """Disconnect from mGBA"""
-        self._stop_ping = True
-        if self._ping_thread and self._ping_thread.is_alive():
-            self._ping_thread.join(timeout=1.0)
-        
-        if self._socket:
-            self._socket.close()
-            self._socket = None
+        # Anything still queued was meant for the previous socket
+        while True:
+            try:
+                self._outbound.get_nowait()
+            except queue.Empty:
+                break
+        self._decoder.reset()
+        self._socket = sock
+        self._connected = True
+        self._writer_thread = threading.Thread(target=self._write_loop, args=(sock,), daemon=True)
+        self._writer_thread.start()
+        if self._listening:
+            self._listen_thread = threading.Thread(target=self._listen_loop, args=(sock,), daemon=True)
+            self._listen_thread.start()
+        return True
+
+    def _close_socket(self):
+        """Stop writing, after whatever is still queued, and close the socket"""
+        sock, self._socket = self._socket, None
         self._connected = False
+        if self._writer_thread and self._writer_thread.is_alive():
+            self._outbound.put(None)
+            self._writer_thread.join(timeout=1.0)
+        if sock:
+            try:
+                # Wakes up the listening thread
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def disconnect(self):
+        """Disconnect from mGBA, after writing whatever is still queued"""
+        self._closing = True
+        self._stop_heartbeat.set()
+        if self._heartbeat_thread and self._heartbeat_thread.is_alive():
+            self._heartbeat_thread.join(timeout=1.0)
+
+        self._close_socket()
+        self._listening = False
+
+        if self._dispatch_thread and self._dispatch_thread.is_alive():
+            # Messages already received are still dispatched
+            self._queue_inbound(_STOP_DISPATCH)
+            self._dispatch_thread.join(timeout=1.0)
+        self._fail_pending()
         print(f"Disconnected from MGBA on {self._host}:{self._port}")
 
-    def ping(self):
-        """Send a ping to keep the connection alive"""
-        if self._connected and self._socket:
-            try:
-                self._socket.send("ping\n".encode())
-            except Exception as e:
-                print(f"Ping failed: {e}")
-                self._connected = False
-
-    def _ping_loop(self):
-        """Background thread to send periodic pings"""
-        while self._connected and not self._stop_ping:
-            time.sleep(2.0)  # Ping every 2 seconds
-            if not self._stop_ping:
-                self.ping()
-
-    def send(self, message: str) -> bool:
-        """Send a message to mGBA"""
+    def _connection_lost(self, reason: str):
+        """Mark the connection as lost and, with auto_reconnect, start reopening it"""
+        with self._reconnect_lock:
+            if self._closing or self._reconnecting or not self._connected:
+                return
+            self._connected = False
+            print(f"Lost connection to mGBA on port {self._port}: {reason}")
+            if self._auto_reconnect:
+                self._reconnecting = True
+                threading.Thread(target=self._reconnect_loop, daemon=True).start()
+        self._fail_pending()
+
+    def _reconnect_loop(self):
+        """Background thread reopening a lost connection with exponential backoff"""
+        delay = RECONNECT_INITIAL_DELAY
+        try:
+            for attempt in range(1, RECONNECT_MAX_ATTEMPTS + 1):
+                if self._closing:
+                    return
+                self._close_socket()
+                if self._open() and self._restore_session():
+                    self._reconnects += 1
+                    print(f"Reconnected to mGBA on port {self._port} after {attempt} attempt(s)")
+                    return
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            print(f"Giving up reconnecting to mGBA on port {self._port} after {RECONNECT_MAX_ATTEMPTS} attempts")
+            self._close_socket()
+        finally:
+            self._reconnecting = False
+
+    def _restore_session(self) -> bool:
+        """Take back this connection's role and the keys it was holding on a fresh socket
+
+        The server may not have noticed the old socket closing yet, in which case it still
+        holds control and the attempt is retried. A server belonging to a different instance
+        than before (another emulator that took over the port) is never driven.
+        """
+        if self._identity is not None:
+            identity = self.identify(timeout=HEARTBEAT_DEADLINE)
+            if identity is None:
+                return False
+            if identity.instance_id != self._identity.instance_id:
+                print(f"Port {self._port} now belongs to instance {identity.instance_id}, "
+                      f"not {self._identity.instance_id}")
+                return False
+        if not self.set_role(self._role or CONTROL_ROLE, timeout=HEARTBEAT_DEADLINE):
+            return False
+        command = encode_key_state(self._key_state.bitmask())
+        return parse_ack(self._request(command, timeout=HEARTBEAT_DEADLINE))
+
+    def ping(self) -> Optional[float]:
+        """Send a heartbeat, returning its round-trip time in seconds (None if it got no reply)"""
+        self._heartbeats_sent += 1
+        sent_at = time.perf_counter()
+        frame = parse_heartbeat_reply(self._request(encode_heartbeat(), timeout=HEARTBEAT_DEADLINE))
+        if frame is None:
+            self._heartbeats_missed += 1
+            return None
+        rtt = time.perf_counter() - sent_at
+        with self._stats_lock:
+            self._rtts.append(rtt)
+            del self._rtts[:-1000]  # Only the most recent heartbeats count
+        self._last_frame = frame
+        self._speed.record(frame, heartbeat=True)
+        return rtt
+
+    def _heartbeat_loop(self):
+        """Background thread sending periodic heartbeats and detecting a dead or stalled server"""
+        while not self._stop_heartbeat.wait(HEARTBEAT_INTERVAL):
+            if not self._connected:
+                continue
+            if self.ping() is None and self._connected:
+                self._connection_lost(f"no heartbeat reply within {HEARTBEAT_DEADLINE}s")
+
+    def heartbeat_stats(self) -> HeartbeatStats:
+        """Get the heartbeat round-trip times measured so far, and the number of reconnects"""
+        with self._stats_lock:
+            rtts = list(self._rtts)
+        return HeartbeatStats(
+            sent=self._heartbeats_sent,
+            missed=self._heartbeats_missed,
+            last_rtt=rtts[-1] if rtts else None,
+            mean_rtt=sum(rtts) / len(rtts) if rtts else None,
+            min_rtt=min(rtts) if rtts else None,
+            max_rtt=max(rtts) if rtts else None,
+            last_frame=self._last_frame,
+            reconnects=self._reconnects,
+        )
+
+    def _record_frame(self, frame: Optional[int]) -> None:
+        if frame is not None:
+            self._speed.record(frame)
+
+    def speed_stats(self) -> SpeedStats:
+        """Get the emulation speed measured from the frame counters reported while listening
+
+        The status flags an instance that is not fast-forwarding, or whose frame counter has
+        stopped even though its process may still be running.
+        """
+        return self._speed.stats()
+
+    def send(self, message: str | bytes) -> bool:
+        """Queue a message for mGBA, or add it to the current batch (see batch)
+
+        Messages are written by a background thread, so this never blocks on the socket.
+        """
+        return self._send(message.encode() if isinstance(message, str) else message)
+
+    def send_command(self, command: Command) -> bool:
+        """Send a command without waiting for the server to apply it"""
+        # Of several key states waiting to be written, only the latest matters
+        data = encode_message(command, protocol=self._protocol)
+        return self._send(data, key_state=command.ctrl == KEY_STATE_CTRL_CHAR)
+
+    def _send(self, data: bytes, key_state: bool = False) -> bool:
         if not self._connected or not self._socket:
             print("Not connected to mGBA")
             return False
 
+        batch = self._current_batch()
+        if batch is not None:
+            batch.append(data)
+            return True
+        self._enqueue(data, key_state)
+        return True
+
+    def _enqueue(self, data: bytes, key_state: bool = False) -> None:
+        self._outbound.put(_Outgoing(data, time.perf_counter(), key_state))
+
+    def _write_loop(self, sock: socket.socket):
+        """Background thread writing queued messages, taking everything queued at once in one write"""
+        stopping = False
+        while not stopping:
+            item = self._outbound.get()
+            if item is None:
+                return
+            items = [item]
+            while True:
+                try:
+                    item = self._outbound.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                items.append(item)
+
+            # The server would apply back-to-back key states within the same frame anyway
+            chunks = [item.data for item, after in zip(items, items[1:] + [None])
+                      if not (item.key_state and after is not None and after.key_state)]
+            data = b"".join(chunks)
+            try:
+                sock.sendall(data)
+            except Exception as e:
+                if sock is self._socket:
+                    self._connection_lost(f"send failed: {e}")
+                return
+
+            written_at = time.perf_counter()
+            with self._stats_lock:
+                self._messages += len(chunks)
+                self._writes += 1
+                self._bytes_written += len(data)
+                self._coalesced += len(items) - len(chunks)
+                for item in items:
+                    latency = written_at - item.queued_at
+                    self._total_write_latency += latency
+                    self._max_write_latency = max(self._max_write_latency, latency)
+
+    def _fail_pending(self):
+        """Wake up every request waiting for a reply that will never come"""
+        with self._pending_lock:
+            waiting = list(self._pending.values())
+        for w in waiting:
+            try:
+                w.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def _reset_writer_stats(self):
+        with self._stats_lock:
+            self._messages = 0
+            self._writes = 0
+            self._bytes_written = 0
+            self._coalesced = 0
+            self._total_write_latency = 0.0
+            self._max_write_latency = 0.0
+
+    def writer_stats(self, reset: bool = False) -> WriterStats:
+        """Get the outbound queue depth and write latency so far, optionally starting over"""
+        with self._stats_lock:
+            handled = self._messages + self._coalesced
+            stats = WriterStats(
+                queue_depth=self._outbound.qsize(),
+                messages=self._messages,
+                writes=self._writes,
+                bytes_written=self._bytes_written,
+                coalesced=self._coalesced,
+                mean_write_latency=self._total_write_latency / handled if handled else 0.0,
+                max_write_latency=self._max_write_latency,
+            )
+        if reset:
+            self._reset_writer_stats()
+        return stats
+
+    @contextmanager
+    def batch(self):
+        """Collect the messages sent inside the block and send them in a single write
+
+        A request that waits for its reply flushes the batch, itself included, before waiting.
+        Batches belong to the thread that opened them: other threads keep sending as usual.
+        """
+        if self._current_batch() is not None:
+            # Already batching, the outermost block sends everything
+            yield self
+            return
+        self._batches.messages = []
         try:
-            self._socket.send(message.encode())
+            yield self
+        finally:
+            self.flush()
+            self._batches.messages = None
+
+    def _current_batch(self) -> Optional[list[bytes]]:
+        """The batch the calling thread has open, if any"""
+        return getattr(self._batches, "messages", None)
+
+    def flush(self) -> bool:
+        """Send the messages collected so far by the calling thread's batch"""
+        batch = self._current_batch()
+        if not batch:
             return True
-        except Exception as e:
-            print(f"Send failed: {e}")
-            self._connected = False
-            return False
+        data = b"".join(batch)
+        batch.clear()
+        self._enqueue(data)
+        return True
 
     def listen(self, callback: Optional[Callable]):
         """Start listening for messages in a background thread (non-blocking)
         
         This method returns immediately and runs the listening loop in a separate thread.
-        Use stop_listening() to stop the background listening thread.
+        Use stop_listening() to stop the background listening thread. Replies to requests are
+        routed straight to the request; callback runs on the dispatch thread for everything else.
         """
         if not self._connected or not self._socket:
             print("Not connected to mGBA")
@@ -100,79 +483,388 @@ class MGBAConnection:
 
         self._on_message = callback
         self._stop_listening = False
-        
-        # Start ping thread
-        self._ping_thread = threading.Thread(target=self._ping_loop, daemon=True)
-        self._ping_thread.start()
+        self._listening = True
 
-        # Start listening thread
-        self._listen_thread = threading.Thread(target=self._listen_loop, daemon=True)
-        self._listen_thread.start()
+        # Start heartbeat thread
+        if not (self._heartbeat_thread and self._heartbeat_thread.is_alive()):
+            self._stop_heartbeat.clear()
+            self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
+            self._heartbeat_thread.start()
+
+        # Start dispatch and listening threads
+        if not (self._dispatch_thread and self._dispatch_thread.is_alive()):
+            self._dispatch_thread = threading.Thread(target=self._dispatch_loop, daemon=True)
+            self._dispatch_thread.start()
+        if not (self._listen_thread and self._listen_thread.is_alive()):
+            self._listen_thread = threading.Thread(target=self._listen_loop, args=(self._socket,), daemon=True)
+            self._listen_thread.start()
         
         print("Started listening in background thread")
         return True
 
     def stop_listening(self):
-        """Stop the background listening thread"""
+        """Stop handling received messages
+
+        The listening thread exits the next time data arrives, or when the connection closes.
+        """
         self._stop_listening = True
-        if hasattr(self, '_listen_thread') and self._listen_thread and self._listen_thread.is_alive():
+        self._listening = False
+        if self._listen_thread and self._listen_thread.is_alive():
             self._listen_thread.join(timeout=1.0)
         print("Stopped background listening")
 
-    def _listen_loop(self):
+    def _listen_loop(self, sock: socket.socket):
         """Background thread for listening to messages"""
+        reason = "mGBA closed the connection"
         try:
-            while self._connected and not getattr(self, '_stop_listening', False):
-                # Try to receive data with a short timeout
+            while not self._stop_listening:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                self._handle_data(data)
+        except Exception as e:
+            reason = f"listen failed: {e}"
+        # A socket closed by disconnect or replaced by a reconnect was not lost
+        if sock is self._socket and not self._stop_listening:
+            self._connection_lost(reason)
+
+    def _handle_data(self, data: bytes):
+        """Split received data into messages, routing replies to waiting requests"""
+        for reply in self._decoder.feed(data):
+            if reply.request_id is None and reply.ctrl == IDENTIFY_CTRL_CHAR:
+                self._set_identity(parse_identity_reply(reply.payload))
+            elif reply.request_id is None and reply.ctrl == FRAME_REPORT_CTRL_CHAR:
+                self._record_frame(parse_frame_report(reply.payload))
+            elif reply.request_id is None and reply.ctrl == RECORD_CTRL_CHAR:
+                self._add_recorded(parse_recorded_steps(reply.payload))
+            elif reply.request_id is not None:
+                with self._pending_lock:
+                    waiting = self._pending.get(reply.request_id)
+                # Replies to requests that already timed out are dropped
+                if waiting is not None:
+                    try:
+                        waiting.put_nowait(reply.payload)
+                    except queue.Full:
+                        pass
+            else:
+                self._received += 1
+                self._queue_inbound(reply.payload)
+
+    def _set_identity(self, identity: Optional[InstanceIdentity]) -> None:
+        """Remember the first instance this connection reached, which a reconnect must reach again"""
+        if identity is not None and self._identity is None:
+            self._identity = identity
+
+    def _queue_inbound(self, message) -> None:
+        """Queue a message for the dispatch thread, making room by dropping the oldest if needed"""
+        while True:
+            try:
+                self._inbound.put_nowait(message)
+                return
+            except queue.Full:
                 try:
-                    self._socket.settimeout(0.1)  # 100ms timeout
-                    data = self._socket.recv(1024).decode()
-                    if data:
-                        if self._on_message:
-                            self._on_message(data.strip())
-                        else:
-                            print(f"Received: {data.strip()}")
-                except socket.timeout:
-                    # Timeout is expected, continue
+                    self._inbound.get_nowait()
+                    self._dropped += 1
+                except queue.Empty:
                     pass
+
+    def _dispatch_loop(self):
+        """Background thread handing received messages to the message callback"""
+        while True:
+            message = self._inbound.get()
+            if message is _STOP_DISPATCH:
+                return
+            if not self._on_message:
+                print(f"Received: {message}")
+            elif self._executor:
+                self._executor.submit(self._on_message, message)
+            else:
+                try:
+                    self._on_message(message)
                 except Exception as e:
-                    print(f"Listen failed: {e}")
-                    self._connected = False
-                    break
-        except Exception as e:
-            print(f"Listen loop error: {e}")
-            self._connected = False
+                    print(f"Message callback failed: {e}")
+
+    def inbound_stats(self) -> InboundStats:
+        """Get the number of received messages waiting for, handed to and dropped before the callback"""
+        return InboundStats(self._inbound.qsize(), self._received, self._dropped)
 
-    def execute_event(self, key_event: KeyEvent):
-        """Execute a key event"""
+    def _ensure_listening(self) -> bool:
+        """Start the background listening thread if it is not already running"""
+        if self._listen_thread and self._listen_thread.is_alive():
+            return True
+        return self.listen(self._on_message)
+
+    def _request(self, command: Command, timeout: Optional[float]) -> Optional[str | bytes]:
+        """Send a command tagged with a new request ID and wait for the server's reply to it
+
+        Returns None on failure or timeout.
+        """
+        if not self._ensure_listening():
+            return None
+
+        request_id = next(self._request_ids)
+        waiting: queue.Queue = queue.Queue(maxsize=1)
+        with self._pending_lock:
+            self._pending[request_id] = waiting
+        try:
+            if not self.send(encode_message(command, request_id, self._protocol)) or not self.flush():
+                return None
+            return waiting.get(timeout=timeout)
+        except queue.Empty:
+            print(f"Timed out waiting for reply to request {request_id} on port {self._port}")
+            return None
+        finally:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+
+    def _send_key_state(self, wait: bool) -> bool:
+        if wait:
+            return parse_ack(self._request(encode_key_state(self._key_state.bitmask()), timeout=5.0))
+        return self.send_command(encode_key_state(self._key_state.bitmask()))
+
+    def execute_event(self, key_event: KeyEvent, wait: bool = False):
+        """Execute a key event
+
+        With wait=True, each key state change blocks until the server has applied it.
+        """
         match key_event.event_type:
             case KeyEventType.PUSH:
                 self._key_state.set_key(key_event.key_type, True)
-                self.send(self._key_state.serialize_bitmask())
+                self._send_key_state(wait)
                 time.sleep(key_event.push_time)
                 self._key_state.set_key(key_event.key_type, False)
-                self.send(self._key_state.serialize_bitmask())
+                self._send_key_state(wait)
             case KeyEventType.HOLD:
                 self._key_state.set_key(key_event.key_type, True)
-                self.send(self._key_state.serialize_bitmask())
+                self._send_key_state(wait)
             case KeyEventType.RELEASE:
                 self._key_state.set_key(key_event.key_type, False)
-                self.send(self._key_state.serialize_bitmask())
+                self._send_key_state(wait)
 
-    def reset_game(self):
-        """Reset the game"""
-        self.send(RESET_CTRL_CHAR + "\n")
+    def reset_game(self, timeout: float = 5.0) -> bool:
+        """Reset the game, returning once the server has reset it
+
+        The server releases every key before resetting, so no extra key state is sent.
+        """
         # Clear local key state after reset to prevent old states from interfering
         self._key_state.clear()
-        # Force clear all keys multiple times to ensure clean state
-        time.sleep(0.1)  # Wait for reset to complete
-        self.send(self._key_state.serialize_bitmask())  # Send all keys released
-        time.sleep(0.05)  # Small delay
-        self.send(self._key_state.serialize_bitmask())  # Send again to be sure
-
-    def save_screenshot_to_file(self, filename: str):
-        """Take a screenshot and save it to a file"""
-        self.send(SCREENSHOT_CTRL_CHAR + filename + "\n")
+        return parse_ack(self._request(encode_reset(), timeout))
+
+    def run_program(self, program: InputProgram, wait: bool = True, timeout: Optional[float] = None) -> bool:
+        """Play back an input program on the emulator's frame callback
+
+        With wait=True, blocks until the server reports the program has finished. The default
+        timeout is the program's duration at 1x speed plus some slack, so it only trips if the
+        emulator is slower than real time (or stuck).
+        """
+        # The server releases every key when the program ends
+        self._key_state.clear()
+        if not wait:
+            return self.send_command(encode_program(program))
+
+        if timeout is None:
+            timeout = program.duration_seconds() + 5.0
+        return self._request(encode_program(program), timeout) == "done"
+
+    def run_program_until(self, program: InputProgram, conditions: list[Command],
+                          timeout: Optional[float] = None) -> Optional[int]:
+        """Play back an input program until any of the conditions holds, returning the frame one
+        first held on
+
+        Conditions are made with protocol.screen_condition and protocol.memory_condition, and are
+        checked on every frame, so the program stops on the frame it should, e.g. as soon as an
+        egg hatches. Returns None if the program played to the end first, or timed out (see
+        run_program).
+        """
+        self._key_state.clear()
+        if timeout is None:
+            timeout = program.duration_seconds() + 5.0
+        reached = parse_wait_frame_reply(self._request(encode_program_until(program, conditions), timeout))
+        self._record_frame(reached)
+        return reached
+
+    def save_state(self, slot: str, wait: bool = True, timeout: float = 5.0) -> bool:
+        """Capture a savestate into a named in-memory slot on the emulator
+
+        With wait=False, nothing waits for the reply, so inside a batch the state is captured in
+        the same receive callback, and on the same frame, as the request that follows it.
+        """
+        command = encode_save_state(slot)
+        if not wait:
+            return self.send_command(command)
+        return parse_state_reply(self._request(command, timeout), self._port)
+
+    def load_state(self, slot: str, wait: bool = True, timeout: float = 5.0) -> bool:
+        """Restore a savestate previously captured with save_state
+
+        Any running input program is cancelled and all keys are released. With wait=False, it is
+        sent as with save_state, e.g. to restore a state and start a program on the same frame.
+        """
+        command = encode_load_state(slot)
+        self._key_state.clear()
+        if not wait:
+            return self.send_command(command)
+        return parse_state_reply(self._request(command, timeout), self._port)
+
+    def read_memory(self, addr: int, length: int, timeout: float = 5.0) -> Optional[bytes]:
+        """Read a range of the GBA address space"""
+        ranges = self.read_memory_ranges([(addr, length)], timeout)
+        return ranges[0] if ranges is not None else None
+
+    def read_memory_ranges(self, ranges: list[tuple[int, int]], timeout: float = 5.0) -> Optional[list[bytes]]:
+        """Read several (address, length) ranges of the GBA address space in a single request"""
+        if not ranges:
+            return []
+        command = encode_read_memory(ranges)
+        return parse_read_memory_reply(self._request(command, timeout), [length for _, length in ranges])
+
+    def grab_frame(self, as_array: bool = True, timeout: float = 5.0) -> Optional[np.ndarray | memoryview]:
+        """Get the current frame as raw RGB bytes straight over the socket
+
+        Returns a read-only (SCREEN_HEIGHT, SCREEN_WIDTH, 3) uint8 array that shares memory with the
+        received bytes, or a flat memoryview of them with as_array=False.
+        """
+        return parse_frame_reply(self._request(encode_grab_frame(), timeout), as_array)
+
+    def probe(self, regions: list[tuple[int, ...]], timeout: float = 5.0) -> Optional[list[int]]:
+        """Sample a few points or rectangles of the current frame without transferring it
+
+        Each region is either a point (x, y), answered with its packed 0xRRGGBB color, or a
+        rectangle (x, y, w, h), answered with a 32-bit FNV-1a hash of its RGB bytes
+        (see image_processing.region_hash). Results are returned in request order.
+        """
+        if not regions:
+            return []
+        command = encode_probe(regions)
+        return parse_probe_reply(self._request(command, timeout), len(regions))
+
+    def wait_frames(self, frames: int, timeout: Optional[float] = None) -> Optional[int]:
+        """Wait until the emulator has run the given number of frames, returning the frame it is on
+
+        The count starts when the server receives the request and is checked on every frame, so
+        the wait is exact in emulated time however fast the emulator runs. The default timeout is
+        the wait's duration at 1x speed plus some slack. Returns None if it timed out.
+        """
+        return self._wait_frame(frames, True, timeout)
+
+    def wait_until_frame(self, frame: int, timeout: Optional[float] = None) -> Optional[int]:
+        """Wait until the emulator's frame counter reaches frame, returning the frame it is on
+
+        Returns straight away if it is already past it, and None if it timed out.
+        """
+        return self._wait_frame(frame, False, timeout)
+
+    def _wait_frame(self, frame: int, relative: bool, timeout: Optional[float]) -> Optional[int]:
+        if timeout is None:
+            timeout = self._wait_frame_timeout(frame, relative)
+        reached = parse_wait_frame_reply(self._request(encode_wait_frame(frame, relative), timeout))
+        self._record_frame(reached)
+        return reached
+
+    def wait_for_pixel(self, x: int, y: int, color: int | str, equal: bool = True,
+                       frames: int = CONDITION_WAIT_FRAMES, timeout: Optional[float] = None) -> Optional[int]:
+        """Wait until a pixel has the given color, returning the frame it first had it on
+
+        The color is packed 0xRRGGBB (as returned by probe) or a "#rrggbb" string. With
+        equal=False, waits until the pixel has any other color instead. The server checks the
+        condition on every frame and gives up after frames frames (0 for never); the default
+        timeout is that long at 1x speed plus some slack. Returns None if the condition was not
+        met in time.
+        """
+        if isinstance(color, str):
+            color = hex_color(color)
+        return self._wait_condition(encode_wait_screen((x, y), color, equal, frames), frames, timeout)
+
+    def wait_for_screen(self, region: tuple[int, int, int, int], region_hash: int, equal: bool = True,
+                        frames: int = CONDITION_WAIT_FRAMES, timeout: Optional[float] = None) -> Optional[int]:
+        """Wait until a rectangle (x, y, w, h) of the screen has the given hash (see
+        image_processing.region_hash), or any other hash if not equal (see wait_for_pixel)
+
+        Waiting for the hash a region has right now to change (equal=False) catches the next
+        screen transition without knowing what it leads to.
+        """
+        return self._wait_condition(encode_wait_screen(region, region_hash, equal, frames), frames, timeout)
+
+    def wait_for_memory(self, addr: int, value: int, size: int = 1, mask: Optional[int] = None,
+                        equal: bool = True, frames: int = CONDITION_WAIT_FRAMES,
+                        timeout: Optional[float] = None) -> Optional[int]:
+        """Wait until the little-endian value of size (1, 2 or 4) bytes at addr, ANDed with mask if
+        given, equals value, or differs from it if not equal (see wait_for_pixel)
+        """
+        command = encode_wait_memory(addr, size, value, mask, equal, frames)
+        return self._wait_condition(command, frames, timeout)
+
+    def _wait_condition(self, command: Command, frames: int, timeout: Optional[float]) -> Optional[int]:
+        # Without a frame limit, only the caller knows how long is too long
+        if timeout is None and frames:
+            timeout = self._wait_frame_timeout(frames, True)
+        reached = parse_wait_frame_reply(self._request(command, timeout))
+        self._record_frame(reached)
+        return reached
+
+    def _wait_frame_timeout(self, frame: int, relative: bool) -> float:
+        """How long a frame wait takes at 1x speed, plus the heartbeat deadline as slack"""
+        if not relative:
+            frame -= self._speed.stats().frame or 0
+        return max(frame, 0) / GBA_FRAMES_PER_SECOND + HEARTBEAT_DEADLINE
+
+    def start_recording(self, timeout: float = 5.0) -> bool:
+        """Start recording the keys held on every frame, e.g. while someone plays the game
+
+        The server streams what it has recorded every 60 emulated frames, so stopping only has
+        to send the rest. One connection can record an emulator at a time, and recording never
+        changes it, so telemetry clients may record too.
+        """
+        recorded, self._recorded = self._recorded, []
+        reply = self._request(encode_record("start"), timeout)
+        if reply != "ok":
+            if reply is not None:
+                print(f"Recording refused on port {self._port}: {reply}")
+            # Refused or lost, so nothing new is being recorded for this connection
+            self._recorded = recorded
+            return False
+        return True
+
+    def stop_recording(self, timeout: float = 5.0) -> Optional[InputProgram]:
+        """Stop recording, returning an input program that plays back what was recorded, frame
+        for frame (see pkbt.input.macro to save it)
+        """
+        rest = parse_recorded_steps(self._request(encode_record("stop"), timeout))
+        recorded, self._recorded = self._recorded, None
+        if rest is None or recorded is None:
+            return None
+        return InputProgram.from_steps(recorded + rest)
+
+    def _add_recorded(self, steps: Optional[list[tuple[int, int]]]) -> None:
+        if steps is not None and self._recorded is not None:
+            self._recorded.extend(steps)
+
+    def identify(self, timeout: float = 5.0) -> Optional[InstanceIdentity]:
+        """Ask the server which instance it belongs to (see InstanceIdentity)"""
+        identity = parse_identity_reply(self._request(encode_identify(), timeout))
+        self._set_identity(identity)
+        return identity
+
+    def set_role(self, role: str, timeout: float = 5.0) -> bool:
+        """Ask to be the "control" client or a read-only "telemetry" client of the emulator
+
+        The first client to send a command that changes the emulator gets control. Only one client can have it at a time, and
+        telemetry clients can only send commands that observe the emulator. The role is asked
+        for again after a reconnect, which otherwise asks for control.
+        """
+        if not parse_role_reply(self._request(encode_role(role), timeout), self._port):
+            return False
+        self._role = role
+        return True
+
+    def save_screenshot_to_file(self, filename: str, wait: bool = True, timeout: float = 5.0) -> bool:
+        """Take a screenshot and save it to a file
+
+        With wait=True, blocks until the server has finished writing the file.
+        """
+        if not wait:
+            return self.send_command(encode_screenshot(filename))
+        return parse_ack(self._request(encode_screenshot(filename), timeout))
 
     def __enter__(self):
         """Context manager entry"""
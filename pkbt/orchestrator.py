@@ -1,7 +1,9 @@
+import asyncio
 import subprocess
-from typing import Callable
+from typing import Callable, Awaitable, Any
 from pkbt.emulator import EmulatorProc
 from pkbt.mgba_connection import MGBAConnection
+from pkbt.async_mgba_connection import AsyncMGBAConnection
 
 class Orchestrator:
 
@@ -20,11 +22,42 @@ class Orchestrator:
             print(f"Error exiting orchestrator: {e}")
 
     def is_healthy(self) -> bool:
-        """Check if both the emulator process and client connection are healthy."""
+        """Check if both the emulator process and client connection are healthy.
+
+        A connection that is being reopened after a hiccup still counts as healthy.
+        """
         emulator_alive = self.emu.is_alive()
-        client_connected = self.client.connected
+        client_connected = self.client.connected or self.client.reconnecting
         return emulator_alive and client_connected
 
+class AsyncOrchestrator:
+    """Orchestrator whose tasks are coroutines, so a whole fleet can run on one event loop"""
+
+    def __init__(self, emu: EmulatorProc, client: AsyncMGBAConnection) -> None:
+        self.emu = emu
+        self.client = client
+
+    async def perform_task(self, task: Callable[[EmulatorProc, AsyncMGBAConnection], Awaitable[Any]]):
+        return await task(self.emu, self.client)
+
+    async def exit(self) -> None:
+        try:
+            await self.client.disconnect()
+            self.emu.process.terminate()
+        except Exception as e:
+            print(f"Error exiting orchestrator: {e}")
+
+    def is_healthy(self) -> bool:
+        """Check if both the emulator process and client connection are healthy (see Orchestrator.is_healthy)."""
+        return self.emu.is_alive() and (self.client.connected or self.client.reconnecting)
+
+async def perform_task_on_all(orchestrators: list[AsyncOrchestrator], task) -> list[Any]:
+    """Run the same task on every orchestrator concurrently, returning results in order
+
+    Exceptions are returned in place of results so one failing instance doesn't cancel the rest.
+    """
+    return await asyncio.gather(*(o.perform_task(task) for o in orchestrators), return_exceptions=True)
+
 if __name__ == "__main__":
 
     from pkbt.mgba_connection import MGBAConnection
@@ -0,0 +1,447 @@
+"""Encoding and decoding of the messages exchanged with the mGBA socket server (see server.lua)
+
+Shared by MGBAConnection and AsyncMGBAConnection so both speak exactly the same protocol.
+
+Two framings are supported and can be mixed on one connection:
+
+- Text (the original protocol): newline-terminated lines starting with a control character,
+  optionally prefixed with a request ID. Replies start with the ID and control character of the
+  request they answer; bulk replies are a header line holding a byte count, followed by that many
+  raw bytes.
+- Binary: a fixed 12-byte little-endian header (magic, version, opcode, flags, request ID, payload
+  length) followed by the payload. The opcode is the byte value of the text control character, and
+  replies are binary frames carrying the request's ID. Numbers are packed instead of spelled out in
+  decimal or hex, and the server never has to scan for line ends.
+
+Commands with nothing else to say reply "ok" once applied, so every tagged request gets an answer.
+The server also reports its frame counter to every connection about once a second.
+Waits are answered on the first frame a target frame is reached, or a condition on the screen or
+memory holds, so scripts never have to sleep for a guessed duration. An input program can also
+be stopped by such conditions, e.g. walking until an egg hatches.
+A session can record the keys held on every frame; the server streams them as the steps of an
+input program while recording, so a played sequence can be saved and played back.
+The first client to send a command that changes the emulator takes control of it; others are
+read-only telemetry clients unless they take control once it is free. Every connection is greeted
+with the instance's identity, so clients can check which emulator they reached.
+"""
+
+import json
+import struct
+from typing import NamedTuple, Optional
+import numpy as np
+from pkbt.input.key_state import KEY_STATE_CTRL_CHAR
+from pkbt.input.input_program import PROGRAM_CTRL_CHAR, InputProgram
+from pkbt.image_processing import SCREEN_WIDTH, SCREEN_HEIGHT
+
+"""Control characters for other non-key state messages"""
+RESET_CTRL_CHAR = "\x02"
+SCREENSHOT_CTRL_CHAR = "\x03"
+SAVE_STATE_CTRL_CHAR = "\x05"
+LOAD_STATE_CTRL_CHAR = "\x06"
+READ_MEMORY_CTRL_CHAR = "\x07"
+GRAB_FRAME_CTRL_CHAR = "\x08"
+PROBE_CTRL_CHAR = "\x09"
+ROLE_CTRL_CHAR = "\x0b"
+HEARTBEAT_CTRL_CHAR = "\x0c"
+IDENTIFY_CTRL_CHAR = "\x0e"
+FRAME_REPORT_CTRL_CHAR = "\x0f"
+WAIT_FRAME_CTRL_CHAR = "\x11"
+WAIT_SCREEN_CTRL_CHAR = "\x12"
+WAIT_MEMORY_CTRL_CHAR = "\x13"
+RECORD_CTRL_CHAR = "\x14"
+PROGRAM_UNTIL_CTRL_CHAR = "\x15"
+
+"""Prefixes a request ID to a request, and to the server's reply to it"""
+REQUEST_ID_CTRL_CHAR = "\x10"
+
+"""Replies to these carry raw bytes: a header line with the byte count, followed by that many bytes"""
+BULK_REPLY_CTRL_CHARS = {GRAB_FRAME_CTRL_CHAR}
+
+"""Binary replies to these carry packed data rather than a status string"""
+BINARY_DATA_REPLY_CTRL_CHARS = {READ_MEMORY_CTRL_CHAR, GRAB_FRAME_CTRL_CHAR, PROBE_CTRL_CHAR}
+
+"""Size of a raw RGB frame"""
+FRAME_SIZE = SCREEN_WIDTH * SCREEN_HEIGHT * 3
+
+"""Binary framing (see wire_protocol.lua)"""
+BINARY_MAGIC = 0xFE
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<BBBBII")  # magic, version, opcode, flags, request ID, payload length
+
+"""Session roles: one control client per emulator, any number of read-only telemetry clients"""
+CONTROL_ROLE = "control"
+TELEMETRY_ROLE = "telemetry"
+ROLES = (CONTROL_ROLE, TELEMETRY_ROLE)
+
+"""Framings a connection can send its commands in"""
+TEXT_PROTOCOL = "text"
+BINARY_PROTOCOL = "binary"
+PROTOCOLS = (TEXT_PROTOCOL, BINARY_PROTOCOL)
+
+"""Sizes in bytes of the memory values a condition wait can compare"""
+MEMORY_VALUE_SIZES = (1, 2, 4)
+
+"""Frames a condition wait gives up after unless told otherwise (10 s at 1x speed)"""
+CONDITION_WAIT_FRAMES = 600
+
+"""What a recording request can ask for"""
+RECORD_ACTIONS = ("start", "stop")
+
+_KEY_STATE_RECORD = struct.Struct("<H")
+_PROGRAM_STEP_RECORD = struct.Struct("<HI")
+_MEMORY_RANGE_RECORD = struct.Struct("<II")
+_PROBE_REGION_RECORD = struct.Struct("<HHHH")
+_WAIT_FRAME_RECORD = struct.Struct("<BI")  # relative flag, frame
+_WAIT_SCREEN_RECORD = struct.Struct("<BIIHHHH")  # equal flag, frames, value, region
+_WAIT_MEMORY_RECORD = struct.Struct("<BIIIBI")  # equal flag, frames, value, address, size, mask
+_CONDITION_COUNT_RECORD = struct.Struct("<B")
+_CONDITION_HEADER_RECORD = struct.Struct("<BH")  # opcode, payload length
+
+# --- Requests ---
+
+class Command(NamedTuple):
+    """A command in both of its forms, framed by encode_message"""
+    ctrl: str
+    text: str       # the text line after the control character, without the newline
+    payload: bytes  # the binary frame payload
+
+def validate_protocol(protocol: str) -> None:
+    if protocol not in PROTOCOLS:
+        raise ValueError(f"Unknown protocol {protocol!r}, expected one of {PROTOCOLS}")
+
+def tag_request(request_id: int, message: str) -> str:
+    """Prefix a text request with an ID, which the server echoes in its reply"""
+    return f"{REQUEST_ID_CTRL_CHAR}{request_id}{message}"
+
+def encode_message(command: Command, request_id: Optional[int] = None, protocol: str = TEXT_PROTOCOL) -> bytes:
+    """Frame a command, tagged with a request ID if one is given"""
+    if protocol == BINARY_PROTOCOL:
+        header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, ord(command.ctrl), 0,
+                                    request_id or 0, len(command.payload))
+        return header + command.payload
+    message = f"{command.ctrl}{command.text}\n"
+    if request_id is not None:
+        message = tag_request(request_id, message)
+    return message.encode()
+
+def encode_key_state(bitmask: int) -> Command:
+    return Command(KEY_STATE_CTRL_CHAR, str(bitmask), _KEY_STATE_RECORD.pack(bitmask))
+
+def encode_program(program: InputProgram) -> Command:
+    steps = program.steps
+    text = ",".join(f"{bitmask}:{frames}" for bitmask, frames in steps)
+    payload = b"".join(_PROGRAM_STEP_RECORD.pack(bitmask, frames) for bitmask, frames in steps)
+    return Command(PROGRAM_CTRL_CHAR, text, payload)
+
+def encode_reset() -> Command:
+    return Command(RESET_CTRL_CHAR, "", b"")
+
+def encode_screenshot(filename: str) -> Command:
+    return Command(SCREENSHOT_CTRL_CHAR, filename, filename.encode())
+
+def _validate_slot(slot: str) -> None:
+    if not slot or "\n" in slot:
+        raise ValueError(f"Invalid savestate slot name: {slot!r}")
+
+def encode_save_state(slot: str) -> Command:
+    _validate_slot(slot)
+    return Command(SAVE_STATE_CTRL_CHAR, slot, slot.encode())
+
+def encode_load_state(slot: str) -> Command:
+    _validate_slot(slot)
+    return Command(LOAD_STATE_CTRL_CHAR, slot, slot.encode())
+
+def encode_read_memory(ranges: list[tuple[int, int]]) -> Command:
+    for addr, length in ranges:
+        if addr < 0 or length <= 0:
+            raise ValueError(f"Invalid memory range: address {addr:#x}, length {length}")
+    text = ",".join(f"{addr}:{length}" for addr, length in ranges)
+    payload = b"".join(_MEMORY_RANGE_RECORD.pack(addr, length) for addr, length in ranges)
+    return Command(READ_MEMORY_CTRL_CHAR, text, payload)
+
+def encode_grab_frame() -> Command:
+    return Command(GRAB_FRAME_CTRL_CHAR, "", b"")
+
+def encode_probe(regions: list[tuple[int, ...]]) -> Command:
+    for region in regions:
+        if len(region) not in (2, 4):
+            raise ValueError(f"Probe regions must be (x, y) or (x, y, w, h), got {region}")
+    text = ";".join(",".join(str(v) for v in region) for region in regions)
+    # Points are sent as zero-sized rectangles
+    payload = b"".join(_PROBE_REGION_RECORD.pack(*region, *(0, 0)[:4 - len(region)]) for region in regions)
+    return Command(PROBE_CTRL_CHAR, text, payload)
+
+def encode_heartbeat() -> Command:
+    return Command(HEARTBEAT_CTRL_CHAR, "", b"")
+
+def encode_role(role: str) -> Command:
+    if role not in ROLES:
+        raise ValueError(f"Unknown role {role!r}, expected one of {ROLES}")
+    return Command(ROLE_CTRL_CHAR, role, role.encode())
+
+def encode_identify() -> Command:
+    return Command(IDENTIFY_CTRL_CHAR, "", b"")
+
+def encode_wait_frame(frame: int, relative: bool) -> Command:
+    """Wait until the given frame, or for that many frames from when the server receives it"""
+    if frame < 0:
+        raise ValueError(f"Invalid frame {frame}")
+    text = f"+{frame}" if relative else str(frame)
+    return Command(WAIT_FRAME_CTRL_CHAR, text, _WAIT_FRAME_RECORD.pack(int(relative), frame))
+
+def encode_wait_screen(region: tuple[int, ...], value: int, equal: bool, frames: int) -> Command:
+    """Wait until a point's color or a rectangle's hash (see encode_probe) matches value, or differs
+    from it if not equal, giving up after frames frames (0 for never)
+    """
+    if len(region) not in (2, 4):
+        raise ValueError(f"Screen conditions must be on (x, y) or (x, y, w, h), got {region}")
+    if frames < 0:
+        raise ValueError(f"Invalid frame limit {frames}")
+    op = "=" if equal else "!="
+    text = f"{','.join(str(v) for v in region)}{op}{value};{frames}"
+    payload = _WAIT_SCREEN_RECORD.pack(int(equal), frames, value, *region, *(0, 0)[:4 - len(region)])
+    return Command(WAIT_SCREEN_CTRL_CHAR, text, payload)
+
+def encode_wait_memory(addr: int, size: int, value: int, mask: Optional[int], equal: bool,
+                       frames: int) -> Command:
+    """Wait until the little-endian value of size bytes at addr, masked, matches value, or differs
+    from it if not equal, giving up after frames frames (0 for never)
+    """
+    if addr < 0 or size not in MEMORY_VALUE_SIZES:
+        raise ValueError(f"Invalid memory condition: address {addr:#x}, size {size}")
+    if frames < 0:
+        raise ValueError(f"Invalid frame limit {frames}")
+    op = "=" if equal else "!="
+    text = f"{addr}:{size}{'' if mask is None else f'&{mask}'}{op}{value};{frames}"
+    payload = _WAIT_MEMORY_RECORD.pack(int(equal), frames, value, addr, size,
+                                       0xFFFFFFFF if mask is None else mask)
+    return Command(WAIT_MEMORY_CTRL_CHAR, text, payload)
+
+def screen_condition(region: tuple[int, ...], value: int, equal: bool = True) -> Command:
+    """A screen condition to stop a program with (see encode_wait_screen and encode_program_until)"""
+    return encode_wait_screen(region, value, equal, 0)
+
+def memory_condition(addr: int, value: int, size: int = 1, mask: Optional[int] = None,
+                     equal: bool = True) -> Command:
+    """A memory condition to stop a program with (see encode_wait_memory and encode_program_until)"""
+    return encode_wait_memory(addr, size, value, mask, equal, 0)
+
+def encode_program_until(program: InputProgram, conditions: list[Command]) -> Command:
+    """Play a program until any of the conditions holds, made with screen_condition or memory_condition"""
+    if not conditions:
+        raise ValueError("A program needs at least one condition to stop on")
+    for condition in conditions:
+        if condition.ctrl not in (WAIT_SCREEN_CTRL_CHAR, WAIT_MEMORY_CTRL_CHAR):
+            raise ValueError(f"Programs can only stop on screen or memory conditions, got {condition.ctrl!r}")
+    steps = encode_program(program)
+    text = "|".join([*(f"{c.ctrl}{c.text}" for c in conditions), steps.text])
+    payload = _CONDITION_COUNT_RECORD.pack(len(conditions)) + b"".join(
+        _CONDITION_HEADER_RECORD.pack(ord(c.ctrl), len(c.payload)) + c.payload for c in conditions)
+    return Command(PROGRAM_UNTIL_CTRL_CHAR, text, payload + steps.payload)
+
+def encode_record(action: str) -> Command:
+    """Start or stop recording the keys held on every frame"""
+    if action not in RECORD_ACTIONS:
+        raise ValueError(f"Unknown recording action {action!r}, expected one of {RECORD_ACTIONS}")
+    return Command(RECORD_CTRL_CHAR, action, action.encode())
+
+# --- Replies ---
+
+class Reply(NamedTuple):
+    request_id: Optional[int]  # None for messages that don't answer a request
+    ctrl: Optional[str]
+    payload: str | bytes       # bytes for bulk replies and binary data replies
+
+class InstanceIdentity(NamedTuple):
+    """Which emulator a server belongs to, as announced when a client connects"""
+    instance_id: str         # given by the launcher (see EmulatorProc), or made up by the server
+    pid: Optional[int]       # only known where the emulator can read /proc
+    rom_title: str
+    game_code: str
+    port: int                # the port the server is actually listening on
+
+class ReplyDecoder:
+    """Incrementally splits bytes received from the server into messages, in either framing"""
+
+    def __init__(self) -> None:
+        self._buf: bytearray = bytearray()
+        self._bulk_reply: Optional[tuple[int, str, int]] = None
+
+    def feed(self, data: bytes) -> list[Reply]:
+        self._buf += data
+        messages: list[Reply] = []
+        # Consumed bytes are only removed once per call, so many small messages arriving
+        # together don't each shift the rest of the buffer
+        pos = self._parse(messages)
+        del self._buf[:pos]
+        return messages
+
+    def _parse(self, messages: list[Reply]) -> int:
+        """Append every complete message in the buffer, returning how many bytes they took up"""
+        buf = self._buf
+        pos = 0
+        while True:
+            # Raw bytes announced by a bulk reply header
+            if self._bulk_reply is not None:
+                request_id, ctrl, size = self._bulk_reply
+                if len(buf) - pos < size:
+                    return pos
+                body = bytes(buf[pos:pos + size])
+                pos += size
+                self._bulk_reply = None
+                messages.append(Reply(request_id, ctrl, body))
+                continue
+
+            if pos < len(buf) and buf[pos] == BINARY_MAGIC:
+                if len(buf) - pos < BINARY_HEADER.size:
+                    return pos
+                _, version, opcode, _, request_id, length = BINARY_HEADER.unpack_from(buf, pos)
+                start = pos + BINARY_HEADER.size
+                end = start + length
+                if len(buf) < end:
+                    return pos
+                payload = bytes(buf[start:end])
+                pos = end
+                if version != BINARY_VERSION:
+                    print(f"Ignoring frame with unsupported protocol version {version}")
+                    continue
+                # Request ID 0 marks a message that doesn't answer a request
+                ctrl = chr(opcode)
+                if ctrl not in BINARY_DATA_REPLY_CTRL_CHARS:
+                    payload = payload.decode()
+                messages.append(Reply(request_id or None, ctrl, payload))
+                continue
+
+            end = buf.find(b"\n", pos)
+            if end < 0:
+                return pos
+            line = buf[pos:end].decode().rstrip("\r")
+            pos = end + 1
+
+            if not line.startswith(REQUEST_ID_CTRL_CHAR):
+                messages.append(Reply(None, None, line))
+                continue
+
+            digits = 1
+            while digits < len(line) and line[digits].isdigit():
+                digits += 1
+            request_id, ctrl, payload = int(line[1:digits]), line[digits:digits + 1], line[digits + 1:]
+            if ctrl in BULK_REPLY_CTRL_CHARS:
+                self._bulk_reply = (request_id, ctrl, int(payload))
+            else:
+                messages.append(Reply(request_id, ctrl, payload))
+
+    def reset(self) -> None:
+        self._buf.clear()
+        self._bulk_reply = None
+
+def parse_ack(reply: Optional[str]) -> bool:
+    return reply == "ok"
+
+def parse_state_reply(reply: Optional[str], port: int) -> bool:
+    if reply is None:
+        return False
+    if reply != "ok":
+        print(f"Savestate command failed on port {port}: {reply}")
+        return False
+    return True
+
+def parse_heartbeat_reply(reply: Optional[str]) -> Optional[int]:
+    """Get the emulator's frame counter from a heartbeat reply"""
+    if reply is None:
+        return None
+    return int(reply)
+
+def parse_identity_reply(reply: Optional[str]) -> Optional[InstanceIdentity]:
+    if reply is None:
+        return None
+    try:
+        fields = json.loads(reply)
+        return InstanceIdentity(str(fields["instance_id"]), fields.get("pid"), fields.get("rom_title", ""),
+                                fields.get("game_code", ""), int(fields["port"]))
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"Invalid identity {reply!r}: {e}")
+        return None
+
+def parse_frame_report(report: str) -> Optional[int]:
+    """Get the emulator's frame counter from a periodic frame report"""
+    try:
+        return int(report)
+    except ValueError:
+        print(f"Invalid frame report {report!r}")
+        return None
+
+def parse_wait_frame_reply(reply: Optional[str]) -> Optional[int]:
+    """Get the frame counter a frame or condition wait ended on"""
+    if reply is None:
+        return None
+    try:
+        return int(reply)
+    except ValueError:
+        print(f"Wait failed: {reply}")
+        return None
+
+def parse_recorded_steps(reply: Optional[str]) -> Optional[list[tuple[int, int]]]:
+    """Get the (bitmask, frames) steps of a recording, streamed or answering its stop request"""
+    if reply is None:
+        return None
+    if reply.startswith("error"):
+        print(f"Recording failed: {reply}")
+        return None
+    try:
+        return [(int(bitmask), int(frames)) for bitmask, frames in
+                (step.split(":") for step in reply.split(",") if step)]
+    except ValueError:
+        print(f"Invalid recording {reply!r}")
+        return None
+
+def parse_role_reply(reply: Optional[str], port: int) -> bool:
+    if reply is None:
+        return False
+    if reply != "ok":
+        print(f"Role change refused on port {port}: {reply}")
+        return False
+    return True
+
+def parse_read_memory_reply(reply: Optional[str | bytes], lengths: list[int]) -> Optional[list[bytes]]:
+    if reply is None:
+        return None
+    if isinstance(reply, bytes):
+        # Binary replies hold the ranges back to back
+        if len(reply) != sum(lengths):
+            print(f"Memory read returned {len(reply)} bytes, expected {sum(lengths)}")
+            return None
+        data, offset = [], 0
+        for length in lengths:
+            data.append(reply[offset:offset + length])
+            offset += length
+        return data
+    data = [bytes.fromhex(h) for h in reply.split(",")]
+    if len(data) != len(lengths):
+        print(f"Memory read returned {len(data)} ranges, expected {len(lengths)}")
+        return None
+    return data
+
+def parse_frame_reply(frame: Optional[bytes], as_array: bool) -> Optional[np.ndarray | memoryview]:
+    if frame is None:
+        return None
+    if len(frame) != FRAME_SIZE:
+        print(f"Frame has {len(frame)} bytes, expected {FRAME_SIZE}")
+        return None
+    if not as_array:
+        return memoryview(frame)
+    return np.frombuffer(frame, dtype=np.uint8).reshape(SCREEN_HEIGHT, SCREEN_WIDTH, 3)
+
+def parse_probe_reply(reply: Optional[str | bytes], expected: int) -> Optional[list[int]]:
+    if reply is None:
+        return None
+    if isinstance(reply, bytes):
+        if len(reply) != 4 * expected:
+            print(f"Probe returned {len(reply)} bytes, expected {4 * expected}")
+            return None
+        return list(struct.unpack(f"<{expected}I", reply))
+    values = [int(v, 16) for v in reply.split(",")]
+    if len(values) != expected:
+        print(f"Probe returned {len(values)} values, expected {expected}")
+        return None
+    return values
@@ -1,11 +1,81 @@
-from pkbt.config import TEMP_DIR, STATE_MANAGER
+import json
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+from pkbt.config import INSTANCE_REGISTRY, REGISTRY_STALE_AFTER
+
+@dataclass
+class InstanceRecord:
+    """An emulator's entry in the instance registry (see state_manager.lua)"""
+    instance_id: str
+    port: int
+    pid: Optional[int]        # only recorded where the emulator can read /proc
+    rom_title: Optional[str]  # not known until a game is loaded
+    game_code: Optional[str]
+    started: int              # Unix time the server started
+    heartbeat: int            # Unix time the entry was last refreshed
+    path: Path
+
+    def is_stale(self, now: Optional[float] = None) -> bool:
+        """Check if the instance has stopped refreshing its entry, so is most likely gone"""
+        return (now or time.time()) - self.heartbeat > REGISTRY_STALE_AFTER
 
 def initialize_state_manager():
-    """Create runtime folder if it doesn't exist"""
-    TEMP_DIR.mkdir(parents=True, exist_ok=True)
-
-    """Create/initialize state manager file"""
-    if not STATE_MANAGER.exists():
-        STATE_MANAGER.touch()
-    with open(STATE_MANAGER, "w", encoding="utf-8") as f:
-        f.write("[]")
\ No newline at end of file
+    """Create the registry folder if it doesn't exist"""
+    INSTANCE_REGISTRY.mkdir(parents=True, exist_ok=True)
+
+    """Clear out entries left behind by instances that are gone"""
+    collect_garbage()
+
+def _read_entry(path: Path) -> Optional[InstanceRecord]:
+    try:
+        fields = json.loads(path.read_text(encoding="utf-8"))
+        return InstanceRecord(str(fields["instance_id"]), int(fields["port"]), fields.get("pid"),
+                              fields.get("rom_title"), fields.get("game_code"),
+                              int(fields.get("started", 0)), int(fields["heartbeat"]), path)
+    except FileNotFoundError:
+        # Removed, or being replaced (Windows can't rename over an existing file)
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Ignoring invalid registry entry {path.name}: {e}")
+        return None
+
+def read_instances(include_stale: bool = False) -> list[InstanceRecord]:
+    """Read the registry, sorted by port
+
+    Entries are written atomically by the instances themselves, so this never needs a lock.
+    """
+    if not INSTANCE_REGISTRY.exists():
+        return []
+    now = time.time()
+    records = [r for r in map(_read_entry, INSTANCE_REGISTRY.glob("*.json")) if r is not None]
+    return sorted((r for r in records if include_stale or not r.is_stale(now)), key=lambda r: r.port)
+
+def find_instance(instance_id: str) -> Optional[InstanceRecord]:
+    """Get the registry entry of one instance, if it is live"""
+    record = _read_entry(INSTANCE_REGISTRY / f"{instance_id}.json")
+    if record is None or record.is_stale():
+        return None
+    return record
+
+def collect_garbage() -> int:
+    """Delete the entries of instances that stopped refreshing them, returning how many were removed
+
+    Unreadable entries and temporary files abandoned by an instance that died mid-write are
+    removed once they have not been touched for as long.
+    """
+    if not INSTANCE_REGISTRY.exists():
+        return 0
+    now = time.time()
+    removed = 0
+    for path in INSTANCE_REGISTRY.glob("*.json*"):
+        record = _read_entry(path) if path.suffix == ".json" else None
+        try:
+            stale = record.is_stale(now) if record else now - path.stat().st_mtime > REGISTRY_STALE_AFTER
+            if stale:
+                path.unlink()
+                removed += 1
+        except OSError:
+            pass
+    return removed
@@ -0,0 +1,190 @@
+import time
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Optional
+from pkbt.config import (
+    CRASH_LOG, SUPERVISOR_MAX_RESTARTS, SUPERVISOR_RESTART_WINDOW, SUPERVISOR_HANG_TIMEOUT,
+    SUPERVISOR_CHECK_INTERVAL,
+)
+from pkbt.fleet import Fleet
+from pkbt.orchestrator import Orchestrator
+
+"""States of a supervised slot"""
+RUNNING = "running"
+FINISHED = "finished"
+RETIRED = "retired"
+
+@dataclass
+class CrashRecord:
+    """One failure of a supervised instance, and what was done about it"""
+    time: float           # Unix time
+    slot: int
+    port: int
+    pid: Optional[int]
+    reason: str
+    action: str           # "restarted", "restart failed" or "retired"
+
+    def __str__(self) -> str:
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.time))
+        return f"{when} slot {self.slot} (port {self.port}, pid {self.pid}): {self.reason} -> {self.action}"
+
+@dataclass
+class _Slot:
+    """One place in the hunt, kept busy by whichever instance currently fills it"""
+    index: int
+    orchestrator: Orchestrator
+    state: str = RUNNING
+    restarts: deque = field(default_factory=deque)  # times of recent restarts
+    reconnecting_since: Optional[float] = None
+    hung: bool = False
+
+class Supervisor:
+    """Keeps every instance of a fleet working on its task, replacing the ones that crash or hang
+
+    Each orchestrator's task runs in its own thread, as task(orchestrator, slot). A task should
+    return once its orchestrator is no longer healthy (see Orchestrator.is_healthy). If it returns
+    on an unhealthy orchestrator, or raises, the instance is replaced by a freshly booted one with
+    the same ROM and scripts and the task is started again on it. A task that returns on a healthy
+    orchestrator has finished its slot.
+
+    An instance whose connection has been trying to reconnect for hang_timeout seconds is
+    considered hung and its emulator is stopped, so its task notices. A slot that needs more than
+    max_restarts restarts within restart_window seconds is retired, leaving the rest of the fleet
+    to carry on without it. Every failure is appended to the crash log.
+    """
+
+    def __init__(self, fleet: Fleet, task: Callable[[Orchestrator, int], Any],
+                 max_restarts: int = SUPERVISOR_MAX_RESTARTS,
+                 restart_window: float = SUPERVISOR_RESTART_WINDOW,
+                 hang_timeout: float = SUPERVISOR_HANG_TIMEOUT,
+                 check_interval: float = SUPERVISOR_CHECK_INTERVAL,
+                 crash_log: Optional[Path] = CRASH_LOG) -> None:
+        self.fleet = fleet
+        self.task = task
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
+        self.hang_timeout = hang_timeout
+        self.check_interval = check_interval
+        self.crash_log = crash_log
+        self.crashes: list[CrashRecord] = []
+        self._slots: list[_Slot] = []
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def run(self, orchestrators: Optional[list[Orchestrator]] = None) -> None:
+        """Run the task on every orchestrator (the fleet's by default), until every slot has
+        finished or been retired
+        """
+        if orchestrators is None:
+            orchestrators = list(self.fleet.orchestrators)
+        self._slots = [_Slot(i, o) for i, o in enumerate(orchestrators)]
+        self._stopping.clear()
+
+        watchdog = threading.Thread(target=self._watch, daemon=True)
+        watchdog.start()
+        threads = [threading.Thread(target=self._run_slot, args=(slot,), daemon=True) for slot in self._slots]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self._stopping.set()
+        watchdog.join(timeout=self.check_interval * 2)
+
+    def stop(self) -> None:
+        """Stop restarting instances; run returns once the running tasks do"""
+        self._stopping.set()
+
+    def active(self) -> int:
+        """Get the number of slots still working on their task"""
+        return sum(1 for slot in self._slots if slot.state == RUNNING)
+
+    def _run_slot(self, slot: _Slot) -> None:
+        """Thread running the task in one slot, restarting its instance whenever it fails"""
+        while True:
+            error = None
+            try:
+                self.task(slot.orchestrator, slot.index)
+            except Exception as e:
+                error = f"task raised {e!r}"
+            if self._stopping.is_set():
+                return
+            if error is None and slot.orchestrator.is_healthy() and not slot.hung:
+                slot.state = FINISHED
+                return
+            if not self._replace(slot, error or self._diagnose(slot)):
+                slot.state = RETIRED
+                print(f"Slot {slot.index} retired, {self.active()} instance(s) still running")
+                return
+
+    def _replace(self, slot: _Slot, reason: str) -> bool:
+        """Boot a new instance in place of a failed one, within the slot's restart limit"""
+        while not self._stopping.is_set():
+            old = slot.orchestrator
+            if not self._allow_restart(slot):
+                old.exit()
+                self._record(slot, reason, "retired")
+                return False
+            print(f"Restarting slot {slot.index}: {reason}")
+            new = self.fleet.relaunch(old)
+            if new is not None:
+                self._record(slot, reason, "restarted")
+                slot.orchestrator = new
+                slot.hung = False
+                slot.reconnecting_since = None
+                return True
+            self._record(slot, reason, "restart failed")
+            reason = "restarted instance did not become ready"
+        return False
+
+    def _allow_restart(self, slot: _Slot) -> bool:
+        now = time.monotonic()
+        while slot.restarts and now - slot.restarts[0] > self.restart_window:
+            slot.restarts.popleft()
+        if len(slot.restarts) >= self.max_restarts:
+            return False
+        slot.restarts.append(now)
+        return True
+
+    def _diagnose(self, slot: _Slot) -> str:
+        o = slot.orchestrator
+        if slot.hung:
+            return f"connection unresponsive for {self.hang_timeout:.0f}s"
+        if not o.emu.is_alive():
+            return f"emulator exited with code {o.emu.process.poll()}"
+        if not (o.client.connected or o.client.reconnecting):
+            return "connection lost and could not be reopened"
+        return "task returned on an unhealthy instance"
+
+    def _watch(self) -> None:
+        """Background thread stopping the emulators of instances that have hung"""
+        while not self._stopping.wait(self.check_interval):
+            now = time.monotonic()
+            for slot in self._slots:
+                o = slot.orchestrator
+                if slot.state != RUNNING or slot.hung or not o.client.reconnecting:
+                    slot.reconnecting_since = None
+                    continue
+                if slot.reconnecting_since is None:
+                    slot.reconnecting_since = now
+                elif now - slot.reconnecting_since > self.hang_timeout:
+                    print(f"Slot {slot.index} has been reconnecting for {self.hang_timeout:.0f}s, stopping its emulator")
+                    slot.hung = True
+                    # A hung process can't be asked to exit
+                    o.emu.process.kill()
+
+    def _record(self, slot: _Slot, reason: str, action: str) -> None:
+        o = slot.orchestrator
+        pid = o.emu.process.pid if hasattr(o.emu, "process") else None
+        record = CrashRecord(time.time(), slot.index, o.client.port, pid, reason, action)
+        with self._lock:
+            self.crashes.append(record)
+            if self.crash_log is not None:
+                try:
+                    self.crash_log.parent.mkdir(parents=True, exist_ok=True)
+                    with open(self.crash_log, "a", encoding="utf-8") as f:
+                        f.write(f"{record}\n")
+                except OSError as e:
+                    print(f"Could not write to crash log {self.crash_log}: {e}")
+        print(f"Crash: {record}")
@@ -13,6 +13,7 @@ from pkbt.input.key_event import KeyEvent
 from pkbt.state_manager import initialize_state_manager
 from pkbt.emulator import EmulatorProc
 from pkbt.mgba_connection import MGBAConnection
+from pkbt.discovery import candidate_ports, locate
 from pkbt.config import MGBA_DEV, SERVER_SCRIPT, TEMP_DIR
 # from pkbt.windowing import Window, arrange_windows_auto_grid, minimize_windows_starting_with, get_primary_screen_width
 from pkbt.image_processing import pixel_hex, save_with_crosshair
@@ -64,7 +65,7 @@ def task(o: Orchestrator, idx: int):
         time.sleep(0.7)
 
     def offset_clock():
-        time.sleep((o.client._port - 8888) * 0.25)
+        time.sleep(idx * 0.25)
 
     def add_jitter():
         time.sleep(random.uniform(0, 1))
@@ -162,7 +163,7 @@ def task(o: Orchestrator, idx: int):
             break
 
         runs += 1
-        if o.client._port == 8888:
+        if idx == 0:
             print(f"Runs: {runs}")
         start_game()
         offset_clock()
@@ -183,21 +184,20 @@ def task(o: Orchestrator, idx: int):
 """Putting it all together and running it"""
 initialize_state_manager()
 
-# Create the orchestrators
-orchestrators = []
-for i in range(NUM_INSTANCES):
-    orch = Orchestrator(
-        EmulatorProc(MGBA_DEV, POKEMON_RED_ROM, [SERVER_SCRIPT]),
-        MGBAConnection('localhost', STARTING_PORT + i))
-    orchestrators.append(orch)
-
 # Start the emulators
+emulators = [EmulatorProc(MGBA_DEV, POKEMON_RED_ROM, [SERVER_SCRIPT]) for _ in range(NUM_INSTANCES)]
 emu_pids: list[int] = []
-for i in range(NUM_INSTANCES):
-    pid = orchestrators[i].perform_task(lambda e, c: e.process.pid if e.start() else None)
-    emu_pids.append(pid)
+for e in emulators:
+    emu_pids.append(e.process.pid if e.start() else None)
     time.sleep(0.5)
 
+# Connect each emulator to the server that announces its instance ID
+identities = locate(emulators, candidate_ports(STARTING_PORT, NUM_INSTANCES))
+orchestrators = [
+    Orchestrator(e, MGBAConnection('localhost', identity.port))
+    for e, identity in zip(emulators, identities) if identity is not None
+]
+
 # # Arrange the windows in a grid
 # time.sleep(10)
 # windows = [Window.from_pid(pid) for pid in emu_pids]